@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""
+Merges the streams of several KSIM hosts into one, in timestamp order
+
+Each host watching part of the room is a Source: a non-blocking subscription
+whose bytes go straight into a FrameParser. Aggregator services all of them
+from one selector in a single thread and returns their frames as one stream,
+each tagged with the host it came from.
+
+Frames of one host arrive in timestamp order, so a frame can be passed on once
+every open source has sent a frame at least as recent (the watermark). A host
+that falls silent must not hold up the others, so frames are also passed on
+after waiting window seconds, or when more than max_buffered are held; frames
+arriving after a more recent one was passed on are dropped and counted in late.
+
+Timestamps are compared after adding the offset of their source (in ticks), to
+correct for hosts whose clocks are known to differ. With align, each source's
+timestamps are first mapped to the host monotonic clock of this process by a
+clock.ClockAlignment, which removes the offsets and drifts without configuring
+them, at the cost of the network delay differences between the hosts.
+
+    python aggregator.py 224 kinect-a kinect-b:8001 kinect-c@-1500000
+"""
+
+import collections
+import heapq
+import selectors
+import sys
+import time
+
+import codec
+from clock import ClockAlignment
+from codec import FrameType, HEADER, TICKS_PER_SECOND
+from decode import FrameParser
+from relay import subscribe
+
+# timestamp: after the source's offset (and alignment); source_timestamp: as sent by the host
+Frame = collections.namedtuple('Frame', ['timestamp', 'host', 'source_timestamp', 'frame_type', 'content', 'writer_data'])
+
+
+class Source(object):
+    """
+    Non-blocking subscription to frame_types on one KSIM host
+    host: name the frames are tagged with, "address:port" by default
+    """
+
+    def __init__(self, address, port, frame_types, offset=0, host=None, capacity=1 << 20):
+        self.address = address
+        self.port = port
+        self.frame_types = FrameType(frame_types)
+        self.offset = offset
+        self.host = host if host is not None else "{}:{}".format(address, port)
+        self.parser = FrameParser(capacity)
+        self.sock = None
+        self.closed = False
+        # Source timestamp of the last frame received, None before the first one
+        self.last_timestamp = None
+        self.frames_received = 0
+
+    def open(self):
+        self.sock = subscribe(self.address, self.port, self.frame_types)
+        self.sock.setblocking(False)
+        return self
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def receive(self):
+        """
+        Receive into the parser with one recv call, without blocking
+        Return: False if nothing was available or the host closed the connection (then closed is set)
+        """
+        try:
+            received = self.sock.recv_into(self.parser.buffer())
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            received = 0
+        if not received:
+            self.closed = True
+            return False
+        self.parser.advance(received)
+        return True
+
+    def read(self):
+        """
+        Receive everything available without blocking
+        Return: list of the complete frames received, as bytes; sets closed once the host closed the connection
+        """
+        frames = []
+        while self.receive():
+            # Copied, the parser reuses its buffer and the frames may be held in the reorder window
+            frames.extend(bytes(frame) for frame in self.parser.frames())
+        if frames:
+            self.last_timestamp = HEADER.unpack_from(frames[-1])[0]
+            self.frames_received += len(frames)
+        return frames
+
+    def close(self):
+        self.closed = True
+        if self.sock is not None:
+            self.sock.close()
+
+
+class Aggregator(object):
+    """
+    Merges the frames of sources into one stream ordered by (offset) timestamp
+    window: seconds a frame may wait for the other sources; max_buffered: frames held at most
+    """
+
+    def __init__(self, sources, window=0.1, max_buffered=1024, align=False, clock=time.monotonic):
+        self.sources = list(sources)
+        if len({source.host for source in self.sources}) != len(self.sources):
+            raise ValueError("Sources must have distinct host names")
+        self.window = window
+        self.max_buffered = max_buffered
+        self.clock = clock
+        self.alignments = {source.host: ClockAlignment(clock=clock) for source in self.sources} if align else None
+
+        self.emitted = 0
+        self.late = 0
+        self.forced = 0
+
+        self._selector = selectors.DefaultSelector()
+        # (timestamp, sequence, arrival, source, raw frame); sequence keeps equal timestamps in arrival order
+        self._heap = []
+        self._sequence = 0
+        self._last_emitted = None
+        # Offset timestamp of the last frame received from each source
+        self._latest = {}
+
+    def open(self):
+        try:
+            for source in self.sources:
+                source.open()
+                self._selector.register(source.sock, selectors.EVENT_READ, source)
+        except BaseException:
+            # Don't leave the connections already made behind
+            self.close()
+            raise
+        return self
+
+    def _timestamp(self, source, timestamp, arrival, frame_type):
+        if self.alignments is not None:
+            # Audio reuses the timestamp of the last multi source frame, it mustn't move the estimate
+            alignment = self.alignments[source.host].observe(timestamp, arrival, update=frame_type != FrameType.Audio)
+            if alignment is not None:
+                timestamp = int(alignment.capture_time * TICKS_PER_SECOND)
+        return timestamp + source.offset
+
+    def _receive(self, source, now):
+        for raw_frame in source.read():
+            source_timestamp, frame_type = HEADER.unpack_from(raw_frame)
+            timestamp = self._timestamp(source, source_timestamp, now, frame_type)
+            self._latest[source.host] = timestamp
+            if self._last_emitted is not None and timestamp < self._last_emitted:
+                self.late += 1
+                continue
+            heapq.heappush(self._heap, (timestamp, self._sequence, now, source, raw_frame))
+            self._sequence += 1
+        if source.closed:
+            self._selector.unregister(source.sock)
+            source.close()
+
+    def _watermark(self):
+        open_sources = [source for source in self.sources if not source.closed]
+        if any(source.host not in self._latest for source in open_sources):
+            return None
+        return min((self._latest[source.host] for source in open_sources), default=float('inf'))
+
+    def _ready(self, now, flush=False):
+        watermark = self._watermark()
+        while self._heap:
+            timestamp, _, arrival, source, raw_frame = self._heap[0]
+            if not (flush or (watermark is not None and timestamp <= watermark)):
+                if now - arrival >= self.window or len(self._heap) > self.max_buffered:
+                    self.forced += 1
+                else:
+                    break
+            heapq.heappop(self._heap)
+            self._last_emitted = timestamp
+            self.emitted += 1
+            (source_timestamp, frame_type), content, (writer_data,) = codec.decode(raw_frame)
+            yield Frame(timestamp, source.host, source_timestamp, FrameType(frame_type), content, writer_data)
+
+    def frames(self):
+        """
+        Yield Frame in timestamp order until every source closed its connection
+        """
+        while any(not source.closed for source in self.sources):
+            # Wake up in time to pass on the oldest frame held once its window is over
+            timeout = None
+            if self._heap:
+                timeout = max(self._heap[0][2] + self.window - self.clock(), 0)
+            for key, _ in self._selector.select(timeout):
+                self._receive(key.data, self.clock())
+            for frame in self._ready(self.clock()):
+                yield frame
+        for frame in self._ready(self.clock(), flush=True):
+            yield frame
+
+    def __iter__(self):
+        return self.frames()
+
+    def close(self):
+        for source in self.sources:
+            if source.sock is not None and not source.closed:
+                if source.sock in self._selector.get_map():
+                    self._selector.unregister(source.sock)
+                source.close()
+        self._selector.close()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def parse_source(spec, frame_types):
+    """
+    spec: address[:port][@offset], offset in ticks
+    """
+    spec, _, offset = spec.partition('@')
+    address, _, port = spec.partition(':')
+    return Source(address, int(port) if port else 8000, frame_types, int(offset) if offset else 0)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage: aggregator.py <frame types> <host[:port][@offset]> ... [--align]")
+        sys.exit(1)
+
+    frame_types = int(sys.argv[1])
+    sources = [parse_source(spec, frame_types) for spec in sys.argv[2:] if not spec.startswith('--')]
+    with Aggregator(sources, align='--align' in sys.argv) as aggregator:
+        try:
+            for frame in aggregator:
+                print("{:<20d} {:<24s} {:<12s} '{}'".format(frame.timestamp, frame.host, frame.frame_type.name,
+                                                          bytes(frame.writer_data).decode('ascii', 'replace')))
+        except KeyboardInterrupt:
+            pass
+        print("{} frames, {} late, {} passed on before the other hosts caught up".format(
+            aggregator.emitted, aggregator.late, aggregator.forced))
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+"""
+asyncio client for KSIM streams
+
+One event loop can service any number of subscriptions (including the Audio
+connection, which KSIM requires to be separate) and the VoxSim channel:
+
+    async def main():
+        body = await open_stream('localhost', 8000, FrameType.ClosestBody | FrameType.LHDepth)
+        audio = await open_stream('localhost', 8000, FrameType.Audio)
+        voxsim = CoalescingVoxSim(await open_voxsim('localhost', 8000)).start()
+        ...
+        async for (timestamp, frame_type), content, (writer_data,) in body:
+            ...
+
+Received bytes go straight into a FrameParser buffer through asyncio.BufferedProtocol,
+so a single read can complete several frames without intermediate copies.
+
+Affixes given to CoalescingVoxSim are batched into one VOXSIM_PASS per tick and
+tagged with a sequence number; feeding the tails of stream frames to its
+AffixLatency tracker measures how long they take to come back.
+"""
+
+import asyncio
+import collections
+import sys
+import time
+
+import numpy as np
+
+import codec
+import metrics
+from codec import FrameType
+from decode import FrameParser
+from protocol import pack_recognizer_registration, pack_voxsim_registration, pack_voxsim_pass, is_valid_subscription, \
+    tag_affix, parse_affix
+
+
+class _FrameProtocol(asyncio.BufferedProtocol):
+    """
+    Parses frames as they are received and queues a copy of each for the consumer
+    Reading is paused while more than max_queued frames are waiting.
+    """
+
+    def __init__(self, max_queued):
+        self.parser = FrameParser()
+        self.max_queued = max_queued
+        self.frames = collections.deque()
+        self.transport = None
+        self.exception = None
+        self.closed = False
+        self._paused = False
+        self._waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.parser.buffer()
+
+    def buffer_updated(self, nbytes):
+        self.parser.advance(nbytes)
+        try:
+            for frame in self.parser.frames():
+                # The parser reuses its buffer, so frames handed out must be copied
+                self.frames.append(bytes(frame))
+        except ValueError as ex:
+            self.exception = ex
+            self.transport.close()
+
+        if len(self.frames) > self.max_queued and not self._paused:
+            self._paused = True
+            self.transport.pause_reading()
+        self._wakeup()
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        self.closed = True
+        if exc is not None and self.exception is None:
+            self.exception = exc
+        self._wakeup()
+
+    def _wakeup(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def next_frame(self):
+        while not self.frames:
+            if self.exception is not None:
+                raise self.exception
+            if self.closed:
+                raise EOFError("Error: Connection closed with {} bytes of an incomplete frame".format(self.parser.pending))
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+
+        frame = self.frames.popleft()
+        if self._paused and len(self.frames) <= self.max_queued // 2:
+            self._paused = False
+            self.transport.resume_reading()
+        return frame
+
+
+class FrameStream(object):
+    """
+    Async iterator over the frames of one subscription, yielding
+    (timestamp, frame_type), content, (writer_data,) as decoded by codec.decode
+    """
+
+    def __init__(self, transport, protocol, frame_types):
+        self.transport = transport
+        self.protocol = protocol
+        self.frame_types = FrameType(frame_types)
+
+    async def read_raw(self):
+        """
+        Return the next frame as bytes, without the length prefix
+        """
+        return await self.protocol.next_frame()
+
+    async def read(self):
+        raw_frame = await self.read_raw()
+        begin = time.perf_counter()
+        # Each raw frame is its own bytes object, so views in the content stay valid
+        header, content, tail = codec.decode(raw_frame)
+        metrics.REGISTRY.observe_frame(header[1], header[0], len(raw_frame) + codec.LENGTH.size,
+                                       time.perf_counter() - begin, tail[0])
+        return header, content, tail
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.read()
+        except EOFError:
+            raise StopAsyncIteration
+
+    def close(self):
+        self.transport.close()
+
+
+class VoxSimChannel(object):
+    """
+    Connection registered as VoxSim, used to pass affixes to the tail of stream frames
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def send(self, affixes):
+        """
+        affixes: dict of frame types (a FrameType bitset) to the affix for them (str or bytes)
+        """
+        self.writer.write(pack_voxsim_pass(affixes))
+        await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+
+
+class AffixLatency(object):
+    """
+    Round trip time of tagged affixes, from sending them to seeing them in the tail of a frame
+
+    Only the first frame carrying a sequence number counts. Sequence numbers not
+    seen after max_pending later ones were sent are given up on and counted in lost.
+    """
+
+    def __init__(self, max_pending=1024, max_samples=10000, clock=time.monotonic):
+        self.clock = clock
+        self.max_pending = max_pending
+        self.samples = collections.deque(maxlen=max_samples)
+        self.lost = 0
+        # sequence -> time sent, in sending order
+        self._pending = collections.OrderedDict()
+
+    def sent(self, sequence, when=None):
+        self._pending[sequence] = self.clock() if when is None else when
+        while len(self._pending) > self.max_pending:
+            self._pending.popitem(last=False)
+            self.lost += 1
+
+    def observe(self, writer_data, when=None):
+        """
+        writer_data: tail of a received frame
+        Return: (sequence, affix) as returned by protocol.parse_affix
+        """
+        sequence, affix = parse_affix(writer_data)
+        if sequence is not None:
+            sent = self._pending.pop(sequence, None)
+            if sent is not None:
+                self.samples.append((self.clock() if when is None else when) - sent)
+        return sequence, affix
+
+    def percentiles(self, q=(50, 90, 99)):
+        """
+        Return: dict of percentile to round trip time in seconds, over the last max_samples affixes
+        """
+        if not self.samples:
+            return {p: None for p in q}
+        return dict(zip(q, np.percentile(np.fromiter(self.samples, dtype=np.float64), q).tolist()))
+
+
+class CoalescingVoxSim(object):
+    """
+    Batches affix updates: between two sends only the last affix given for each
+    frame type is kept, and everything pending goes out as one VOXSIM_PASS at most
+    once per interval (a Kinect tick by default), tagged with a sequence number.
+    Frame types left with the same affix share one entry of the message.
+    """
+
+    def __init__(self, channel, interval=1 / 30.0, tracker=None):
+        self.channel = channel
+        self.interval = interval
+        self.tracker = tracker if tracker is not None else AffixLatency()
+        self.sequence = 0
+        self.messages_sent = 0
+        self.affixes_sent = 0
+        self.affixes_coalesced = 0
+
+        # Frame type -> affix
+        self._pending = {}
+        self._updated = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    def update(self, frame_types, affix):
+        """
+        Queue affix for frame_types (a FrameType bitset), replacing any affix still pending for each of them
+        """
+        selected = [ft for ft in FrameType if ft & frame_types]
+        if not selected:
+            raise ValueError("No frame type in {}".format(frame_types))
+        for frame_type in selected:
+            if frame_type in self._pending:
+                self.affixes_coalesced += 1
+            self._pending[frame_type] = affix
+        self._updated.set()
+
+    async def flush(self):
+        """
+        Send everything pending now, as one message
+        """
+        if not self._pending:
+            return
+        affixes, self._pending = self._pending, {}
+        self._updated.clear()
+        self.sequence += 1
+        # One entry per distinct affix, for all the frame types it goes to
+        masks = collections.OrderedDict()
+        for frame_type, affix in affixes.items():
+            masks[affix] = masks.get(affix, 0) | frame_type
+        message = {frame_types: tag_affix(self.sequence, affix) for affix, frame_types in masks.items()}
+        self.tracker.sent(self.sequence)
+        await self.channel.send(message)
+        self.messages_sent += 1
+        self.affixes_sent += len(message)
+
+    async def _run(self):
+        last = None
+        while True:
+            await self._updated.wait()
+            if last is not None:
+                delay = last + self.interval - time.monotonic()
+                if delay > 0:
+                    # Let more updates come in until the next tick
+                    await asyncio.sleep(delay)
+            last = time.monotonic()
+            await self.flush()
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        self.channel.close()
+
+
+async def open_stream(host, port, frame_types, max_queued=64):
+    """
+    Connect to KSIM and subscribe to frame_types (a FrameType bitset)
+    """
+    if not is_valid_subscription(frame_types):
+        raise ValueError("Invalid subscription {}: Audio has to be requested on its own".format(frame_types))
+
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_connection(lambda: _FrameProtocol(max_queued), host, port)
+    transport.write(pack_recognizer_registration(frame_types))
+    return FrameStream(transport, protocol, frame_types)
+
+
+async def open_voxsim(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(pack_voxsim_registration())
+    await writer.drain()
+    return VoxSimChannel(reader, writer)
+
+
+async def _print_frames(stream):
+    async for (timestamp, frame_type), content, (writer_data,) in stream:
+        print("{:<20d} {:<4d} '{}'".format(timestamp, frame_type, writer_data.decode('ascii', 'replace')))
+
+
+async def _measure_affix_latency(host, port, frame_types, period=0.1, report_every=50):
+    stream = await open_stream(host, port, frame_types)
+    voxsim = CoalescingVoxSim(await open_voxsim(host, port)).start()
+
+    async def send():
+        while True:
+            voxsim.update(frame_types, "latency probe")
+            await asyncio.sleep(period)
+
+    sender = asyncio.get_running_loop().create_task(send())
+    try:
+        async for header, content, (writer_data,) in stream:
+            sequence, affix = voxsim.tracker.observe(writer_data)
+            if sequence is not None and sequence % report_every == 0:
+                print("Affix round trip over {} messages: {}".format(len(voxsim.tracker.samples), ", ".join(
+                    "p{} {:.1f} ms".format(q, t * 1000) for q, t in voxsim.tracker.percentiles().items())))
+    finally:
+        sender.cancel()
+        voxsim.close()
+        stream.close()
+
+
+async def _main(host, port, masks):
+    streams = [await open_stream(host, port, mask) for mask in masks]
+    try:
+        await asyncio.gather(*[_print_frames(stream) for stream in streams])
+    finally:
+        for stream in streams:
+            stream.close()
+
+
+if __name__ == '__main__':
+    # e.g. async_client.py 32 96 8 for body, both hands and audio on one event loop
+    # or async_client.py --latency 32 for the round trip of affixes to the ClosestBody tail
+    latency = len(sys.argv) > 1 and sys.argv[1] == '--latency'
+    masks = [int(mask) for mask in sys.argv[2 if latency else 1:]] or [FrameType.ClosestBody]
+    try:
+        if latency:
+            asyncio.run(_measure_affix_latency('localhost', 8000, masks[0]))
+        else:
+            asyncio.run(_main('localhost', 8000, masks))
+    except (ConnectionError, EOFError) as ex:
+        print("Error: {}".format(ex))
@@ -1,9 +1,12 @@
-import random
+import argparse
 import socket
 import struct
 import sys
 import numpy as np
-import wave
+from decode import recv_frame
+from codec import decode
+from pcm import to_pcm16, WavWriter
+from audio_chunks import AudioChunker, EnergyGate
 
 src_addr = 'localhost'
 src_port = 8000
@@ -33,71 +36,59 @@ def connect():
 
 
 def decode_frame(raw_frame):
-    # The format is given according to the following assumption of network data
+    # [ commonTimestamp | frame type | sample count | samples | affix ]
+    (timestamp, frame_type), (sample_count, samples), (writer_data,) = decode(raw_frame)
 
-    # Expect little endian byte order
-    endianness = "<"
+    return (timestamp, frame_type, sample_count, samples)
 
-    # [ commonTimestamp | frame type | sample count
-    header_format = "qii"
 
-    timestamp, frame_type, sample_count = struct.unpack(endianness + header_format, raw_frame[:struct.calcsize(header_format)])
-
-    samples_format = str(sample_count) + "f" 
-    # Unpack the raw frame into individual pieces of data as a tuple
-    frame_pieces = struct.unpack(endianness + samples_format, raw_frame[struct.calcsize(header_format):])
-    
-    return (timestamp, frame_type, sample_count, list(frame_pieces))
-
-
-
-def recv_all(sock, size):
-    result = b''
-    while len(result) < size:
-        data = sock.recv(size - len(result))
-        if not data:
-            raise EOFError("Error: Received only {} bytes into {} byte message".format(len(data), size))
-        result += data
-    return result
-
-
-def recv_audio_frame(sock):
-    """
-    To read each stream frame from the server
-    """
-    (load_size,) = struct.unpack("<i", recv_all(sock, struct.calcsize("<i")))
-    #print(load_size)
-    return recv_all(sock, load_size)
-    
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Print, write or chunk the Audio stream")
+    parser.add_argument("--write", nargs='*', metavar="PATH [ROTATE_SECONDS]", default=None,
+                        help="write to PATH (out.wav), optionally starting a new file every ROTATE_SECONDS")
+    # Fixed size chunks (e.g. --chunks 20 or --chunks 30, in ms), silence dropped, as the ASR models take them
+    parser.add_argument("--chunks", type=int, default=None, metavar="MS", help="chunk duration, in ms")
+    args = parser.parse_args()
+    if args.write is not None and len(args.write) > 2:
+        parser.error("--write takes at most a path and a rotation in seconds")
+
     s = connect()
     if s is None:
         sys.exit(0)
-        
-    sign = lambda x: 1 if x >= 0.0 else -1
-    
-    do_write = True if len(sys.argv) > 1 and sys.argv[1] == '--write' else False
+
+    do_write = args.write is not None
 
     if do_write:
-        out_file = sys.argv[2] if len(sys.argv) > 2 else 'out.wav' 
-        outwav = wave.open(out_file, 'wb')
-        outwav.setparams((1, 2, 16000, 0, "NONE", "NONE"))
-    
+        out_file = args.write[0] if len(args.write) > 0 else 'out.wav'
+        # Optionally start a new file every so many seconds
+        rotate_seconds = float(args.write[1]) if len(args.write) > 1 else None
+        outwav = WavWriter(out_file, rotate_seconds=rotate_seconds)
+
+    chunker, gate = None, None
+    if args.chunks is not None:
+        chunker = AudioChunker(args.chunks)
+        gate = EnergyGate()
+
     while True:
         try:
-            f = recv_audio_frame(s)
+            f = recv_frame(s)
             timestamp, frame_type, sample_count, samples = decode_frame(f)
-            # PCM-16
-            samples = [ int(sm * 32767) if -1.0 <= sm <= 1.0 else (sign(sm) * 32767 ) for sm in samples ]
             if do_write:
-                outwav.writeframes(struct.pack('<' + str(len(samples)) + 'h', *samples))
-            print(timestamp, frame_type, sample_count, random.sample(samples, 5), max(samples))
+                # Converted to PCM-16 here and written out by the writer thread
+                outwav.write(samples)
+            if chunker is not None:
+                chunker.add(timestamp, samples)
+                chunk_timestamps, chunks = gate(*chunker.take())
+                print("{} chunks of speech from {}, {} passed and {} dropped so far".format(
+                    len(chunks), chunk_timestamps[:1], gate.passed, gate.dropped))
+                continue
+            pcm = to_pcm16(samples)
+            print(timestamp, frame_type, sample_count, np.random.choice(pcm, 5) if len(pcm) else [], pcm.max(initial=0))
         except:
-            
-            
             break
         print("\n\n")
-       
+
     s.close()
     if do_write:
         outwav.close()
+        print("Dropped {} frames while writing {}".format(outwav.dropped, ", ".join(outwav.files)))
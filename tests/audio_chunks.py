@@ -0,0 +1,201 @@
+"""
+Fixed size chunks of the Audio stream, and an energy gate dropping silence
+
+Audio frames hold 256 samples per sub-frame and a varying number of sub-frames
+(AudioFrame.SerializeMiddle), while ASR and keyword models want fixed 20 or
+30ms chunks. AudioChunker writes the samples of each frame into a NumPy ring
+and hands out whole chunks as one (n, chunk size) array, each with the Kinect
+timestamp of its first sample.
+
+Audio frames carry the timestamp of the last multi source frame, not their own,
+so timestamps follow the sample count instead: the first frame anchors the
+clock (its last sample is taken to be at its timestamp) and every sample after
+it is 1/16000 s later. A frame stamped more than max_lag after the end of the
+samples received so far means audio was lost: up to max_gap of it is filled
+with zeros so that the chunks stay on the same clock, anything longer restarts
+the clock.
+
+EnergyGate keeps the chunks whose short-term energy is above a threshold, along
+with a few chunks before (preroll) and after (hangover) them, and drops the
+rest before it reaches the models. Sub-frames KSIM didn't copy (beam angle
+confidence below 0.8) arrive as zeros and are dropped as silence.
+"""
+
+import numpy as np
+
+from codec import TICKS_PER_SECOND
+from pcm import SAMPLE_RATE
+
+
+class AudioChunker(object):
+    """
+    chunk_ms: chunk duration; capacity_seconds: audio kept before the oldest chunks are dropped
+    """
+
+    def __init__(self, chunk_ms=20, sample_rate=SAMPLE_RATE, capacity_seconds=2.0, max_lag=0.25, max_gap=1.0):
+        self.chunk_size = int(round(sample_rate * chunk_ms / 1000.0))
+        if self.chunk_size < 1:
+            raise ValueError("chunk_ms must be at least one sample long")
+        self.sample_rate = sample_rate
+        self.chunk_count = max(int(capacity_seconds * sample_rate) // self.chunk_size, 2)
+        self.capacity = self.chunk_count * self.chunk_size
+        self.max_lag = int(max_lag * TICKS_PER_SECOND)
+        self.max_gap = int(max_gap * TICKS_PER_SECOND)
+
+        self._samples = np.zeros(self.capacity, dtype=np.float32)
+        # Kinect timestamp of the first sample of each chunk
+        self._timestamps = np.zeros(self.chunk_count, dtype=np.int64)
+
+        # Samples written and read since the start, the ring positions are these modulo capacity
+        self.written = 0
+        self.read = 0
+        # (sample index, Kinect timestamp) the timestamps are counted from
+        self._anchor = None
+
+        self.filled = 0
+        self.restarts = 0
+        self.overflows = 0
+
+    def _timestamp(self, sample):
+        return self._anchor[1] + (sample - self._anchor[0]) * TICKS_PER_SECOND // self.sample_rate
+
+    def _write(self, samples):
+        n = len(samples)
+        if n > self.capacity:
+            # Only the end fits, skip the rest on the same clock
+            skipped = n - self.capacity
+            self.read = max(self.read, self.written + skipped)
+            self.written += skipped
+            samples = samples[skipped:]
+            n = self.capacity
+
+        # Timestamps of the chunks starting in this write
+        first = -(-self.written // self.chunk_size) * self.chunk_size
+        starts = np.arange(first, self.written + n, self.chunk_size, dtype=np.int64)
+        if len(starts):
+            self._timestamps[(starts // self.chunk_size) % self.chunk_count] = \
+                self._anchor[1] + (starts - self._anchor[0]) * TICKS_PER_SECOND // self.sample_rate
+
+        position = self.written % self.capacity
+        head = min(n, self.capacity - position)
+        self._samples[position:position + head] = samples[:head]
+        self._samples[:n - head] = samples[head:]
+        self.written += n
+
+        # Drop the oldest whole chunks the consumer didn't take in time
+        if self.written - self.read > self.capacity:
+            overflow = -(-(self.written - self.read - self.capacity) // self.chunk_size) * self.chunk_size
+            self.read += overflow
+            self.overflows += overflow // self.chunk_size
+
+    def add(self, timestamp, samples):
+        """
+        timestamp, samples: Kinect timestamp and samples of an Audio frame, as decoded by codec.decode_audio
+        Return: number of whole chunks ready
+        """
+        samples = np.asarray(samples, dtype=np.float32)
+        if self._anchor is not None:
+            # How far the stamp is past where the last sample of this frame falls on the sample clock
+            lag = timestamp - self._timestamp(self.written + len(samples))
+            if lag > self.max_gap:
+                # Lost too much to fill in: finish the partial chunk and start a new clock
+                self._write(np.zeros(-self.written % self.chunk_size, dtype=np.float32))
+                self._anchor = None
+                self.restarts += 1
+            elif lag > self.max_lag:
+                gap = lag * self.sample_rate // TICKS_PER_SECOND
+                self._write(np.zeros(gap, dtype=np.float32))
+                self.filled += gap
+        if self._anchor is None:
+            self._anchor = (self.written, timestamp - len(samples) * TICKS_PER_SECOND // self.sample_rate)
+        self._write(samples)
+        return self.ready
+
+    @property
+    def ready(self):
+        return (self.written - self.read) // self.chunk_size
+
+    def take(self, max_chunks=None):
+        """
+        Return: (timestamps, chunks), an (n,) int64 array and a new (n, chunk_size) float32 array, oldest first
+        """
+        n = self.ready if max_chunks is None else min(self.ready, max_chunks)
+        first = (self.read // self.chunk_size) % self.chunk_count
+        chunk_indices = (first + np.arange(n)) % self.chunk_count
+        timestamps = self._timestamps[chunk_indices]
+
+        start = self.read % self.capacity
+        size = n * self.chunk_size
+        head = min(size, self.capacity - start)
+        chunks = np.empty(size, dtype=np.float32)
+        chunks[:head] = self._samples[start:start + head]
+        chunks[head:] = self._samples[:size - head]
+        self.read += size
+        return timestamps, chunks.reshape(n, self.chunk_size)
+
+
+def energy_db(chunks):
+    """
+    Return: (n,) short-term energy of each chunk in dBFS, -inf for digital silence
+    """
+    power = np.einsum('ij,ij->i', chunks, chunks, dtype=np.float64) / chunks.shape[1]
+    with np.errstate(divide='ignore'):
+        return 10.0 * np.log10(power)
+
+
+class EnergyGate(object):
+    """
+    Keeps the chunks with an energy above threshold_db, preroll chunks before them and hangover chunks after them
+
+    The preroll chunks at the end of one batch are held back until the next one
+    tells whether speech starts there, so the chunks of a batch may be returned
+    along with the next batch.
+    """
+
+    def __init__(self, threshold_db=-40.0, hangover=10, preroll=3):
+        self.threshold_db = threshold_db
+        self.hangover = hangover
+        self.preroll = preroll
+
+        self.voiced = 0
+        self.passed = 0
+        self.dropped = 0
+
+        # Chunks counted since the start; index of the last chunk above the threshold
+        self._count = 0
+        self._last_voiced = -(hangover + 1)
+        self._held = (np.zeros(0, dtype=np.int64), None)
+
+    def __call__(self, timestamps, chunks):
+        """
+        Return: (timestamps, chunks) of the chunks kept, as AudioChunker.take returns them
+        """
+        held_timestamps, held_chunks = self._held
+        if len(held_timestamps):
+            timestamps = np.concatenate((held_timestamps, timestamps))
+            chunks = np.concatenate((held_chunks, chunks))
+        n, held = len(timestamps), len(held_timestamps)
+
+        voiced = energy_db(chunks) > self.threshold_db
+        voiced[:held] = False
+        indices = self._count - held + np.arange(n)
+
+        # Index of the last voiced chunk at or before each chunk, and of the next one at or after it
+        last = np.maximum.accumulate(np.where(voiced, indices, self._last_voiced))
+        following = np.minimum.accumulate(np.where(voiced, indices, np.iinfo(np.int64).max)[::-1])[::-1]
+        keep = (indices - last <= self.hangover) | (following - indices <= self.preroll)
+
+        # Hold back the trailing silence that the next batch may need as preroll
+        unkept = np.flatnonzero(keep[::-1])
+        trailing = n if len(unkept) == 0 else int(unkept[0])
+        trailing = min(trailing, self.preroll)
+        self._held = (timestamps[n - trailing:], chunks[n - trailing:])
+
+        if n:
+            self._last_voiced = int(last[-1])
+        self._count += n - held
+        kept = int(keep.sum())
+        self.voiced += int(voiced.sum())
+        self.passed += kept
+        self.dropped += n - kept - trailing
+        return timestamps[keep], chunks[keep]
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+"""
+Sharded, parallel processing of captures (capture.py)
+
+run() splits a capture into shards of shard_seconds of Kinect time, processes
+them in a process pool and merges the per-shard results in timestamp order.
+Each worker reads only the byte range of its shard from the capture file,
+through a FrameParser as if it came from the socket, and hands the raw frames
+to the processor; nothing but the shard description and its result crosses
+process boundaries.
+
+A processor is a module level function (it is pickled to the workers) taking
+an iterator of raw frames, as decode.recv_frame returns them, and returning the
+result for the shard; each frame is only valid until the next one is taken,
+like the frames of a FrameReader. Shards start with no state from the previous
+one, so processors that keep state across frames (tracking, smoothing) see a
+fresh start at each shard boundary.
+
+Results are written to output_dir as soon as a shard is done, along with the
+plan of the run. Running again with the same output_dir only processes the
+shards that have no result yet, so a crashed or interrupted run resumes where
+it stopped.
+
+    python batch.py session.ksim out_dir faces --workers 8
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import pickle
+import sys
+
+import numpy as np
+
+import codec
+from body import decode_bodies
+from capture import CaptureReader
+from codec import FrameType, HEADER, TICKS_PER_SECOND
+from decode import FrameParser
+
+# number: position in time; [start, stop): frames in the capture index; [begin, end): bytes in the capture
+Shard = collections.namedtuple('Shard', ['number', 'start', 'stop', 'begin', 'end', 'first_timestamp', 'last_timestamp'])
+
+PLAN = "plan.json"
+
+
+def plan(path, shard_seconds=60.0):
+    """
+    Return: list of Shard covering the frames of the capture at path, in timestamp order
+    Frames with the same timestamp (one tick) always end up in the same shard
+    """
+    # The reader drops the entries of frames a crash left incomplete at the end of the capture
+    with CaptureReader(path) as capture:
+        index, ends = capture.index.copy(), capture.ends.copy()
+    if len(index) == 0:
+        return []
+    timestamps = index['timestamp']
+    if np.any(np.diff(timestamps) < 0):
+        raise ValueError("Timestamps of {} are not in order, it can't be split by time".format(path))
+
+    buckets = (timestamps - timestamps[0]) // int(shard_seconds * TICKS_PER_SECOND)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+    stops = np.append(starts[1:], len(index))
+    return [Shard(number, int(start), int(stop), int(index['offset'][start]), int(ends[stop - 1]),
+                  int(timestamps[start]), int(timestamps[stop - 1]))
+            for number, (start, stop) in enumerate(zip(starts, stops))]
+
+
+def read_shard(path, shard, frame_types=None, chunk_size=1 << 20):
+    """
+    Yield the raw frames of shard, optionally only those of frame_types (a bitset)
+    Each frame is a memoryview, valid until the next one is taken
+    """
+    parser = FrameParser(chunk_size)
+    remaining = shard.end - shard.begin
+    with open(path, 'rb') as f:
+        f.seek(shard.begin)
+        while remaining > 0:
+            free = parser.buffer()
+            received = f.readinto(free[:min(len(free), remaining)])
+            if not received:
+                raise EOFError("{} ends {} bytes before the end of shard {}".format(path, remaining, shard.number))
+            parser.advance(received)
+            remaining -= received
+            for frame in parser.frames():
+                if frame_types is None or HEADER.unpack_from(frame)[1] & frame_types:
+                    yield frame
+    if parser.pending:
+        raise ValueError("Shard {} ends in the middle of a frame".format(shard.number))
+
+
+def shard_path(output_dir, shard):
+    return os.path.join(output_dir, "shard-{:05d}.pkl".format(shard.number))
+
+
+def process_shard(path, shard, processor, frame_types, output_dir):
+    """
+    Runs in a worker process: process shard and write its result to output_dir
+    Return: shard.number
+    """
+    result = processor(read_shard(path, shard, frame_types))
+    target = shard_path(output_dir, shard)
+    # Written under another name first, so that a crash never leaves a partial result behind
+    temporary = target + ".tmp"
+    with open(temporary, 'wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, target)
+    return shard.number
+
+
+def concatenate(results):
+    """
+    Default merge: concatenates arrays, tuples of arrays (element by element) and lists
+    """
+    results = list(results)
+    if not results:
+        return []
+    if isinstance(results[0], np.ndarray):
+        return np.concatenate(results)
+    if isinstance(results[0], tuple):
+        return tuple(concatenate(parts) for parts in zip(*results))
+    return [item for result in results for item in result]
+
+
+def _check_plan(output_dir, description):
+    plan_path = os.path.join(output_dir, PLAN)
+    if os.path.exists(plan_path):
+        with open(plan_path) as f:
+            previous = json.load(f)
+        if previous != description:
+            raise ValueError("{} holds the results of another run ({}), use another directory".format(
+                output_dir, previous))
+        return
+    temporary = plan_path + ".tmp"
+    with open(temporary, 'w') as f:
+        json.dump(description, f)
+    os.replace(temporary, plan_path)
+
+
+def run(path, processor, output_dir, shard_seconds=60.0, frame_types=None, workers=None, merge=concatenate,
+        mp_context=None, progress=None):
+    """
+    Process the capture at path with processor, shard by shard, resuming from the results in output_dir
+    progress: called with (shards done, shard count) as shards complete
+    Return: merge(results of the shards, in timestamp order)
+    """
+    shards = plan(path, shard_seconds)
+    os.makedirs(output_dir, exist_ok=True)
+    _check_plan(output_dir, {
+        'capture': os.path.abspath(path),
+        'capture_size': os.path.getsize(path),
+        'shard_seconds': shard_seconds,
+        'frame_types': frame_types,
+        'processor': "{}.{}".format(processor.__module__, processor.__qualname__),
+        'shards': [list(shard) for shard in shards],
+    })
+
+    pending = [shard for shard in shards if not os.path.exists(shard_path(output_dir, shard))]
+    done = len(shards) - len(pending)
+    if pending:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as pool:
+            futures = [pool.submit(process_shard, path, shard, processor, frame_types, output_dir) for shard in pending]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+                done += 1
+                if progress is not None:
+                    progress(done, len(shards))
+    return merge(load(output_dir, shards))
+
+
+def load(output_dir, shards):
+    """
+    Yield the results of shards, in timestamp order
+    """
+    for shard in shards:
+        with open(shard_path(output_dir, shard), 'rb') as f:
+            yield pickle.load(f)
+
+
+FACE_DTYPE = np.dtype([
+    ('timestamp', '<i8'),
+    ('face_found', 'u1'),
+    ('engaged', 'u1'),
+    ('looking_away', 'u1'),
+    ('wearing_glasses', 'u1'),
+    ('pitch', '<f8'),
+    ('yaw', '<f8'),
+    ('roll', '<f8'),
+])
+
+HAND_DTYPE = np.dtype([
+    ('timestamp', '<i8'),
+    ('frame_type', '<i4'),
+    ('width', '<i4'),
+    ('height', '<i4'),
+    ('posx', '<f4'),
+    ('posy', '<f4'),
+    # Median of the valid pixels of the crop, 0 if there are none
+    ('depth', '<f4'),
+])
+
+
+def faces(frames):
+    """
+    Processor: ClosestFace frames as an (N,) FACE_DTYPE array
+    """
+    rows = []
+    for frame in frames:
+        timestamp, frame_type = HEADER.unpack_from(frame)
+        if frame_type == FrameType.ClosestFace:
+            rows.append((timestamp,) + codec.FACE.unpack_from(frame, HEADER.size))
+    return np.array(rows, dtype=FACE_DTYPE)
+
+
+def hands(frames):
+    """
+    Processor: LHDepth, RHDepth and HeadDepth frames as an (N,) HAND_DTYPE array
+    """
+    rows = []
+    for frame in frames:
+        (timestamp, frame_type), offset = codec.decode_header(frame)
+        if frame_type not in (FrameType.LHDepth, FrameType.RHDepth, FrameType.HeadDepth):
+            continue
+        (width, height, posx, posy, depth_data), _ = codec.decode_segmented_depth(frame, offset)
+        valid = depth_data[depth_data > 0]
+        rows.append((timestamp, frame_type, width, height, posx, posy, np.median(valid) if len(valid) else 0.0))
+    return np.array(rows, dtype=HAND_DTYPE)
+
+
+def bodies(frames):
+    """
+    Processor: ClosestBody frames as (headers, joints), see body.decode_bodies
+    """
+    return decode_bodies(frames)
+
+
+PROCESSORS = collections.OrderedDict([
+    ('faces', (faces, FrameType.ClosestFace)),
+    ('hands', (hands, FrameType.LHDepth | FrameType.RHDepth | FrameType.HeadDepth)),
+    ('bodies', (bodies, FrameType.ClosestBody)),
+])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("capture", help="capture file, with its .idx next to it")
+    parser.add_argument("output_dir", help="where the shard results go; run again to resume")
+    parser.add_argument("processor", choices=list(PROCESSORS))
+    parser.add_argument("--workers", type=int, default=None, help="processes, the number of cores by default")
+    parser.add_argument("--shard-seconds", type=float, default=60.0)
+    args = parser.parse_args()
+
+    processor, frame_types = PROCESSORS[args.processor]
+    result = run(args.capture, processor, args.output_dir, args.shard_seconds, int(frame_types), args.workers,
+                 progress=lambda done, total: print("{}/{} shards".format(done, total)))
+    rows = result[0] if isinstance(result, tuple) else result
+    print("{} rows from {}".format(len(rows), args.capture))
+    if len(rows):
+        print(rows[:5])
+    sys.exit(0)
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+"""
+End-to-end benchmark of the stream clients
+
+For every client in tests/, subscribes to the same frame types it does and
+measures, per frame type, decode time, frames/s, bytes/s and the p50/p99
+inter-arrival time. Decode time covers what the client does with each frame,
+e.g. the JPEG decode of color_client, the PCM-16 conversion of audio or the
+bundle assembly of combined_hands_client, not only codec.decode. Streams come
+from an in-process stand-in (fake_server.py) by default, or from a recorded
+capture (replay_server.py), whose frames are also decoded offline. Results are
+written as JSON and compared to a stored baseline; any metric worse than the
+baseline by more than the tolerance fails the run.
+
+    python benchmark.py --output results.json
+    python benchmark.py --capture session.ksim --baseline baseline.json
+"""
+
+import argparse
+import json
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+
+import codec
+import color_pipeline
+from body_history import BodyHistory
+from bundle import BundleAssembler
+from codec import FrameType, HEADER
+from decode import FrameReader
+from pcm import to_pcm16
+from protocol import pack_recognizer_registration
+from segment import segment_body
+
+# Subscriptions of the clients in tests/
+CLIENTS = {
+    'color_client': FrameType.Color,
+    'speech_client': FrameType.Speech,
+    'audio': FrameType.Audio,
+    'depth_client': FrameType.Depth,
+    'closest_body': FrameType.ClosestBody,
+    'lh_depth_client': FrameType.LHDepth,
+    'rh_depth_client': FrameType.RHDepth,
+    'head_depth_client': FrameType.HeadDepth,
+    'combined_hands_client': FrameType.LHDepth | FrameType.RHDepth,
+    'closest_face_client': FrameType.ClosestFace,
+    'segment_client': FrameType.Depth | FrameType.ClosestBody | FrameType.LHDepth | FrameType.RHDepth | FrameType.HeadDepth,
+    # Its default subscription, each connection is benchmarked on its own
+    'async_client': FrameType.ClosestBody,
+}
+
+
+def decode_only():
+    """
+    Clients that only decode, into views over the frame
+    """
+    return codec.decode
+
+
+def decode_color():
+    # fake_server.py sends JPEGs without cv2, but decoding them needs cv2 or imageio
+    if color_pipeline.cv2 is None and color_pipeline.imageio is None:
+        raise ImportError("Decoding JPEG needs cv2 or imageio")
+
+    # What ColorPipeline runs in its pool for each frame
+    def process(raw_frame):
+        header, (stride, width, height, jpeg), tail = codec.decode(raw_frame)
+        return header, color_pipeline.decode_jpeg(jpeg), tail
+    return process
+
+
+def decode_audio():
+    def process(raw_frame):
+        header, (sample_count, samples), tail = codec.decode(raw_frame)
+        return header, to_pcm16(samples), tail
+    return process
+
+
+def decode_closest_body():
+    history = BodyHistory(capacity=300, window=30)
+
+    def process(raw_frame):
+        (timestamp, frame_type), closest_body, tail = codec.decode(raw_frame)
+        history.append_closest_body(timestamp, closest_body)
+        if len(history) > 1:
+            history.velocity()
+            history.angles()
+        return (timestamp, frame_type), closest_body, tail
+    return process
+
+
+def decode_hands():
+    assembler = BundleAssembler(FrameType.LHDepth | FrameType.RHDepth)
+
+    def process(raw_frame):
+        # Bundles hold on to their contents, so read_bundles decodes with copy=True
+        (timestamp, frame_type), content, (writer_data,) = codec.decode(raw_frame, copy=True)
+        return assembler.add(timestamp, frame_type, content, writer_data)
+    return process
+
+
+def decode_segments():
+    assembler = BundleAssembler(CLIENTS['segment_client'])
+
+    def process(raw_frame):
+        (timestamp, frame_type), content, (writer_data,) = codec.decode(raw_frame, copy=True)
+        for bundle in assembler.add(timestamp, frame_type, content, writer_data):
+            if bundle.complete:
+                (width, height, depth_data), _ = bundle.frames[FrameType.Depth]
+                closest_body, _ = bundle.frames[FrameType.ClosestBody]
+                segment_body(depth_data, closest_body)
+    return process
+
+
+def decode_async():
+    # _FrameProtocol hands out each frame as its own bytes object
+    def process(raw_frame):
+        return codec.decode(bytes(raw_frame))
+    return process
+
+
+# Per client, a factory of the function taking a raw frame through what the client does with it
+DECODERS = {
+    'color_client': decode_color,
+    'speech_client': decode_only,
+    'audio': decode_audio,
+    'depth_client': decode_only,
+    'closest_body': decode_closest_body,
+    'lh_depth_client': decode_only,
+    'rh_depth_client': decode_only,
+    'head_depth_client': decode_only,
+    'combined_hands_client': decode_hands,
+    'closest_face_client': decode_only,
+    'segment_client': decode_segments,
+    'async_client': decode_async,
+}
+
+
+def unavailable(client):
+    """
+    Return: why client can't be benchmarked here (e.g. a missing decoder), None if it can
+    """
+    try:
+        DECODERS[client]()
+    except ImportError as ex:
+        return str(ex)
+    return None
+
+# Metrics where a higher value is better; for the others lower is better
+HIGHER_IS_BETTER = ('fps', 'bytes_per_s')
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if len(values) > 0 else None
+
+
+def summarize(elapsed, arrivals, decode_times, sizes):
+    """
+    Return: metrics for one frame type from per frame arrival times (s), decode times (s) and sizes (bytes)
+    """
+    gaps = np.diff(arrivals) * 1000.0 if len(arrivals) > 1 else np.array([])
+    decode_us = np.asarray(decode_times) * 1e6
+    return {
+        'frames': len(arrivals),
+        'fps': len(arrivals) / elapsed if elapsed > 0 else 0.0,
+        'bytes_per_s': sum(sizes) / elapsed if elapsed > 0 else 0.0,
+        'decode_us_mean': float(decode_us.mean()) if len(decode_us) else None,
+        'decode_us_p50': percentile(decode_us, 50),
+        'decode_us_p99': percentile(decode_us, 99),
+        'interarrival_ms_p50': percentile(gaps, 50),
+        'interarrival_ms_p99': percentile(gaps, 99),
+    }
+
+
+def bench_stream(host, port, frame_types, duration, process=codec.decode, connect_timeout=5.0):
+    """
+    Subscribe to frame_types and receive for duration seconds, passing each frame to process
+    Return: dict of frame type name to metrics
+    """
+    sock = socket.create_connection((host, port), timeout=connect_timeout)
+    sock.settimeout(max(duration, 1.0))
+    sock.sendall(pack_recognizer_registration(frame_types))
+    reader = FrameReader(sock)
+
+    per_type = {}
+    began = time.perf_counter()
+    end = began + duration
+    try:
+        while time.perf_counter() < end:
+            try:
+                reader.fill()
+            except socket.timeout:
+                break
+            arrived = time.perf_counter()
+            for frame in reader.parser.frames():
+                frame_type = HEADER.unpack_from(frame)[1]
+                t0 = time.perf_counter()
+                process(frame)
+                t1 = time.perf_counter()
+                arrivals, decode_times, sizes = per_type.setdefault(frame_type, ([], [], []))
+                arrivals.append(arrived)
+                decode_times.append(t1 - t0)
+                sizes.append(len(frame) + codec.LENGTH.size)
+    except EOFError:
+        pass
+    finally:
+        sock.close()
+
+    elapsed = time.perf_counter() - began
+    return {FrameType(ft).name: summarize(elapsed, *samples) for ft, samples in per_type.items()}
+
+
+def bench_decode(frames, decoder, repeat=3):
+    """
+    Decode-only time over already received frames (e.g. from a capture)
+    frames: callable returning an iterable over the frames; decoder: factory from DECODERS
+    Each pass starts with a new decoder, as clients keeping state (bundles, history) need the frames in order
+    Return: dict of frame type name to {'decode_us_p50', 'decode_us_p99', 'frames'}
+    """
+    best = []
+    frame_types = []
+    for i in range(repeat):
+        process = decoder()
+        for j, frame in enumerate(frames()):
+            t0 = time.perf_counter()
+            process(frame)
+            t = time.perf_counter() - t0
+            if i == 0:
+                best.append(t)
+                frame_types.append(HEADER.unpack_from(frame)[1])
+            else:
+                best[j] = min(best[j], t)
+
+    per_type = {}
+    for frame_type, t in zip(frame_types, best):
+        per_type.setdefault(frame_type, []).append(t * 1e6)
+    return {FrameType(ft).name: {'frames': len(times),
+                                 'decode_us_p50': percentile(times, 50),
+                                 'decode_us_p99': percentile(times, 99)}
+            for ft, times in per_type.items()}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return: list of regressions as human readable strings
+    """
+    regressions = []
+    # Streamed (clients) and, with a capture, offline (decode), both per client and frame type
+    for section in ('clients', 'decode'):
+        for client, types in baseline.get(section, {}).items():
+            if client not in results.get(section, {}):
+                # Not benchmarked in this run
+                continue
+            for frame_type, metrics in types.items():
+                current = results[section][client].get(frame_type)
+                if current is None:
+                    regressions.append("{} {} {}: missing from results".format(section, client, frame_type))
+                    continue
+                for name, expected in metrics.items():
+                    actual = current.get(name)
+                    if name == 'frames' or expected is None or actual is None:
+                        continue
+                    if name in HIGHER_IS_BETTER:
+                        worse = actual < expected * (1.0 - tolerance)
+                    else:
+                        worse = actual > expected * (1.0 + tolerance)
+                    if worse:
+                        regressions.append("{} {} {} {}: {:.3f} vs baseline {:.3f}".format(
+                            section, client, frame_type, name, actual, expected))
+    return regressions
+
+
+def run(args):
+    clients = args.clients.split(',') if args.clients else list(CLIENTS)
+    unknown = [client for client in clients if client not in CLIENTS]
+    if unknown:
+        raise ValueError("Unknown clients: {}".format(", ".join(unknown)))
+
+    results = {'source': args.capture or 'fake_server', 'duration': args.duration, 'clients': {}, 'unavailable': {}}
+    for client in list(clients):
+        reason = unavailable(client)
+        if reason is not None:
+            results['unavailable'][client] = reason
+            clients.remove(client)
+
+    if args.capture:
+        from capture import CaptureReader
+        from ksim_server import KsimServer
+        from replay_server import Replay
+
+        capture = CaptureReader(args.capture)
+        results['decode'] = {}
+        for client in clients:
+            frame_types = int(CLIENTS[client])
+            results['decode'][client] = bench_decode(
+                lambda: (frame for _, frame in capture.frames(frame_types=frame_types)), DECODERS[client])
+        for client in clients:
+            server = KsimServer('127.0.0.1', 0)
+            server.start()
+            replay = Replay(capture, server, args.speed)
+            # The replay starts once the client below is subscribed
+            def serve():
+                while server.client_count() < 1:
+                    time.sleep(0.001)
+                replay.run()
+            thread = threading.Thread(target=serve, daemon=True)
+            thread.start()
+            results['clients'][client] = bench_stream('127.0.0.1', server.port, CLIENTS[client], args.duration,
+                                                      DECODERS[client]())
+            replay.stop()
+            server.stop()
+        capture.close()
+    else:
+        import fake_server
+
+        fake = fake_server.FakeKsim(fake_server.parse_args(['--host', '127.0.0.1', '--port', '0', '--fps', str(args.fps)]))
+        fake.run()
+        for client in clients:
+            results['clients'][client] = bench_stream('127.0.0.1', fake.server.port, CLIENTS[client], args.duration,
+                                                      DECODERS[client]())
+        fake.stop()
+
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--capture", default=None, help="replay this capture instead of synthetic frames")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 0 for as fast as possible")
+    parser.add_argument("--fps", type=float, default=30.0, help="rate of the synthetic frames")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per client")
+    parser.add_argument("--clients", default=None, help="comma separated subset of: " + ", ".join(CLIENTS))
+    parser.add_argument("--output", default=None, help="write results to this JSON file")
+    parser.add_argument("--baseline", default=None, help="compare against this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = run(args)
+
+    for client, types in results['clients'].items():
+        for frame_type, metrics in types.items():
+            print("{:<22s} {:<12s} {:>8.1f} fps {:>12.0f} B/s decode p50 {:>9.1f} us  gap p50/p99 {} / {} ms".format(
+                client, frame_type, metrics['fps'], metrics['bytes_per_s'], metrics['decode_us_p50'] or 0.0,
+                *["{:.1f}".format(v) if v is not None else "-" for v in (metrics['interarrival_ms_p50'], metrics['interarrival_ms_p99'])]))
+
+    for client, reason in results['unavailable'].items():
+        print("{:<22s} not benchmarked: {}".format(client, reason))
+
+    for client, types in results.get('decode', {}).items():
+        for frame_type, metrics in types.items():
+            print("{:<22s} {:<12s} {:>8d} frames decoded offline, p50 {:>9.1f} us p99 {:>9.1f} us".format(
+                client, frame_type, metrics['frames'], metrics['decode_us_p50'], metrics['decode_us_p99']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("=" * 30)
+            print("REGRESSIONS against {}:".format(args.baseline))
+            for regression in regressions:
+                print("  " + regression)
+            print("=" * 30)
+            sys.exit(1)
+        print("No regressions against {}".format(args.baseline))
@@ -0,0 +1,100 @@
+"""
+Batch decoding of ClosestBody frames into NumPy structured arrays
+
+The wire layout of ClosestBodyFrame.SerializeMiddle maps directly onto the dtypes
+below, so N frames are decoded by gathering their body blocks into one buffer and
+viewing it with np.frombuffer, instead of unpacking ~230 values per frame.
+"""
+
+import numpy as np
+
+from codec import HEADER, BODY_HEADER, BODY, JOINT_COUNT, FrameType
+from decode import recv_frame
+
+
+# [ JointType | TrackingState | Position.X | Position.Y | Position.Z | Orientation.W | Orientation.X | Orientation.Y | Orientation.Z ]
+JOINT_DTYPE = np.dtype([
+    ('joint_type', 'u1'),
+    ('tracking_state', 'u1'),
+    ('position', '<f4', (3,)),
+    ('orientation', '<f4', (4,)),
+])
+
+# TrackingId | HandLeftConfidence | HandLeftState | HandRightConfidence | HandRightState | 25 joints
+BODY_DTYPE = np.dtype([
+    ('tracking_id', '<u8'),
+    ('hand_left_confidence', 'u1'),
+    ('hand_left_state', 'u1'),
+    ('hand_right_confidence', 'u1'),
+    ('hand_right_state', 'u1'),
+    ('joints', JOINT_DTYPE, (JOINT_COUNT,)),
+])
+
+# Timestamp | frame type | Tracked body count | Engaged, i.e. the first bytes of every frame
+_FRAME_DTYPE = np.dtype([
+    ('timestamp', '<i8'),
+    ('frame_type', '<i4'),
+    ('tracked_body_count', 'u1'),
+    ('engaged', '?'),
+])
+
+# Per frame header returned by decode_bodies
+HEADER_DTYPE = np.dtype([
+    ('timestamp', '<i8'),
+    ('tracked_body_count', 'u1'),
+    ('engaged', '?'),
+    ('tracking_id', '<u8'),
+    ('hand_left_confidence', 'u1'),
+    ('hand_left_state', 'u1'),
+    ('hand_right_confidence', 'u1'),
+    ('hand_right_state', 'u1'),
+])
+
+assert BODY_DTYPE.itemsize == BODY.size
+assert _FRAME_DTYPE.itemsize == HEADER.size + BODY_HEADER.size
+
+# Written for frames where no body is engaged, which leaves every field 0
+_EMPTY_BODY = bytes(BODY.size)
+
+
+def decode_bodies(raw_frames):
+    """
+    Decode a sequence of raw ClosestBody frames (as returned by decode.recv_frame)
+    Frames of other types are skipped. Each frame is only read during the
+    iteration, so a generator over a live socket can be passed in directly.
+
+    Return: (headers, joints), headers being an (N,) HEADER_DTYPE array and joints
+    an (N, 25) JOINT_DTYPE array, all zeros for frames without an engaged body
+    """
+    frames = bytearray()
+    bodies = bytearray()
+
+    body_start = _FRAME_DTYPE.itemsize
+    body_end = body_start + BODY.size
+
+    for raw_frame in raw_frames:
+        _, frame_type = HEADER.unpack_from(raw_frame)
+        if frame_type != FrameType.ClosestBody:
+            continue
+
+        frames += raw_frame[:body_start]
+        _, engaged = BODY_HEADER.unpack_from(raw_frame, HEADER.size)
+        bodies += raw_frame[body_start:body_end] if engaged else _EMPTY_BODY
+
+    frames = np.frombuffer(frames, dtype=_FRAME_DTYPE)
+    bodies = np.frombuffer(bodies, dtype=BODY_DTYPE)
+
+    headers = np.empty(len(frames), dtype=HEADER_DTYPE)
+    for name in ('timestamp', 'tracked_body_count', 'engaged'):
+        headers[name] = frames[name]
+    for name in ('tracking_id', 'hand_left_confidence', 'hand_left_state', 'hand_right_confidence', 'hand_right_state'):
+        headers[name] = bodies[name]
+
+    return headers, bodies['joints']
+
+
+def read_bodies(sock, count):
+    """
+    Receive count frames from a ClosestBody subscription and decode them in one pass
+    """
+    return decode_bodies(recv_frame(sock) for _ in range(count))
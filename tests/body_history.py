@@ -0,0 +1,232 @@
+"""
+Fixed capacity history of the ClosestBody stream, with windowed features
+
+BodyHistory keeps the last capacity frames of the engaged body in preallocated
+NumPy rings, indexed by Kinect timestamp. Appending a frame is O(1) in the
+window length: the velocity, acceleration and joint angles of the new frame are
+computed from the previous one, and the mean and variance of the joint positions
+over the last window frames are updated by adding the new frame and removing
+the one leaving the window. The history starts over when the tracked body
+changes (TrackingId) or is lost, so features never mix two people.
+"""
+
+import collections
+
+import numpy as np
+
+from codec import JOINT_COUNT, TICKS_PER_SECOND
+
+# Microsoft.Kinect.JointType
+SPINE_BASE, SPINE_MID, NECK, HEAD = 0, 1, 2, 3
+SHOULDER_LEFT, ELBOW_LEFT, WRIST_LEFT, HAND_LEFT = 4, 5, 6, 7
+SHOULDER_RIGHT, ELBOW_RIGHT, WRIST_RIGHT, HAND_RIGHT = 8, 9, 10, 11
+HIP_LEFT, KNEE_LEFT, ANKLE_LEFT, FOOT_LEFT = 12, 13, 14, 15
+HIP_RIGHT, KNEE_RIGHT, ANKLE_RIGHT, FOOT_RIGHT = 16, 17, 18, 19
+SPINE_SHOULDER, HAND_TIP_LEFT, THUMB_LEFT, HAND_TIP_RIGHT, THUMB_RIGHT = 20, 21, 22, 23, 24
+
+# Angle at the middle joint between the segments to the two others, in radians
+ANGLES = collections.OrderedDict([
+    ('shoulder_left', (SPINE_SHOULDER, SHOULDER_LEFT, ELBOW_LEFT)),
+    ('elbow_left', (SHOULDER_LEFT, ELBOW_LEFT, WRIST_LEFT)),
+    ('wrist_left', (ELBOW_LEFT, WRIST_LEFT, HAND_LEFT)),
+    ('shoulder_right', (SPINE_SHOULDER, SHOULDER_RIGHT, ELBOW_RIGHT)),
+    ('elbow_right', (SHOULDER_RIGHT, ELBOW_RIGHT, WRIST_RIGHT)),
+    ('wrist_right', (ELBOW_RIGHT, WRIST_RIGHT, HAND_RIGHT)),
+    ('knee_left', (HIP_LEFT, KNEE_LEFT, ANKLE_LEFT)),
+    ('knee_right', (HIP_RIGHT, KNEE_RIGHT, ANKLE_RIGHT)),
+])
+
+# Offsets into the BODY values of a ClosestBody frame, see codec.BODY_FORMAT and codec.JOINT_FORMAT
+_JOINTS_OFFSET = 5
+_JOINT_VALUES = 9
+
+
+def joint_angles(positions, angles=ANGLES):
+    """
+    positions: (..., JOINT_COUNT, 3)
+    Return: (..., len(angles)) angles in radians, NaN where a segment has zero length
+    """
+    a, b, c = (np.array(joints) for joints in zip(*angles.values()))
+    u = positions[..., a, :] - positions[..., b, :]
+    v = positions[..., c, :] - positions[..., b, :]
+    norms = np.linalg.norm(u, axis=-1) * np.linalg.norm(v, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cosine = np.einsum('...i,...i->...', u, v) / norms
+    return np.arccos(np.clip(cosine, -1.0, 1.0))
+
+
+class BodyHistory(object):
+    """
+    capacity: number of frames kept; window: number of frames the mean and variance are over
+    """
+
+    def __init__(self, capacity=300, window=30, angles=ANGLES):
+        if not 1 <= window <= capacity:
+            raise ValueError("window must be between 1 and capacity ({}), got {}".format(capacity, window))
+        self.capacity = capacity
+        self.window = window
+        self.angle_names = list(angles)
+        self._angles = angles
+
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.positions = np.zeros((capacity, JOINT_COUNT, 3), dtype=np.float32)
+        self.orientations = np.zeros((capacity, JOINT_COUNT, 4), dtype=np.float32)
+        self.tracking_states = np.zeros((capacity, JOINT_COUNT), dtype=np.uint8)
+        # HandLeftConfidence | HandLeftState | HandRightConfidence | HandRightState
+        self.hand_states = np.zeros((capacity, 4), dtype=np.uint8)
+        self.velocities = np.zeros((capacity, JOINT_COUNT, 3), dtype=np.float32)
+        self.accelerations = np.zeros((capacity, JOINT_COUNT, 3), dtype=np.float32)
+        self.joint_angles = np.zeros((capacity, len(angles)), dtype=np.float32)
+
+        self.tracking_id = None
+        self.resets = 0
+        self.reset()
+
+    def reset(self):
+        self.tracking_id = None
+        self.count = 0
+        # Position of the next frame in the rings
+        self._next = 0
+        # Sliding window sums for the mean and variance (Welford), in double precision
+        self._mean = np.zeros((JOINT_COUNT, 3))
+        self._m2 = np.zeros((JOINT_COUNT, 3))
+
+    def __len__(self):
+        return self.count
+
+    def _slot(self, i):
+        """
+        Ring position of the i-th frame kept, 0 being the oldest and -1 the newest
+        """
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("Frame {} out of {}".format(i, self.count))
+        return (self._next - self.count + i) % self.capacity
+
+    def _order(self, n=None):
+        # Ring positions of the last n frames, oldest first
+        n = self.count if n is None else min(n, self.count)
+        return (self._next - n + np.arange(n)) % self.capacity
+
+    def append(self, timestamp, tracking_id, positions, orientations, tracking_states, hand_states):
+        """
+        Add the frame of the engaged body; frames must come in timestamp order
+        """
+        if tracking_id != self.tracking_id:
+            if self.tracking_id is not None:
+                self.resets += 1
+            self.reset()
+            self.tracking_id = tracking_id
+        elif self.count and timestamp <= self.timestamps[self._slot(-1)]:
+            raise ValueError("Timestamp {} is not after the last one".format(timestamp))
+
+        slot = self._next
+        positions = np.asarray(positions, dtype=np.float32)
+        # Read before the ring is written, slot may be where it is when window == capacity
+        leaving = self.positions[self._slot(-self.window)].astype(np.float64) if self.count >= self.window else None
+
+        self.timestamps[slot] = timestamp
+        self.positions[slot] = positions
+        self.orientations[slot] = orientations
+        self.tracking_states[slot] = tracking_states
+        self.hand_states[slot] = hand_states
+        self.joint_angles[slot] = joint_angles(positions, self._angles)
+
+        if self.count:
+            previous = self._slot(-1)
+            dt = (timestamp - self.timestamps[previous]) / float(TICKS_PER_SECOND)
+            self.velocities[slot] = (positions - self.positions[previous]) / dt
+            if self.count > 1:
+                self.accelerations[slot] = (self.velocities[slot] - self.velocities[previous]) / dt
+            else:
+                self.accelerations[slot] = 0.0
+        else:
+            self.velocities[slot] = 0.0
+            self.accelerations[slot] = 0.0
+
+        # Sliding window mean and variance: add the new frame, drop the one leaving the window
+        x = positions.astype(np.float64)
+        if leaving is None:
+            n = self.count + 1
+            delta = x - self._mean
+            self._mean += delta / n
+            self._m2 += delta * (x - self._mean)
+        else:
+            y = leaving
+            mean = self._mean + (x - y) / self.window
+            self._m2 += (x - y) * (x - mean + y - self._mean)
+            self._mean = mean
+
+        self._next = (slot + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def append_closest_body(self, timestamp, closest_body):
+        """
+        closest_body: content of a ClosestBody frame, (tracked_body_count, engaged, frame_pieces)
+        Frames without an engaged body reset the history
+        """
+        tracked_body_count, engaged, frame_pieces = closest_body
+        if not engaged:
+            if self.tracking_id is not None:
+                self.resets += 1
+            self.reset()
+            return
+        joints = np.asarray(frame_pieces[_JOINTS_OFFSET:], dtype=np.float64).reshape(JOINT_COUNT, _JOINT_VALUES)
+        self.append(timestamp, frame_pieces[0], joints[:, 2:5], joints[:, 5:9], joints[:, 1], frame_pieces[1:5])
+
+    def index(self, timestamp):
+        """
+        Return: index (0 being the oldest) of the last frame at or before timestamp, -1 if there is none
+        """
+        return int(np.searchsorted(self.timestamps[self._order()], timestamp, side='right')) - 1
+
+    def last(self, n=None, field='positions'):
+        """
+        Return: a copy of the last n frames of field (e.g. 'positions', 'velocities', 'joint_angles'), oldest first
+        """
+        return getattr(self, field)[self._order(n)]
+
+    def velocity(self):
+        """
+        Return: (JOINT_COUNT, 3) velocity of the joints at the last frame, in m/s
+        """
+        return self.velocities[self._slot(-1)]
+
+    def acceleration(self):
+        """
+        Return: (JOINT_COUNT, 3) acceleration of the joints at the last frame, in m/s^2
+        """
+        return self.accelerations[self._slot(-1)]
+
+    def angles(self):
+        """
+        Return: dict of angle name to the angle at the last frame, in radians
+        """
+        return dict(zip(self.angle_names, self.joint_angles[self._slot(-1)].tolist()))
+
+    def mean(self):
+        """
+        Return: (JOINT_COUNT, 3) mean position over the last min(window, len) frames
+        """
+        return self._mean.copy()
+
+    def variance(self):
+        """
+        Return: (JOINT_COUNT, 3) population variance of the positions over the last min(window, len) frames
+        """
+        n = min(self.count, self.window)
+        if n == 0:
+            return np.zeros_like(self._m2)
+        return np.maximum(self._m2 / n, 0.0)
+
+    def window_velocity(self):
+        """
+        Return: (JOINT_COUNT, 3) mean velocity over the last min(window, len) frames, in m/s
+        """
+        n = min(self.count, self.window)
+        if n < 2:
+            return np.zeros((JOINT_COUNT, 3), dtype=np.float32)
+        first, last = self._slot(-n), self._slot(-1)
+        dt = (self.timestamps[last] - self.timestamps[first]) / float(TICKS_PER_SECOND)
+        return (self.positions[last] - self.positions[first]) / dt
@@ -0,0 +1,114 @@
+"""
+Groups the frames KSIM sends for one tick into a single bundle
+
+MainWindow.OnMultiSourceFrameArrived sends every subscribed frame type back to back
+with the same timestamp, so a subscription such as ClosestBody | LHDepth | RHDepth
+can be consumed one tick at a time instead of one frame at a time.
+"""
+
+import collections
+import time
+
+from codec import FrameType
+from decode import read_frame
+
+
+# frames maps each frame type to its (content, writer_data)
+Bundle = collections.namedtuple('Bundle', ['timestamp', 'frames', 'complete'])
+
+
+class BundleAssembler(object):
+    """
+    Sans-IO bundle assembler
+
+    Feed it decoded frames with add(); it returns the bundles that became ready, in
+    timestamp order. A bundle is ready once every subscribed frame type arrived for
+    its timestamp. Bundles still missing frames are flushed (complete=False) when a
+    later bundle completes or when they have been pending for more than timeout
+    seconds, and are counted in incomplete_count.
+
+    Contents are kept until the bundle is returned, so they must not be views over
+    a receive buffer (decode with copy=True).
+    """
+
+    def __init__(self, frame_types, timeout=0.5, clock=time.monotonic):
+        self.frame_types = frozenset(ft for ft in FrameType if ft & frame_types)
+        if not self.frame_types:
+            raise ValueError("No frame type in {}".format(frame_types))
+        self.timeout = timeout
+        self.clock = clock
+
+        self.complete_count = 0
+        self.incomplete_count = 0
+
+        # timestamp -> (arrival time of the first frame, frames), in arrival order
+        self._pending = collections.OrderedDict()
+
+    def add(self, timestamp, frame_type, content, writer_data=b""):
+        if frame_type not in self.frame_types:
+            raise ValueError("Frame type {} is not part of the bundle".format(frame_type))
+
+        now = self.clock()
+        entry = self._pending.get(timestamp)
+        if entry is None:
+            entry = (now, {})
+            self._pending[timestamp] = entry
+        entry[1][frame_type] = (content, writer_data)
+
+        ready = []
+        if len(entry[1]) == len(self.frame_types):
+            # Anything still pending from before this tick won't be completed anymore
+            while True:
+                pending_timestamp, (_, frames) = self._pending.popitem(last=False)
+                if pending_timestamp == timestamp:
+                    break
+                ready.append(self._flush(pending_timestamp, frames))
+            self.complete_count += 1
+            ready.append(Bundle(timestamp, entry[1], True))
+
+        ready.extend(self.expire(now))
+        return ready
+
+    def expire(self, now=None):
+        """
+        Flush bundles pending for longer than the timeout
+        """
+        if now is None:
+            now = self.clock()
+        expired = []
+        while self._pending:
+            timestamp, (arrived, frames) = next(iter(self._pending.items()))
+            if now - arrived <= self.timeout:
+                break
+            del self._pending[timestamp]
+            expired.append(self._flush(timestamp, frames))
+        return expired
+
+    def flush(self):
+        """
+        Flush every pending bundle, e.g. when the connection is closed
+        """
+        flushed = [self._flush(timestamp, frames) for timestamp, (_, frames) in self._pending.items()]
+        self._pending.clear()
+        return flushed
+
+    def _flush(self, timestamp, frames):
+        self.incomplete_count += 1
+        return Bundle(timestamp, frames, False)
+
+
+def read_bundles(sock, frame_types, timeout=0.5, include_incomplete=False):
+    """
+    Yield bundles from a socket subscribed to frame_types
+    """
+    assembler = BundleAssembler(frame_types, timeout)
+    try:
+        while True:
+            (timestamp, frame_type), content, (writer_data,) = read_frame(sock, copy=True)
+            for bundle in assembler.add(timestamp, frame_type, content, writer_data):
+                if bundle.complete or include_incomplete:
+                    yield bundle
+    except EOFError:
+        for bundle in assembler.flush():
+            if include_incomplete:
+                yield bundle
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+"""
+Append-only capture of KSIM streams, with a sidecar index
+
+The capture file holds the frames exactly as received, length prefix included,
+one after the other, so it can be served again byte for byte (replay_server.py).
+The index (<capture>.idx) holds one INDEX_DTYPE record per frame:
+Timestamp (8 bytes, signed) | Frame Type (4 bytes, signed) | Offset of the length prefix (8 bytes, signed)
+
+    python capture.py session.ksim 224         # ClosestBody and both hands (32|64|128)
+    python capture.py audio.ksim 8             # Audio has to be on its own connection
+"""
+
+import mmap
+import os
+import socket
+import struct
+import sys
+import time
+
+import numpy as np
+
+from codec import HEADER, LENGTH, FrameType
+from decode import FrameReader
+from protocol import pack_recognizer_registration
+
+src_addr = 'localhost'
+src_port = 8000
+
+INDEX_DTYPE = np.dtype([
+    ('timestamp', '<i8'),
+    ('frame_type', '<i4'),
+    ('offset', '<i8'),
+])
+
+_index_entry = struct.Struct("<qiq")
+
+assert _index_entry.size == INDEX_DTYPE.itemsize
+
+
+def index_path(path):
+    return path + ".idx"
+
+
+class CaptureWriter(object):
+    """
+    Appends raw frames to a capture, together with their index entries
+    """
+
+    def __init__(self, path, buffering=1 << 20):
+        self.path = path
+        self._data = open(path, 'ab', buffering=buffering)
+        self._index = open(index_path(path), 'ab')
+        # Index entries of the frames not flushed yet, written once their data is
+        self._pending = bytearray()
+        self._index_buffering = 1 << 16
+        self.offset = self._data.tell()
+        self.frame_count = 0
+
+    def write(self, raw_frame):
+        """
+        raw_frame: frame as returned by decode.recv_frame, i.e. without the length prefix
+        """
+        timestamp, frame_type = HEADER.unpack_from(raw_frame)
+        self._data.write(LENGTH.pack(len(raw_frame)))
+        self._data.write(raw_frame)
+        self._pending += _index_entry.pack(timestamp, frame_type, self.offset)
+        self.offset += LENGTH.size + len(raw_frame)
+        self.frame_count += 1
+        if len(self._pending) >= self._index_buffering:
+            self.flush()
+
+    def flush(self):
+        # Data first, so the index never points past the end of the capture
+        self._data.flush()
+        self._index.write(self._pending)
+        self._index.flush()
+        del self._pending[:]
+
+    def close(self):
+        self.flush()
+        self._data.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def rebuild_index(path):
+    """
+    Recreate the index by scanning the capture, e.g. after a crash left it behind
+    Return: number of frames indexed; a truncated last frame is left out
+    """
+    size = os.path.getsize(path)
+    count = 0
+    with open(path, 'rb') as data, open(index_path(path), 'wb') as index:
+        offset = 0
+        while offset + LENGTH.size + HEADER.size <= size:
+            data.seek(offset)
+            prefix = data.read(LENGTH.size + HEADER.size)
+            (frame_size,) = LENGTH.unpack_from(prefix)
+            if offset + LENGTH.size + frame_size > size:
+                break
+            timestamp, frame_type = HEADER.unpack_from(prefix, LENGTH.size)
+            index.write(_index_entry.pack(timestamp, frame_type, offset))
+            offset += LENGTH.size + frame_size
+            count += 1
+    return count
+
+
+class CaptureReader(object):
+    """
+    Random access to a capture through mmap; frames are returned as memoryviews
+    over the mapping, valid until close()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else None
+        self._view = memoryview(self._mmap) if self._mmap is not None else memoryview(b"")
+
+        index = np.fromfile(index_path(path), dtype=INDEX_DTYPE)
+        # Entries for frames that didn't make it to the capture in full are ignored
+        index = index[(index['offset'] >= 0) & (index['offset'] + LENGTH.size <= size)]
+        ends = np.zeros(len(index), dtype=np.int64)
+        if len(index):
+            data = np.frombuffer(self._mmap, dtype=np.uint8)
+            prefixes = data[index['offset'][:, None] + np.arange(LENGTH.size)]
+            ends = index['offset'] + LENGTH.size + prefixes.view(LENGTH.format).ravel()
+            del data, prefixes
+        complete = (ends >= index['offset'] + LENGTH.size + HEADER.size) & (ends <= size)
+        self.index = index[complete]
+        # Offset of the end of each frame, where the next one starts
+        self.ends = ends[complete]
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def timestamps(self):
+        return self.index['timestamp']
+
+    def frame(self, i):
+        """
+        Return: frame i without its length prefix, as decode.recv_frame would
+        """
+        start = int(self.index['offset'][i])
+        (frame_size,) = LENGTH.unpack_from(self._view, start)
+        start += LENGTH.size
+        return self._view[start:start + frame_size]
+
+    def wire_frame(self, i):
+        """
+        Return: frame i as it was received, length prefix included
+        """
+        start = int(self.index['offset'][i])
+        (frame_size,) = LENGTH.unpack_from(self._view, start)
+        return self._view[start:start + LENGTH.size + frame_size]
+
+    def seek(self, timestamp):
+        """
+        Return: position of the first frame at or after timestamp
+        """
+        return int(np.searchsorted(self.index['timestamp'], timestamp, side='left'))
+
+    def frames(self, start=0, stop=None, frame_types=None):
+        """
+        Yield (index, frame) for frames in [start, stop), optionally only those of frame_types (a bitset)
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        types = self.index['frame_type']
+        for i in range(start, stop):
+            if frame_types is None or types[i] & frame_types:
+                yield i, self.frame(i)
+
+    def close(self):
+        self._view.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Frames are still referenced, the mapping goes away with the last of them
+                pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def connect(frame_types):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.connect((src_addr, src_port))
+    except:
+        print("Error connecting to {}:{}".format(src_addr, src_port))
+        return None
+    try:
+        sock.sendall(pack_recognizer_registration(frame_types))
+    except:
+        print("Error: Stream rejected")
+        return None
+    return sock
+
+
+def record(sock, writer, duration=None):
+    """
+    Write every frame received on sock to writer, for duration seconds or until the connection closes
+    """
+    reader = FrameReader(sock)
+    end = None if duration is None else time.monotonic() + duration
+    try:
+        while end is None or time.monotonic() < end:
+            reader.fill()
+            for frame in reader.parser.frames():
+                writer.write(frame)
+    except EOFError:
+        pass
+    writer.flush()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage: capture.py <capture file> <frame types> [seconds]")
+        sys.exit(1)
+
+    path = sys.argv[1]
+    frame_types = int(sys.argv[2])
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    s = connect(frame_types)
+    if s is None:
+        sys.exit(0)
+    print("Recording {} to {}".format(FrameType(frame_types), path))
+
+    with CaptureWriter(path) as writer:
+        try:
+            record(s, writer, duration)
+        except KeyboardInterrupt:
+            pass
+    s.close()
+    print("Recorded {} frames".format(writer.frame_count))
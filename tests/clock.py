@@ -0,0 +1,158 @@
+"""
+Alignment of the Kinect timestamps with the host monotonic clock
+
+Frames carry the Kinect Timestamp (Frame.SerializeHeader), which has an unknown
+offset to the clocks of this host and drifts against them. ClockAlignment
+estimates host time as a linear function of Kinect time from the arrival time
+of the frames:
+
+    arrival = offset + (1 + drift) * kinect_time + delay,    delay >= 0
+
+Delays only ever add to the arrival time, so the line is fit to the lower
+envelope of the (kinect_time, arrival) points: the earliest arrival of each
+bucket of Kinect time is kept, for a bounded number of buckets, the slope is
+fit by least squares through these minima and the line is then lowered until
+it touches the lowest one. Each frame costs O(1); the fit runs once per bucket.
+
+The capture time of a frame is where the line puts its Kinect timestamp, and
+its latency is the arrival time minus that. The fastest frames therefore have a
+latency of 0: the fixed part of the latency (exposure, USB, KSIM processing)
+can't be observed from the arrival times and is given as base_latency.
+
+Audio frames reuse the timestamp of the last multi source frame, so they are
+aligned but don't update the estimate. Neither do frames older than the last
+one, which other connections of the same process (each with their own frame
+types) deliver interleaved; a step back of more than reset_seconds restarts
+the estimate, as the Kinect clock was reset.
+"""
+
+import collections
+import threading
+import time
+
+import numpy as np
+
+from codec import TICKS_PER_SECOND
+
+# capture_time: host monotonic time the frame was captured at
+# latency: arrival time minus capture_time, in seconds
+Alignment = collections.namedtuple('Alignment', ['capture_time', 'latency'])
+
+
+class ClockAlignment(object):
+    """
+    bucket_seconds: Kinect time each minimum is taken over; buckets: number of minima the fit is over
+    max_drift: bound of the drift estimate, crystals are well within 1e-4
+    reset_seconds: frames arriving that much before the line predicts mean the Kinect clock jumped
+    """
+
+    def __init__(self, bucket_seconds=1.0, buckets=120, max_drift=1e-3, reset_seconds=5.0, base_latency=0.0,
+                 clock=time.monotonic):
+        if bucket_seconds <= 0 or buckets < 2:
+            raise ValueError("bucket_seconds must be positive and buckets at least 2")
+        self.bucket_seconds = bucket_seconds
+        self.max_drift = max_drift
+        self.reset_seconds = reset_seconds
+        self.base_latency = base_latency
+        self.clock = clock
+        self.resets = 0
+        self._lock = threading.Lock()
+        # (x, y) of the earliest arrival of each closed bucket, oldest first
+        self._minima = collections.deque(maxlen=buckets)
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the estimate, e.g. after the sensor was restarted
+        """
+        # Kinect ticks and host seconds the estimate is relative to, keeping the fit well conditioned
+        self._origin = None
+        self._last_timestamp = None
+        self._minima.clear()
+        self._bucket = None
+        self._bucket_min = None
+        # Host time (relative to the origin) at Kinect time 0 (relative to the origin)
+        self._offset = None
+        self.drift = 0.0
+        self.samples = 0
+
+    @property
+    def ready(self):
+        return self._offset is not None
+
+    def _fit(self):
+        x, y = np.array(self._minima).T
+        slope = 1.0 + self.drift
+        if len(x) >= 2 and x[-1] - x[0] >= self.bucket_seconds:
+            dx = x - x.mean()
+            slope = float(np.dot(dx, y - y.mean()) / np.dot(dx, dx))
+            slope = min(max(slope, 1.0 - self.max_drift), 1.0 + self.max_drift)
+        self.drift = slope - 1.0
+        self._offset = float(np.min(y - slope * x))
+
+    def observe(self, timestamp, arrival=None, update=True):
+        """
+        timestamp: Kinect timestamp of a frame, in ticks; arrival: host monotonic time it arrived at
+        update: False for frames whose timestamp isn't their own (Audio)
+        Return: Alignment of the frame, None until a frame with update=True was seen
+        """
+        arrival = self.clock() if arrival is None else arrival
+        with self._lock:
+            if update and self._origin is not None and timestamp < self._last_timestamp:
+                # Connections of one process interleave their ticks: only a large step back is a clock jump
+                if self._last_timestamp - timestamp > self.reset_seconds * TICKS_PER_SECOND:
+                    self._restart(timestamp, arrival)
+                else:
+                    update = False
+            if update:
+                if self._origin is None:
+                    self._restart(timestamp, arrival)
+                x, y = self._relative(timestamp, arrival)
+                if y - self._line(x) < -self.reset_seconds:
+                    self._restart(timestamp, arrival)
+                    x, y = 0.0, 0.0
+                self._update(x, y)
+                self._last_timestamp = timestamp
+            elif self._origin is None:
+                return None
+            else:
+                x, y = self._relative(timestamp, arrival)
+
+            capture_time = self._origin[1] + self._line(x) - self.base_latency
+        return Alignment(capture_time, arrival - capture_time)
+
+    def capture_time(self, timestamp):
+        """
+        Return: host monotonic time of Kinect timestamp, None before the first frame
+        """
+        with self._lock:
+            if self._origin is None:
+                return None
+            x = (timestamp - self._origin[0]) / float(TICKS_PER_SECOND)
+            return self._origin[1] + self._line(x) - self.base_latency
+
+    def _restart(self, timestamp, arrival):
+        if self._origin is not None:
+            self.resets += 1
+        self.reset()
+        self._origin = (timestamp, arrival)
+
+    def _relative(self, timestamp, arrival):
+        return (timestamp - self._origin[0]) / float(TICKS_PER_SECOND), arrival - self._origin[1]
+
+    def _line(self, x):
+        return self._offset + (1.0 + self.drift) * x if self._offset is not None else x
+
+    def _update(self, x, y):
+        bucket = int(x // self.bucket_seconds)
+        if bucket != self._bucket:
+            if self._bucket_min is not None:
+                self._minima.append(self._bucket_min)
+                self._fit()
+            self._bucket, self._bucket_min = bucket, (x, y)
+        elif y - x < self._bucket_min[1] - self._bucket_min[0]:
+            self._bucket_min = (x, y)
+        # Keep the line under every point, including those of the open bucket
+        if self._offset is None or y < self._line(x):
+            self._offset = y - (1.0 + self.drift) * x
+        self.samples += 1
@@ -1,9 +1,13 @@
 import socket
 import struct
-import time
 import sys
 
+import numpy as np
+
 from decode import read_frame
+from codec import decode_closest_body
+from body_history import BodyHistory, HAND_RIGHT
+import metrics
 
 src_addr = 'localhost'
 src_port = 8000
@@ -32,45 +36,17 @@ def connect():
     return sock
 
 
-def decode_content(raw_frame, offset):
-    """
-    raw_frame: frame starting from 4 to end (4 for length field)
-    offset: index where header ends; header is header_l, timestamp, frame_type
-    """
-    endianness = "<"
-
-    content_header_format = "BB"  # Tracked body count | Engaged
-    content_header_size = struct.calcsize(endianness + content_header_format)
-    content_header = struct.unpack_from(endianness + content_header_format, raw_frame, offset)
-
-    tracked_body_count, engaged = content_header
-
-    # For each body, a header is transmitted
-    # TrackingId | HandLeftConfidence | HandLeftState | HandRightConfidence | HandRightState ]
-    body_format = "Q4B"
-
-    # For each of the 25 joints, the following info is transmitted
-    # [ JointType | TrackingState | Position.X | Position.Y | Position.Z | Orientation.W | Orientation.X | Orientation.Y | Orientation.Z ]
-    joint_format = "BB7f"
-
-    frame_format = body_format + (joint_format * 25)
-
-    # Unpack the raw frame into individual pieces of data as a tuple
-    frame_pieces = struct.unpack_from(endianness + (frame_format * engaged), raw_frame, offset + content_header_size)
-
-    # decoded = (tracked_body_count, engaged) + frame_pieces
-    decoded = (tracked_body_count, engaged, frame_pieces)
-    offset = offset + content_header_size + struct.calcsize(
-        endianness + frame_format * engaged)  # new offset from where tail starts
-    return decoded, offset
+decode_content = decode_closest_body
 
     
 if __name__ == '__main__':
     s = connect()
     if s is None:
         sys.exit(0)
+    metrics.serve_if_requested()
     
-    start_time = time.time()
+    # Last 10s of the engaged body, features over the last second
+    history = BodyHistory(capacity=300, window=30)
     count = 0
     while True:
         try:
@@ -80,12 +56,18 @@ if __name__ == '__main__':
             break
 
         print("{:<20d} {:<4d} {:<4d} {:<5s} '{}'".format(timestamp, frame_type, tracked_body_count, str(engaged > 0), writer_data.decode('ascii')))
+        history.append_closest_body(timestamp, (tracked_body_count, engaged, frame_pieces))
+        if len(history) > 1:
+            print("Right hand speed: {:.2f} m/s, right elbow: {:.0f} deg".format(
+                float(np.linalg.norm(history.velocity()[HAND_RIGHT])), np.degrees(history.angles()['elbow_right'])))
+        # Estimated from the Kinect timestamps, see clock.py
+        alignment = metrics.REGISTRY.stream(frame_type).alignment
+        print("Captured at {:.3f}, latency {:.1f} ms".format(alignment.capture_time, alignment.latency * 1000))
         print("\n\n")
 
         count += 1
         if count == 100:
             print('='*30)
-            print('FPS: ', 100.0 / (time.time() - start_time))
+            print(metrics.REGISTRY.summary())
             print('='*30)
-            start_time = time.time()
             count = 0
@@ -4,6 +4,7 @@ import socket
 import sys
 import struct
 from decode import read_frame
+from codec import decode_closest_face
 
 src_addr = 'localhost'
 src_port = 8000
@@ -35,14 +36,7 @@ def connect():
 
 # Timestamp | frame type | command_length | command
 
-def decode_content(raw_frame, offset):
-    endianness = "<"
-
-    # 4 bytes and 3 doubles
-    content_format = "B" * 4 + "d" * 3
-    content_size = struct.calcsize(endianness + content_format)
-    content = struct.unpack_from(endianness + content_format, raw_frame, offset)
-    return content, offset + content_size
+decode_content = decode_closest_face
 
 
 if __name__ == '__main__':
@@ -0,0 +1,305 @@
+"""
+Decoders for every frame type sent by KSIM, mirroring KSIM/Frames/*.cs
+
+Each frame is serialized by Frame.Serialize as
+Timestamp (8 bytes, signed) | Frame Type (4 bytes, bitset) | middle section | Affix Length (4 bytes, signed) | Affix
+where the middle section depends on the frame type. All the formats are compiled
+once here, and every decoder works straight on the received buffer (bytes,
+bytearray or memoryview) with unpack_from.
+
+Content decoders share the signature of decode_content in the clients:
+decode_xxx(raw_frame, offset, copy=False) -> (content, offset), with offset pointing
+at the tail. Unless copy is True, bulk data (depth arrays, JPEG bytes) is returned
+as a view over raw_frame.
+"""
+
+import enum
+import struct
+
+import numpy as np
+
+
+class FrameType(enum.IntFlag):
+    """
+    Same values as KSIM.Frames.FrameType
+    """
+    Color = 2
+    Speech = 4
+    Audio = 8
+    Depth = 16
+    ClosestBody = 32
+    LHDepth = 64
+    RHDepth = 128
+    HeadDepth = 256
+    HeadColor = 512
+    ClosestFace = 1024
+
+
+# Number of bytes in the frame that follow
+LENGTH = struct.Struct("<i")
+
+# Timestamp | frame type
+HEADER = struct.Struct("<qi")
+
+# Affix length, followed by the affix itself
+TAIL = struct.Struct("<i")
+
+# Stride | Width | Height | Number of JPEG bytes
+COLOR_HEADER = struct.Struct("<iiii")
+
+# Always 0 | Width | Height | Number of JPEG bytes
+HEAD_COLOR_HEADER = struct.Struct("<iiii")
+
+# Command length
+SPEECH_HEADER = struct.Struct("<i")
+
+# Sample count
+AUDIO_HEADER = struct.Struct("<i")
+
+# Mono 32 bit float samples at 16kHz
+AUDIO_DTYPE = np.dtype("<f4")
+
+# Width | Height
+DEPTH_HEADER = struct.Struct("<ii")
+
+# Width | Height | Position X | Position Y (w.r.t. the segmented frame)
+SEGMENTED_DEPTH_HEADER = struct.Struct("<iiff")
+
+# Timestamps are DateTime.Now.Ticks on the KSIM host, in units of 100ns
+TICKS_PER_SECOND = 10 ** 7
+
+# Depth data, stored one row after the other
+DEPTH_DTYPE = np.dtype("<u2")
+
+# (height, width) of the Kinect v2 depth frames
+DEPTH_SHAPE = (424, 512)
+
+# Tracked body count | Engaged
+BODY_HEADER = struct.Struct("<BB")
+
+# For the engaged body, a header is transmitted
+# TrackingId | HandLeftConfidence | HandLeftState | HandRightConfidence | HandRightState
+BODY_FORMAT = "Q4B"
+
+# For each of the 25 joints, the following info is transmitted
+# [ JointType | TrackingState | Position.X | Position.Y | Position.Z | Orientation.W | Orientation.X | Orientation.Y | Orientation.Z ]
+JOINT_FORMAT = "BB7f"
+
+JOINT_COUNT = 25
+
+BODY = struct.Struct("<" + BODY_FORMAT + JOINT_FORMAT * JOINT_COUNT)
+
+# Face found | Engaged | Looking away | Wearing glasses | Pitch | Yaw | Roll
+FACE = struct.Struct("<4B3d")
+
+
+def decode_header(raw_frame):
+    """
+    Return: (timestamp, frame_type), offset where the middle section starts
+    """
+    return HEADER.unpack_from(raw_frame), HEADER.size
+
+
+def decode_tail(raw_frame, offset):
+    """
+    Return: (writer_data,), offset past the end of the frame
+    """
+    (writer_data_length,) = TAIL.unpack_from(raw_frame, offset)
+    offset += TAIL.size
+    writer_data = bytes(raw_frame[offset:offset + writer_data_length])
+    return (writer_data,), offset + writer_data_length
+
+
+def decode_color(raw_frame, offset, copy=False):
+    """
+    Return: (stride, width, height, jpeg), where jpeg is a view over the JPEG bytes unless copy is True
+    """
+    stride, width, height, num_bytes = COLOR_HEADER.unpack_from(raw_frame, offset)
+    offset += COLOR_HEADER.size
+    jpeg = memoryview(raw_frame)[offset:offset + num_bytes]
+    if copy:
+        jpeg = bytes(jpeg)
+    return (stride, width, height, jpeg), offset + num_bytes
+
+
+def decode_head_color(raw_frame, offset, copy=False):
+    """
+    Return: (width, height, jpeg), where jpeg is a view over the JPEG bytes unless copy is True
+    """
+    _, width, height, num_bytes = HEAD_COLOR_HEADER.unpack_from(raw_frame, offset)
+    offset += HEAD_COLOR_HEADER.size
+    jpeg = memoryview(raw_frame)[offset:offset + num_bytes]
+    if copy:
+        jpeg = bytes(jpeg)
+    return (width, height, jpeg), offset + num_bytes
+
+
+def decode_speech(raw_frame, offset, copy=False):
+    """
+    Return: (command_length, command)
+    """
+    (command_length,) = SPEECH_HEADER.unpack_from(raw_frame, offset)
+    offset += SPEECH_HEADER.size
+    command = bytes(raw_frame[offset:offset + command_length]).decode('ascii')
+    return (command_length, command), offset + command_length
+
+
+def decode_audio(raw_frame, offset, copy=False):
+    """
+    Return: (sample_count, samples) with samples as a float32 array of values in [-1.0, 1.0]
+    samples is a view over raw_frame unless copy is True
+    """
+    (sample_count,) = AUDIO_HEADER.unpack_from(raw_frame, offset)
+    offset += AUDIO_HEADER.size
+    samples = np.frombuffer(raw_frame, dtype=AUDIO_DTYPE, count=sample_count, offset=offset)
+    if copy:
+        samples = samples.copy()
+    return (sample_count, samples), offset + samples.nbytes
+
+
+def _depth_array(raw_frame, offset, width, height, copy):
+    # A view over the receive buffer, unless the caller wants to keep the frame around
+    depth_data = np.frombuffer(raw_frame, dtype=DEPTH_DTYPE, count=width * height, offset=offset).reshape(height, width)
+    return depth_data.copy() if copy else depth_data
+
+
+def decode_depth(raw_frame, offset, copy=False):
+    """
+    Return: (width, height, depth_data) with depth_data as a (height, width) uint16 array
+    depth_data is a view over raw_frame unless copy is True
+    """
+    width, height = DEPTH_HEADER.unpack_from(raw_frame, offset)
+    offset += DEPTH_HEADER.size
+    depth_data = _depth_array(raw_frame, offset, width, height, copy)
+    return (width, height, depth_data), offset + depth_data.nbytes
+
+
+def decode_segmented_depth(raw_frame, offset, copy=False):
+    """
+    Return: (width, height, posx, posy, depth_data); width and height are 0 if the frame could not be segmented
+    depth_data is a (height, width) uint16 array, a view over raw_frame unless copy is True
+    """
+    width, height, posx, posy = SEGMENTED_DEPTH_HEADER.unpack_from(raw_frame, offset)
+    offset += SEGMENTED_DEPTH_HEADER.size
+    depth_data = _depth_array(raw_frame, offset, width, height, copy)
+    return (width, height, posx, posy, depth_data), offset + depth_data.nbytes
+
+
+def decode_closest_body(raw_frame, offset, copy=False):
+    """
+    Return: (tracked_body_count, engaged, frame_pieces), with frame_pieces empty if no body is engaged
+    """
+    tracked_body_count, engaged = BODY_HEADER.unpack_from(raw_frame, offset)
+    offset += BODY_HEADER.size
+    if engaged:
+        return (tracked_body_count, engaged, BODY.unpack_from(raw_frame, offset)), offset + BODY.size
+    return (tracked_body_count, engaged, ()), offset
+
+
+def decode_closest_face(raw_frame, offset, copy=False):
+    """
+    Return: (face_found, engaged, looking_away, wearing_glasses, pitch, yaw, roll)
+    """
+    return FACE.unpack_from(raw_frame, offset), offset + FACE.size
+
+
+CODECS = {
+    FrameType.Color: decode_color,
+    FrameType.Speech: decode_speech,
+    FrameType.Audio: decode_audio,
+    FrameType.Depth: decode_depth,
+    FrameType.ClosestBody: decode_closest_body,
+    FrameType.LHDepth: decode_segmented_depth,
+    FrameType.RHDepth: decode_segmented_depth,
+    FrameType.HeadDepth: decode_segmented_depth,
+    FrameType.HeadColor: decode_head_color,
+    FrameType.ClosestFace: decode_closest_face,
+}
+
+
+def decode_content(raw_frame, offset, frame_type, copy=False):
+    try:
+        decoder = CODECS[frame_type]
+    except KeyError:
+        raise ValueError("Unknown frame type {}".format(frame_type))
+    return decoder(raw_frame, offset, copy)
+
+
+def decode(raw_frame, copy=False):
+    """
+    Decode a frame of any type, dispatching on its frame_type field
+    With copy=False, arrays and JPEG data in the content are views over raw_frame, so
+    they are only valid as long as raw_frame is
+    Return: (timestamp, frame_type), content, (writer_data,)
+    """
+    header, offset = decode_header(raw_frame)
+    content, offset = decode_content(raw_frame, offset, header[1], copy)
+    tail, offset = decode_tail(raw_frame, offset)
+
+    if offset != len(raw_frame):
+        raise ValueError("Decoded {} bytes out of a {} byte frame of type {}".format(offset, len(raw_frame), header[1]))
+
+    return header, content, tail
+
+
+# Encoders, the inverse of the decoders above. They return the middle section of a
+# frame the way the matching SerializeMiddle writes it.
+
+def encode_color(stride, width, height, jpeg):
+    return COLOR_HEADER.pack(stride, width, height, len(jpeg)) + bytes(jpeg)
+
+
+def encode_head_color(width, height, jpeg):
+    return HEAD_COLOR_HEADER.pack(0, width, height, len(jpeg)) + bytes(jpeg)
+
+
+def encode_speech(command):
+    command = command.encode('ascii')
+    return SPEECH_HEADER.pack(len(command)) + command
+
+
+def encode_audio(samples):
+    samples = np.asarray(samples, dtype=AUDIO_DTYPE)
+    return AUDIO_HEADER.pack(len(samples)) + samples.tobytes()
+
+
+def encode_depth(depth_data):
+    """
+    depth_data: (height, width) array
+    """
+    depth_data = np.asarray(depth_data, dtype=DEPTH_DTYPE)
+    height, width = depth_data.shape
+    return DEPTH_HEADER.pack(width, height) + depth_data.tobytes()
+
+
+def encode_segmented_depth(depth_data, posx, posy):
+    """
+    depth_data: (height, width) array, or None for a frame that could not be segmented
+    """
+    if depth_data is None:
+        return SEGMENTED_DEPTH_HEADER.pack(0, 0, -1.0, -1.0)
+    depth_data = np.asarray(depth_data, dtype=DEPTH_DTYPE)
+    height, width = depth_data.shape
+    return SEGMENTED_DEPTH_HEADER.pack(width, height, posx, posy) + depth_data.tobytes()
+
+
+def encode_closest_body(tracked_body_count, frame_pieces=None):
+    """
+    frame_pieces: the BODY values as returned by decode_closest_body, or None if no body is engaged
+    """
+    if frame_pieces is None:
+        return BODY_HEADER.pack(tracked_body_count, 0)
+    return BODY_HEADER.pack(tracked_body_count, 1) + BODY.pack(*frame_pieces)
+
+
+def encode_closest_face(face_found, engaged, looking_away, wearing_glasses, pitch, yaw, roll):
+    return FACE.pack(face_found, engaged, looking_away, wearing_glasses, pitch, yaw, roll)
+
+
+def encode(timestamp, frame_type, middle, affix=b""):
+    """
+    Return: the complete frame as sent on the wire, length prefix included
+    """
+    affix = affix or b""
+    size = HEADER.size + len(middle) + TAIL.size + len(affix)
+    return b"".join((LENGTH.pack(size), HEADER.pack(timestamp, int(frame_type)), middle, TAIL.pack(len(affix)), affix))
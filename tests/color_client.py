@@ -1,11 +1,9 @@
 #!/usr/bin/env python
 
 import socket, sys, struct
-import time
-import numpy as np
-import matplotlib.pyplot as plt
-import imageio
 import cv2
+from color_pipeline import ColorPipeline, SharedColorPipeline
+import metrics
 
 src_addr = 'cwc2'
 src_port = 8000
@@ -34,53 +32,6 @@ def connect():
     return sock
     
 
-# timestamp | frame type | stride | width | height | color_data
-def decode_frame(raw_frame):
-    # Expect little endian byte order
-    endianness = "<"
-
-    # In each frame, a header is transmitted
-    # Timestamp | frame type | width | height
-    header_format = "qiiiii"
-    header_size = struct.calcsize(endianness + header_format)
-    header = struct.unpack(endianness + header_format, raw_frame[:header_size])
-
-    timestamp, frame_type, stride, width, height, num_bits = header
-
-    # Removed called to struct.unpack_from and decoded the jpeg file
-    # Relies on the imageio jibrary 
-    print(header)
-    #color_data = imageio.imread(raw_frame[header_size:], "jpeg")
-    color_data = imageio.imread(raw_frame[header_size:])
-    
-    return (timestamp, frame_type, stride, width, height, color_data)
-
-def format_as_image(raw_image, width, height):
-    # Convert to RGBA from BGRA
-    image_as_pixels = np.array([ (raw_image[i+2], raw_image[i+1], raw_image[i], raw_image[i+3]) for i in range(0, len(raw_image), 4)] , dtype=np.float)
-    #image_as_pixels = np.array(raw_image)
-    image_as_pixels /= 255.0
-    
-    return image_as_pixels.reshape((height, width, 3))
-
-def recv_all(sock, size):
-    result = b''
-    while len(result) < size:
-        data = sock.recv(size - len(result))
-        if not data:
-            raise EOFError("Error: Received only {} bytes into {} byte message".format(len(data), size))
-        result += data
-    return result
-
-def recv_color_frame(sock):
-    """
-    Experimental function to read each stream frame from the server
-    """
-    (frame_size,) = struct.unpack("<i", recv_all(sock, 4))
-
-    return recv_all(sock, frame_size) 
-    
-
 if __name__ == '__main__':
 
     s = connect()
@@ -88,44 +39,38 @@ if __name__ == '__main__':
         sys.exit(0)
         
     i = 0
-    avg_frame_time = 0.0
     do_plot = True if len(sys.argv) > 1 and sys.argv[1] == '--plot' else False
-    
-    while True:
-        try:
-            t_begin = time.time()
-            f = recv_color_frame(s)
-            t_end = time.time()
-        except ex:
-            print(ex)
-            s.close()
-            break
-        print ("Time taken for this frame: {}".format(t_end - t_begin))
-        avg_frame_time += (t_end - t_begin)
-        timestamp, frame_type, stride, width, height, img = decode_frame(f)
-        #temp = img[:,0]
-        #img[:,0] = img[:,2]
-        #img[:,2] = temp
-        print (timestamp, frame_type, stride, width, height)
+    use_processes = '--processes' in sys.argv
+
+    # Frames are received on their own thread and decoded by a thread pool, in order.
+    # With --processes they are decoded by a process pool into shared memory, as RGB
+    if use_processes:
+        pipeline = SharedColorPipeline(s)
+    else:
+        pipeline = ColorPipeline(s)
+    # Only once the workers are forked, so that no thread (the HTTP server's included) exists before
+    metrics.serve_if_requested()
+    pipeline.start()
+    for frame in pipeline:
+        timestamp, stride, width, height, img = frame.timestamp, frame.stride, frame.width, frame.height, frame.image
+        print (timestamp, stride, width, height, "in flight: {}".format(pipeline.in_flight))
 
         if do_plot and i %1  == 0:
-            #img = format_as_image(color_data, width, height)
-            #print (img[0,0])
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            cv2.imshow("David is bad at Overwatch", img)
+            # cv2.imdecode already returns BGR, as imshow expects
+            cv2.imshow("David is bad at Overwatch", cv2.cvtColor(img, cv2.COLOR_RGB2BGR) if use_processes else img)
             cv2.waitKey(1)
-           # plt.show(block = False)
-           # plt.pause(0.1)
-           # plt.close()
-            
+        if use_processes:
+            # Hand the shared memory slot back for the next frames
+            frame.release()
+
         print ("\n\n")
         i += 1
+        if i % 100 == 0:
+            # JPEG decode times, from the pool
+            print (metrics.REGISTRY.summary())
 
-    print ("Total frame time: {}".format(avg_frame_time))
-
-    avg_frame_time /= i
-    
-    print ("Average frame time over {} frames: {}".format(i, avg_frame_time))
+    print ("Frames received: {}".format(i))
+    print (metrics.REGISTRY.summary())
 
-    s.close()
+    pipeline.close()
     sys.exit(0)
@@ -0,0 +1,332 @@
+"""
+Pipelined consumer for the Color stream
+
+Decoding a 1920x1080 JPEG takes longer than the 33ms between Kinect frames on
+a single core, so decoding inline in the receive loop lets the socket backlog
+grow. Here one thread only receives and parses frames, and the JPEG payloads are
+decoded by a thread pool (the decoders release the GIL while they work). Decoded
+frames are returned in the order they were received, i.e. by timestamp, and at
+most max_in_flight frames are received but not yet consumed.
+
+SharedColorPipeline does the same with a process pool instead, for when the
+work around decoding (color conversion, normalization) is what saturates the
+interpreter: workers write RGB straight into a ring of shared memory slots and
+the consumer gets the slots, so no image is ever pickled between processes.
+"""
+
+import collections
+import concurrent.futures
+import multiprocessing
+import queue
+import socket
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import codec
+import metrics
+from codec import FrameType
+from decode import FrameReader
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+try:
+    import imageio
+except ImportError:
+    imageio = None
+
+
+# image is the decoded (height, width, 3) array, BGR with cv2 and RGB otherwise
+ColorFrame = collections.namedtuple('ColorFrame', ['timestamp', 'stride', 'width', 'height', 'image', 'writer_data'])
+
+
+def decode_jpeg(jpeg):
+    """
+    Decode with cv2 when available, imageio otherwise
+    """
+    if cv2 is not None:
+        return cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if imageio is not None:
+        return imageio.imread(bytes(jpeg))
+    raise ImportError("Decoding JPEG needs cv2 or imageio")
+
+
+def decode_jpeg_rgb(jpeg):
+    """
+    Same as decode_jpeg, always returning RGB
+    """
+    image = decode_jpeg(jpeg)
+    if cv2 is not None:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    return image
+
+
+class ColorPipeline(object):
+    """
+    Receives Color frames from sock on a dedicated thread and decodes them on a thread pool
+
+    When max_in_flight frames are waiting to be consumed the receive thread stops
+    reading, so a consumer that can't keep up applies backpressure to the server
+    instead of growing memory without bound.
+    """
+
+    _end = object()
+
+    def __init__(self, sock, workers=4, max_in_flight=8, decoder=decode_jpeg):
+        self.sock = sock
+        self.decoder = decoder
+        self.received = 0
+        self.consumed = 0
+
+        self._pool = self._make_pool(workers)
+        # Indices of the slots not in use, a frame holds one from receive to consume
+        self._free = queue.Queue()
+        for slot in range(max_in_flight):
+            self._free.put(slot)
+        # Futures in the order frames were received
+        self._pending = queue.Queue()
+        self._stopped = threading.Event()
+        self._receiver = threading.Thread(target=self._receive_loop, name="ColorRecv", daemon=True)
+
+    def start(self):
+        self._receiver.start()
+        return self
+
+    def _make_pool(self, workers):
+        return concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ColorDecode")
+
+    def _acquire_slot(self):
+        while not self._stopped.is_set():
+            try:
+                return self._free.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def _release_slot(self, slot):
+        self._free.put(slot)
+        self.consumed += 1
+
+    def _decode(self, timestamp, stride, width, height, jpeg, writer_data):
+        begin = time.perf_counter()
+        image = self.decoder(jpeg)
+        return ColorFrame(timestamp, stride, width, height, image, writer_data), time.perf_counter() - begin
+
+    def _submit(self, slot, *frame):
+        future = self._pool.submit(self._decode, *frame)
+        future.slot = slot
+        return future
+
+    def _result(self, future):
+        try:
+            frame, seconds = future.result()
+        finally:
+            self._release_slot(future.slot)
+        # Recorded here rather than in the workers, so that only this thread updates the histogram
+        metrics.REGISTRY.stream(FrameType.Color).decode.observe(seconds)
+        return frame
+
+    def _receive_loop(self):
+        reader = FrameReader(self.sock)
+        try:
+            while not self._stopped.is_set():
+                frame = reader.read()
+                # The payload is copied out of the receive buffer, which is reused by the next read
+                (timestamp, frame_type), (stride, width, height, jpeg), (writer_data,) = codec.decode(frame, copy=True)
+                if frame_type != FrameType.Color:
+                    raise ValueError("Expected a Color frame, got frame type {}".format(frame_type))
+                # The JPEG decode time is recorded when the frame is returned
+                metrics.REGISTRY.observe_frame(frame_type, timestamp, len(frame) + codec.LENGTH.size, None, writer_data)
+                slot = self._acquire_slot()
+                if slot is None:
+                    return
+                self._pending.put(self._submit(slot, timestamp, stride, width, height, jpeg, writer_data))
+                self.received += 1
+        except EOFError:
+            pass
+        except Exception as ex:
+            # A socket closed by close() is not an error
+            if not self._stopped.is_set():
+                self._pending.put(ex)
+        finally:
+            self._pending.put(self._end)
+
+    def get(self):
+        """
+        Return: the next decoded ColorFrame, in timestamp order
+        Raises EOFError once the connection is closed and every frame was returned
+        """
+        item = self._pending.get()
+        if item is self._end:
+            # Leave the marker for any later call
+            self._pending.put(item)
+            raise EOFError("Color stream closed")
+        if isinstance(item, BaseException):
+            raise item
+        return self._result(item)
+
+    def __iter__(self):
+        try:
+            while True:
+                yield self.get()
+        except EOFError:
+            return
+
+    @property
+    def in_flight(self):
+        return self.received - self.consumed
+
+    def close(self):
+        self._stopped.set()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self._receiver.join()
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Slots of a SharedFrameRing attached by this (worker) process, by name
+_attached = {}
+
+
+def _attach(name):
+    shm = _attached.get(name)
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = shm
+    return shm
+
+
+def _decode_into(name, shape, decoder, jpeg):
+    """
+    Runs in a worker process: decode jpeg and write the RGB image at the top left of slot name
+    Return: (height, width) of the image, seconds spent decoding and copying it
+    """
+    begin = time.perf_counter()
+    image = decoder(jpeg)
+    height, width = image.shape[:2]
+    if height > shape[0] or width > shape[1]:
+        raise ValueError("{}x{} image doesn't fit in a {}x{} slot".format(width, height, shape[1], shape[0]))
+    out = np.ndarray(shape, dtype=np.uint8, buffer=_attach(name).buf)
+    out[:height, :width] = image
+    return (height, width), time.perf_counter() - begin
+
+
+class SharedFrameRing(object):
+    """
+    slots preallocated shared memory blocks, each holding one (height, width, 3) uint8 image
+    """
+
+    def __init__(self, slots, shape=(1080, 1920, 3)):
+        self.shape = tuple(shape)
+        size = int(np.prod(self.shape))
+        self.memory = [shared_memory.SharedMemory(create=True, size=size) for _ in range(slots)]
+        self.arrays = [np.ndarray(self.shape, dtype=np.uint8, buffer=shm.buf) for shm in self.memory]
+
+    def __len__(self):
+        return len(self.memory)
+
+    def name(self, slot):
+        return self.memory[slot].name
+
+    def close(self):
+        self.arrays = []
+        for shm in self.memory:
+            shm.unlink()
+            try:
+                shm.close()
+            except BufferError:
+                # Images still referenced by the consumer, the mapping goes away with them
+                pass
+        self.memory = []
+
+
+class ColorSlot(object):
+    """
+    Handle to a decoded frame in a SharedFrameRing slot
+
+    image is a view over the shared memory, valid until release(); the slot is then
+    reused for a later frame. Use as a context manager to release it automatically.
+    """
+
+    __slots__ = ('timestamp', 'stride', 'width', 'height', 'writer_data', 'slot', 'image', '_pipeline')
+
+    def __init__(self, pipeline, slot, timestamp, stride, width, height, writer_data, decoded_shape):
+        self.timestamp = timestamp
+        self.stride = stride
+        self.width = width
+        self.height = height
+        self.writer_data = writer_data
+        self.slot = slot
+        self.image = pipeline.ring.arrays[slot][:decoded_shape[0], :decoded_shape[1]]
+        self._pipeline = pipeline
+
+    def release(self):
+        if self._pipeline is not None:
+            self.image = None
+            self._pipeline._release_slot(self.slot)
+            self._pipeline = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class SharedColorPipeline(ColorPipeline):
+    """
+    ColorPipeline decoding on a process pool into a SharedFrameRing
+
+    get() and iteration return ColorSlot handles, in timestamp order. There are
+    max_in_flight slots, so the receive thread waits once that many frames are
+    pending or held by the consumer: release each slot as soon as it is done with.
+    decoder runs in the workers and must be picklable (a module level function).
+    """
+
+    def __init__(self, sock, workers=4, max_in_flight=8, decoder=decode_jpeg_rgb, shape=(1080, 1920, 3),
+                 mp_context=None):
+        if isinstance(mp_context, str):
+            mp_context = multiprocessing.get_context(mp_context)
+        self.mp_context = mp_context
+        self.ring = SharedFrameRing(max_in_flight, shape)
+        ColorPipeline.__init__(self, sock, workers, max_in_flight, decoder)
+        # Start the workers now, before the receive thread exists: forking a
+        # process while another thread holds a lock can deadlock the child
+        self._pool.submit(int).result()
+
+    def _make_pool(self, workers):
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=self.mp_context)
+
+    def _submit(self, slot, timestamp, stride, width, height, jpeg, writer_data):
+        future = self._pool.submit(_decode_into, self.ring.name(slot), self.ring.shape, self.decoder, jpeg)
+        future.slot = slot
+        future.frame = (timestamp, stride, width, height, writer_data)
+        return future
+
+    def _result(self, future):
+        try:
+            decoded_shape, seconds = future.result()
+        except BaseException:
+            self._release_slot(future.slot)
+            raise
+        metrics.REGISTRY.stream(FrameType.Color).decode.observe(seconds)
+        timestamp, stride, width, height, writer_data = future.frame
+        return ColorSlot(self, future.slot, timestamp, stride, width, height, writer_data, decoded_shape)
+
+    def close(self):
+        ColorPipeline.close(self)
+        self.ring.close()
@@ -1,60 +1,250 @@
 import struct
+import time
+import weakref
+
+import codec
+import metrics
+
+try:
+    import fcntl
+    import termios
+except ImportError:
+    # Windows
+    fcntl = None
+
+
+_frame_length = struct.Struct("<i")
+
+
+class FrameParser(object):
+    """
+    Sans-IO parser for the length prefixed frames sent by KSIM.
+
+    Bytes are written straight into the parser's own buffer: get a writable
+    memoryview from buffer(), fill it (e.g. with sock.recv_into) and commit the
+    number of bytes written with advance(). Complete frames are then returned by
+    next_frame() / frames() as memoryview slices of that buffer, excluding the
+    4 byte length prefix, so several frames can be parsed out of one recv call
+    without copying them.
+
+    A returned frame is only valid until the next call to buffer(), which may
+    reuse the memory. Copy it (bytes(frame)) if it has to be kept around.
+    """
+
+    def __init__(self, capacity=1 << 20):
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        # Unparsed bytes live in [_start, _end)
+        self._start = 0
+        self._end = 0
+        # Number of bytes the frame at _start needs in total, length prefix included
+        self._needed = _frame_length.size
+        # Keep at least this much free space at the end of the buffer for recv_into
+        self._min_free = max(capacity // 8, _frame_length.size)
+
+    @property
+    def pending(self):
+        """
+        Number of received bytes not yet returned as part of a frame
+        """
+        return self._end - self._start
+
+    def buffer(self):
+        """
+        Return a writable memoryview over the free part of the buffer
+        """
+        pending = self._end - self._start
+        capacity = len(self._buf)
+
+        if self._needed > capacity:
+            # Frame larger than the buffer: grow into a fresh buffer, so that views
+            # handed out earlier stay intact
+            buf = bytearray(max(2 * capacity, self._needed))
+            view = memoryview(buf)
+            view[:pending] = self._view[self._start:self._end]
+            self._buf, self._view = buf, view
+            self._start, self._end = 0, pending
+        elif self._start > 0 and (self._start + self._needed > capacity or capacity - self._end < self._min_free):
+            # Move the partial frame to the front (memoryview assignment handles the overlap)
+            self._view[:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+
+        return self._view[self._end:]
+
+    def advance(self, size):
+        """
+        Commit size bytes written into the view returned by buffer()
+        """
+        if size < 0 or self._end + size > len(self._buf):
+            raise ValueError("Cannot advance by {} bytes".format(size))
+        self._end += size
+
+    def feed(self, data):
+        """
+        Copy data into the buffer; convenience for callers that already hold bytes
+        """
+        data = memoryview(data)
+        while len(data) > 0:
+            free = self.buffer()
+            size = min(len(free), len(data))
+            free[:size] = data[:size]
+            self.advance(size)
+            data = data[size:]
+
+    def next_frame(self):
+        """
+        Return the next complete frame (without the length prefix) or None
+        """
+        available = self._end - self._start
+        if available < _frame_length.size:
+            self._needed = _frame_length.size
+            return None
+
+        (frame_size,) = _frame_length.unpack_from(self._buf, self._start)
+        if frame_size < 0:
+            raise ValueError("Invalid frame size {}".format(frame_size))
+
+        self._needed = _frame_length.size + frame_size
+        if available < self._needed:
+            return None
+
+        begin = self._start + _frame_length.size
+        self._start = begin + frame_size
+        self._needed = _frame_length.size
+        if self._start == self._end:
+            # Everything consumed, so the next recv can start from the front again
+            self._start = self._end = 0
+            return self._view[begin:begin + frame_size]
+        return self._view[begin:self._start]
+
+    def frames(self):
+        """
+        Yield all complete frames currently in the buffer
+        """
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+
+class FrameReader(object):
+    """
+    Drives a FrameParser from a blocking socket
+    """
+
+    def __init__(self, sock, capacity=1 << 20):
+        self.sock = sock
+        self.parser = FrameParser(capacity)
+
+    def fill(self):
+        """
+        Receive as many bytes as fit in the free part of the buffer with one syscall
+        """
+        received = self.sock.recv_into(self.parser.buffer())
+        if not received:
+            raise EOFError("Error: Connection closed with {} bytes of an incomplete frame".format(self.parser.pending))
+        self.parser.advance(received)
+        return received
+
+    def read(self):
+        """
+        Return the next frame as a memoryview, valid until the next call to read()
+        """
+        frame = self.parser.next_frame()
+        while frame is None:
+            self.fill()
+            frame = self.parser.next_frame()
+        return frame
+
+
+def queued_socket_bytes(sock):
+    """
+    Return: number of bytes waiting in the receive buffer of sock, None if it can't be queried
+    """
+    if fcntl is None:
+        return None
+    try:
+        buf = fcntl.ioctl(sock.fileno(), termios.FIONREAD, struct.pack("i", 0))
+    except OSError:
+        return None
+    return struct.unpack("i", buf)[0]
+
+
+# One reader per socket, so that bytes of the next frame received along with the
+# current one are not lost between calls to read_frame()
+_readers = weakref.WeakKeyDictionary()
+
+
+def get_reader(sock):
+    reader = _readers.get(sock)
+    if reader is None:
+        reader = FrameReader(sock)
+        _readers[sock] = reader
+    return reader
+
+
+def recv_frame(sock):
+    """
+    Return: raw_frame as a memoryview, which is excluding the frame size that was at the front
+    """
+    reader = get_reader(sock)
+    raw_frame = reader.read()
+    # Sample the backlog about once per second per frame type, a syscall per frame would cost more
+    stream = metrics.REGISTRY.stream(codec.HEADER.unpack_from(raw_frame)[1])
+    if stream.backlog_due():
+        queued = queued_socket_bytes(sock)
+        stream.backlog_bytes = None if queued is None else queued + reader.parser.pending
+    return raw_frame
+
+
+def decode(raw_frame, copy=False):
+    """
+    Same as codec.decode, recording the frame in metrics.REGISTRY
+    """
+    begin = time.perf_counter()
+    header, content, tail = codec.decode(raw_frame, copy)
+    seconds = time.perf_counter() - begin
+    metrics.REGISTRY.observe_frame(header[1], header[0], len(raw_frame) + _frame_length.size, seconds, tail[0])
+    return header, content, tail
+
 
-def _recv_all(sock, size):
-    result = b''
-    while len(result) < size:
-        data = sock.recv(size - len(result))
-        if not data:
-            raise EOFError("Error: Received only {} bytes into {} byte message".format(len(data), size))
-        result += data
-    return result
-    
-    
 def _recv_frame(sock):
     """
     Return: frame_size (4:end), raw_frame which is excluding the frame size that was at the front
     """
-    (frame_size,) = struct.unpack("<i", _recv_all(sock, 4))
-    return (frame_size, _recv_all(sock, frame_size))
-    
-    
+    raw_frame = recv_frame(sock)
+    return (len(raw_frame), raw_frame)
+
+
 def _decode_header(raw_frame):
-    endianness = "<"
-    header_format = "qi"  # timestamp, frame_type
-    header_size = struct.calcsize(endianness + header_format)
-    header = struct.unpack_from(endianness + header_format, raw_frame)
+    return codec.decode_header(raw_frame)
+
 
-    timestamp, frame_type = header
-    
-    offset = header_size
-    return (timestamp, frame_type), offset
-    
-    
 def _decode_tail(raw_frame, offset):
-    endianness = "<"
-    
-    writer_header_format = "i"  # size of tail
-    writer_header_offset = offset
-    writer_data_length, = struct.unpack_from(endianness + writer_header_format, raw_frame, writer_header_offset)
-    
-    writer_data_offset = writer_header_offset + struct.calcsize(writer_header_format)
-    if writer_data_length > 0:
-        writer_data_format = "{}s".format(writer_data_length)
-        writer_data, = struct.unpack_from(endianness + writer_data_format, raw_frame, writer_data_offset)
-    else:
-        writer_data = b""
-    
-    offset = writer_data_offset + writer_data_length
-    return (writer_data,), offset
-    
-    
-    
-def read_frame(sock, decode_content):
+    return codec.decode_tail(raw_frame, offset)
+
+
+def read_frame(sock, decode_content=None, copy=False):
+    """
+    Read and decode one frame. Without decode_content, the content decoder is picked
+    from the frame_type field, which is needed for subscriptions such as 64|128
+    Arrays in the content are views over the receive buffer, valid until the next
+    read from sock, unless copy is True
+    """
     frame_size, raw_frame = _recv_frame(sock)
+    begin = time.perf_counter()
     header, offset = _decode_header(raw_frame)
-    content, offset = decode_content(raw_frame, offset)
+    if decode_content is None:
+        content, offset = codec.decode_content(raw_frame, offset, header[1], copy)
+    elif copy:
+        content, offset = decode_content(raw_frame, offset, copy)
+    else:
+        content, offset = decode_content(raw_frame, offset)
     tail, offset = _decode_tail(raw_frame, offset)
     
     assert offset == frame_size
+
+    metrics.REGISTRY.observe_frame(header[1], header[0], frame_size + _frame_length.size,
+                                   time.perf_counter() - begin, tail[0])
         
     return header, content, tail
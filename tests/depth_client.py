@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 
 import socket, sys, struct
-import time
-import numpy as np
 import matplotlib.pyplot as plt
+from decode import recv_frame, decode
+from depth_dataset import DepthDatasetWriter
+import metrics
 
 src_addr = 'localhost'
 src_port = 8000
@@ -34,78 +35,51 @@ def connect():
 
 # Timestamp | frame type | width | height | depth_data
 def decode_frame(raw_frame):
-    
-    # Expect little endian byte order
-    endianness = "<"
-
-    # In each frame, a header is transmitted
-    # Timestamp | frame type | width | height
-    header_format = "qiii"
-    header_size = struct.calcsize(endianness + header_format)
-    header = struct.unpack(endianness + header_format, raw_frame[:header_size])
-
-    timestamp, frame_type, width, height = header
-    
-    depth_data_format = str(width * height) + "H"
-    
-    depth_data = struct.unpack_from(endianness + depth_data_format, raw_frame, header_size)
-    
-    return (timestamp, frame_type, width, height, list(depth_data))
-
-def recv_all(sock, size):
-    result = b''
-    while len(result) < size:
-        data = sock.recv(size - len(result))
-        if not data:
-            raise EOFError("Error: Received only {} bytes into {} byte message".format(len(data), size))
-        result += data
-    return result
-
-def recv_depth_frame(sock):
     """
-    Experimental function to read each stream frame from the server
+    Tail (affix) is validated by codec.decode and returned as writer_data
+    The frame is recorded in metrics.REGISTRY, decode time included
     """
-    (frame_size,) = struct.unpack("<i", recv_all(sock, 4))
+    (timestamp, frame_type), (width, height, depth_data), (writer_data,) = decode(raw_frame)
 
-    return recv_all(sock, frame_size) 
-    
+    return (timestamp, frame_type, width, height, depth_data, writer_data)
 
 if __name__ == '__main__':
 
     s = connect()
     if s is None:
         sys.exit(0)
+    metrics.serve_if_requested()
         
     i = 0
-    avg_frame_time = 0.0
     do_plot = True if len(sys.argv) > 1 and sys.argv[1] == '--plot' else False
+    # Frames are appended to a memory-mapped dataset (depth_dataset.py) instead of being kept in memory
+    dataset = DepthDatasetWriter(sys.argv[sys.argv.index('--dataset') + 1]) if '--dataset' in sys.argv else None
 
     while True:
         try:
-            t_begin = time.time()
-            f = recv_depth_frame(s)
-            t_end = time.time()
+            f = recv_frame(s)
         except:
             s.close()
             break
-        print("Time taken for this frame: {}".format(t_end - t_begin))
-        avg_frame_time += (t_end - t_begin)
-        timestamp, frame_type, width, height, depth_data = decode_frame(f)
+        timestamp, frame_type, width, height, depth_data, writer_data = decode_frame(f)
         print(timestamp, frame_type, width, height)
+        if dataset is not None:
+            dataset.append(timestamp, frame_type, (width, height, depth_data))
         
         if do_plot and i % 20 == 0:
-            image = np.array(depth_data).reshape((height, width))
+            image = depth_data
             im = plt.imshow(image, cmap='gray')
             plt.show()
 
         print("\n\n")
         i += 1
+        if i % 100 == 0:
+            print(metrics.REGISTRY.summary())
 
-    print("Total frame time: {}".format(avg_frame_time))
-
-    avg_frame_time /= i
-    
-    print("Average frame time over {} frames: {}".format(i, avg_frame_time))
+    print("Frames received: {}".format(i))
+    if dataset is not None:
+        dataset.close()
+    print(metrics.REGISTRY.summary())
 
     s.close()
     sys.exit(0)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""
+Lossless compression of Depth, LHDepth, RHDepth and HeadDepth frames
+
+A raw 512x424 depth frame is 434 KB, about 13 MB/s at 30 fps, too much for
+remote consumers on Wi-Fi. DepthEncoder turns each raw frame (as returned by
+decode.recv_frame) into a packet holding the per-pixel difference to the
+previous frame of the same type, compressed with zlib; DepthDecoder turns the
+packets back into the exact same raw frames, header and affix included.
+
+Packet: Kind (1 byte) | Frame Type (4 bytes) | Index (4 bytes, unsigned) | Prefix Size (4 bytes) | Pixel Count (4 bytes) | zlib data
+The zlib data holds the frame up to the pixels (prefix), the pixel residuals
+as a plane of low bytes followed by a plane of high bytes, and the rest of the
+frame (the tail). Residuals are the pixels themselves in keyframes, and the
+difference modulo 2**16 to the previous frame otherwise. A keyframe is sent
+every keyframe_interval frames of a type, and whenever the frame size changes
+(the segmented crops fall back to 168x168 when the joint is lost).
+
+This is only a library for now: neither relay.py nor capture.py use it. The
+relay serializes each frame once for all its clients and drops ticks per client
+when a queue is full, while deltas need one encoder per consumer that sees every
+frame; captures are replayed byte for byte and read at random, while deltas are
+only decodable from the last keyframe on. Both need a packet framing of their
+own (a stream that carries packets instead of KSIM frames, an index of the
+keyframes) before they can offer it as an option.
+
+    python depth_codec.py session.ksim          # compression ratio of a capture
+"""
+
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+import codec
+from codec import FrameType, DEPTH_DTYPE
+
+KEYFRAME = 0
+DELTA = 1
+
+# Kind | Frame Type | Index | Prefix Size | Pixel Count
+PACKET_HEADER = struct.Struct("<BiIii")
+
+DEPTH_TYPES = (FrameType.Depth, FrameType.LHDepth, FrameType.RHDepth, FrameType.HeadDepth)
+
+
+def _split(raw_frame):
+    """
+    Return: frame_type, pixels as a flat uint16 view, the bytes before and after them
+    """
+    (timestamp, frame_type), offset = codec.decode_header(raw_frame)
+    if frame_type not in DEPTH_TYPES:
+        raise ValueError("Frame type {} is not a depth frame".format(frame_type))
+    content, end = codec.decode_content(raw_frame, offset, frame_type)
+    pixels = content[-1].reshape(-1)
+    start = end - pixels.nbytes
+    return frame_type, pixels, raw_frame[:start], raw_frame[end:]
+
+
+def _to_planes(residual):
+    # Low bytes then high bytes: each plane is much more regular than the interleaved pairs
+    return residual.view(np.uint8).reshape(-1, 2).T.tobytes()
+
+
+def _from_planes(data, offset, count):
+    planes = np.frombuffer(data, dtype=np.uint8, count=2 * count, offset=offset).reshape(2, count)
+    return np.ascontiguousarray(planes.T).view(DEPTH_DTYPE).reshape(-1)
+
+
+class DepthEncoder(object):
+    """
+    Encodes the depth frames of one stream, keeping the previous frame of each type
+    """
+
+    def __init__(self, keyframe_interval=30, level=1):
+        if keyframe_interval < 1:
+            raise ValueError("keyframe_interval must be at least 1")
+        self.keyframe_interval = keyframe_interval
+        self.level = level
+        # frame type -> (index of the last frame, its pixels)
+        self._previous = {}
+
+    def encode(self, raw_frame):
+        """
+        raw_frame: frame without its length prefix, of one of the DEPTH_TYPES
+        Return: the packet, as bytes
+        """
+        raw_frame = memoryview(raw_frame)
+        frame_type, pixels, prefix, suffix = _split(raw_frame)
+
+        index, previous = self._previous.get(frame_type, (-1, None))
+        index = (index + 1) & 0xFFFFFFFF
+        if previous is None or previous.shape != pixels.shape or index % self.keyframe_interval == 0:
+            kind, residual = KEYFRAME, pixels
+        else:
+            # uint16 arithmetic wraps around, which the decoder undoes exactly
+            kind, residual = DELTA, pixels - previous
+        self._previous[frame_type] = (index, pixels.copy())
+
+        compressor = zlib.compressobj(self.level)
+        data = b"".join((compressor.compress(prefix), compressor.compress(_to_planes(residual)),
+                         compressor.compress(suffix), compressor.flush()))
+        return PACKET_HEADER.pack(kind, frame_type, index, len(prefix), len(pixels)) + data
+
+    def reset(self):
+        """
+        Start over with keyframes, e.g. for a new downstream consumer
+        """
+        self._previous.clear()
+
+
+class DepthDecoder(object):
+    """
+    Decodes the packets of one DepthEncoder, in the order they were encoded
+    """
+
+    def __init__(self):
+        # frame type -> (index of the last frame, its pixels)
+        self._previous = {}
+
+    def decode(self, packet):
+        """
+        Return: the raw frame, without length prefix, as bytes
+        Raises ValueError for a delta whose reference frame was not decoded
+        """
+        kind, frame_type, index, prefix_size, pixel_count = PACKET_HEADER.unpack_from(packet)
+        data = zlib.decompress(memoryview(packet)[PACKET_HEADER.size:])
+        residual = _from_planes(data, prefix_size, pixel_count)
+
+        if kind == KEYFRAME:
+            pixels = residual
+        elif kind == DELTA:
+            last_index, previous = self._previous.get(frame_type, (None, None))
+            if previous is None or (last_index + 1) & 0xFFFFFFFF != index or len(previous) != pixel_count:
+                raise ValueError("Missing reference for {} frame {}, wait for the next keyframe".format(
+                    FrameType(frame_type).name, index))
+            pixels = previous + residual
+        else:
+            raise ValueError("Invalid packet kind {}".format(kind))
+        self._previous[frame_type] = (index, pixels)
+
+        suffix_start = prefix_size + 2 * pixel_count
+        return b"".join((data[:prefix_size], pixels.tobytes(), data[suffix_start:]))
+
+    def reset(self):
+        self._previous.clear()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: depth_codec.py <capture file> [keyframe interval]")
+        sys.exit(1)
+
+    from capture import CaptureReader
+
+    encoder = DepthEncoder(int(sys.argv[2]) if len(sys.argv) > 2 else 30)
+    decoder = DepthDecoder()
+    raw_bytes, packet_bytes = {}, {}
+    with CaptureReader(sys.argv[1]) as capture:
+        for i, frame in capture.frames(frame_types=sum(DEPTH_TYPES)):
+            packet = encoder.encode(frame)
+            assert decoder.decode(packet) == frame, "Frame {} doesn't round trip".format(i)
+            frame_type = int(capture.index['frame_type'][i])
+            raw_bytes[frame_type] = raw_bytes.get(frame_type, 0) + len(frame)
+            packet_bytes[frame_type] = packet_bytes.get(frame_type, 0) + len(packet)
+
+    for frame_type in sorted(raw_bytes):
+        print("{:<10s} {:>12d} -> {:>12d} bytes, ratio {:.2f}".format(
+            FrameType(frame_type).name, raw_bytes[frame_type], packet_bytes[frame_type],
+            raw_bytes[frame_type] / float(max(packet_bytes[frame_type], 1))))
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+"""
+Memory-mapped dataset of Depth, LHDepth, RHDepth and HeadDepth frames
+
+DepthDatasetWriter appends frames to one np.memmap per frame type: (N, 424, 512)
+uint16 for Depth and (N, h, w) for the crops, with a parallel array of META_DTYPE
+records. The files are preallocated and doubled when full, so a session of any
+length costs the same memory: the pages are written back by the OS, nothing is
+kept in the process. DepthDataset maps the same files read-only, for random
+access by index or timestamp without parsing anything.
+
+A dataset is a directory:
+
+    dataset.json           frame types, image shape and number of frames of each
+    <FrameType>.frames     (capacity, height, width) uint16 images
+    <FrameType>.meta       (capacity,) META_DTYPE records
+
+The crops change size with the distance of the joint, so they are stored at
+the top left of a fixed (h, w) image (crop_shape), the rest left zero, with
+their actual width and height in the record. Crops larger than crop_shape keep
+their central part; posx and posy are moved accordingly and truncated is set.
+Only the frames counted in dataset.json, which is rewritten on flush(), are
+part of the dataset, so a crash loses at most the frames since the last flush.
+
+    python depth_dataset.py out_dir session.ksim     # convert a capture (capture.py)
+"""
+
+import json
+import os
+import sys
+
+import numpy as np
+
+import codec
+from codec import FrameType, DEPTH_DTYPE, DEPTH_SHAPE
+
+DEPTH_TYPES = (FrameType.Depth, FrameType.LHDepth, FrameType.RHDepth, FrameType.HeadDepth)
+
+META_DTYPE = np.dtype([
+    ('timestamp', '<i8'),
+    ('frame_type', '<i4'),
+    ('width', '<i4'),
+    ('height', '<i4'),
+    # Center of the crop, relative to its top left; NaN for Depth frames
+    ('posx', '<f4'),
+    ('posy', '<f4'),
+    ('truncated', '?'),
+])
+
+MANIFEST = "dataset.json"
+
+
+def _paths(path, frame_type):
+    name = os.path.join(path, FrameType(frame_type).name)
+    return name + ".frames", name + ".meta"
+
+
+class _Stream(object):
+    """
+    Memory maps of one frame type, opened for writing
+    """
+
+    def __init__(self, path, frame_type, shape, count, capacity):
+        self.frame_type = FrameType(frame_type)
+        self.shape = tuple(shape)
+        self.count = count
+        self.frames_path, self.meta_path = _paths(path, frame_type)
+        self.capacity = 0
+        self.images = None
+        self.meta = None
+        self._map(max(capacity, count))
+
+    def _map(self, capacity):
+        # Growing the files keeps what is already in them, the rest reads as zeros
+        for file_path, itemsize in ((self.frames_path, int(np.prod(self.shape)) * DEPTH_DTYPE.itemsize),
+                                    (self.meta_path, META_DTYPE.itemsize)):
+            with open(file_path, 'ab') as f:
+                f.truncate(capacity * itemsize)
+        self.images = np.memmap(self.frames_path, dtype=DEPTH_DTYPE, mode='r+', shape=(capacity,) + self.shape)
+        self.meta = np.memmap(self.meta_path, dtype=META_DTYPE, mode='r+', shape=(capacity,))
+        self.capacity = capacity
+
+    def append(self, timestamp, width, height, posx, posy, depth_data):
+        if self.count == self.capacity:
+            self.flush()
+            self._release()
+            self._map(2 * self.capacity)
+
+        rows, columns = self.shape
+        y0, x0 = max((height - rows) // 2, 0), max((width - columns) // 2, 0)
+        h, w = min(height, rows), min(width, columns)
+        image = self.images[self.count]
+        image[:h, :w] = depth_data[y0:y0 + h, x0:x0 + w]
+        # Left over from a previous, larger frame once the files were reused
+        image[h:, :] = 0
+        image[:h, w:] = 0
+        self.meta[self.count] = (timestamp, self.frame_type, w, h, posx - x0, posy - y0, h < height or w < width)
+        self.count += 1
+
+    def flush(self):
+        self.images.flush()
+        self.meta.flush()
+
+    def _release(self):
+        # np.memmap unmaps when the last reference goes away
+        self.images = self.meta = None
+
+    def close(self):
+        self.flush()
+        self._release()
+        # Give back the preallocated space past the last frame
+        for file_path, itemsize in ((self.frames_path, int(np.prod(self.shape)) * DEPTH_DTYPE.itemsize),
+                                    (self.meta_path, META_DTYPE.itemsize)):
+            with open(file_path, 'r+b') as f:
+                f.truncate(self.count * itemsize)
+
+
+class DepthDatasetWriter(object):
+    """
+    Appends depth frames to the dataset in directory path, after the frames already in it
+
+    crop_shape: (height, width) the LHDepth, RHDepth and HeadDepth crops are stored at
+    flush_every: frames between two flushes of the files and of dataset.json
+    """
+
+    def __init__(self, path, depth_shape=DEPTH_SHAPE, crop_shape=(256, 256), initial_capacity=1024, flush_every=300):
+        self.path = path
+        self.flush_every = flush_every
+        os.makedirs(path, exist_ok=True)
+
+        manifest = _read_manifest(path)
+        shapes = {FrameType.Depth: tuple(depth_shape)}
+        shapes.update((ft, tuple(crop_shape)) for ft in DEPTH_TYPES[1:])
+        self.streams = {}
+        for frame_type, shape in shapes.items():
+            entry = manifest.get(frame_type.name, {'shape': shape, 'count': 0})
+            if tuple(entry['shape']) != shape:
+                raise ValueError("{} frames in {} are {}, not {}".format(frame_type.name, path, entry['shape'], shape))
+            self.streams[frame_type] = _Stream(path, frame_type, shape, entry['count'], initial_capacity)
+        self._since_flush = 0
+
+    def append(self, timestamp, frame_type, content):
+        """
+        content: content of a frame of one of the DEPTH_TYPES, as returned by codec.decode
+        """
+        stream = self.streams.get(frame_type)
+        if stream is None:
+            raise ValueError("Frame type {} is not a depth frame".format(frame_type))
+        if frame_type == FrameType.Depth:
+            width, height, depth_data = content
+            posx = posy = np.nan
+        else:
+            width, height, posx, posy, depth_data = content
+        stream.append(timestamp, width, height, posx, posy, depth_data)
+
+        self._since_flush += 1
+        if self._since_flush >= self.flush_every:
+            self.flush()
+
+    def write(self, raw_frame):
+        """
+        raw_frame: frame as returned by decode.recv_frame; frames of other types are ignored
+        Return: True if the frame was added
+        """
+        (timestamp, frame_type), offset = codec.decode_header(raw_frame)
+        if frame_type not in self.streams:
+            return False
+        content, _ = codec.decode_content(raw_frame, offset, frame_type)
+        self.append(timestamp, frame_type, content)
+        return True
+
+    def __len__(self):
+        return sum(stream.count for stream in self.streams.values())
+
+    def flush(self):
+        # Frames first, so that dataset.json never counts frames that aren't on disk
+        for stream in self.streams.values():
+            stream.flush()
+        _write_manifest(self.path, self.streams)
+        self._since_flush = 0
+
+    def close(self):
+        for stream in self.streams.values():
+            stream.close()
+        _write_manifest(self.path, self.streams)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _read_manifest(path):
+    try:
+        with open(os.path.join(path, MANIFEST)) as f:
+            return json.load(f)['streams']
+    except FileNotFoundError:
+        return {}
+
+
+def _write_manifest(path, streams):
+    manifest = {'streams': {ft.name: {'shape': list(s.shape), 'count': s.count} for ft, s in streams.items()}}
+    temporary = os.path.join(path, MANIFEST + ".tmp")
+    with open(temporary, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temporary, os.path.join(path, MANIFEST))
+
+
+class DepthDataset(object):
+    """
+    Read-only access to a dataset written by DepthDatasetWriter
+
+    images[frame_type] is an (N, h, w) uint16 np.memmap and meta[frame_type] the
+    (N,) META_DTYPE records, both sliced to the frames in the dataset.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.images = {}
+        self.meta = {}
+        for name, entry in _read_manifest(path).items():
+            frame_type, count = FrameType[name], entry['count']
+            if count == 0:
+                continue
+            frames_path, meta_path = _paths(path, frame_type)
+            self.images[frame_type] = np.memmap(frames_path, dtype=DEPTH_DTYPE, mode='r',
+                                                shape=(count,) + tuple(entry['shape']))
+            self.meta[frame_type] = np.memmap(meta_path, dtype=META_DTYPE, mode='r', shape=(count,))
+
+    def __len__(self):
+        return sum(len(meta) for meta in self.meta.values())
+
+    def count(self, frame_type):
+        meta = self.meta.get(frame_type)
+        return 0 if meta is None else len(meta)
+
+    def timestamps(self, frame_type):
+        return self.meta[frame_type]['timestamp']
+
+    def index(self, frame_type, timestamp):
+        """
+        Return: index of the last frame_type frame at or before timestamp, -1 if there is none
+        """
+        if frame_type not in self.meta:
+            return -1
+        return int(np.searchsorted(self.timestamps(frame_type), timestamp, side='right')) - 1
+
+    def get(self, frame_type, i):
+        """
+        Return: (record, image) of frame i, image being the (height, width) view of the stored frame
+        """
+        record = self.meta[frame_type][i]
+        return record, self.images[frame_type][i, :record['height'], :record['width']]
+
+    def at(self, frame_type, timestamp):
+        """
+        Return: (record, image) of the last frame_type frame at or before timestamp, None if there is none
+        """
+        i = self.index(frame_type, timestamp)
+        return None if i < 0 else self.get(frame_type, i)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage: depth_dataset.py <dataset directory> <capture file>")
+        sys.exit(1)
+
+    from capture import CaptureReader
+
+    with DepthDatasetWriter(sys.argv[1]) as writer, CaptureReader(sys.argv[2]) as capture:
+        for i, frame in capture.frames(frame_types=sum(DEPTH_TYPES)):
+            writer.write(frame)
+
+    dataset = DepthDataset(sys.argv[1])
+    for frame_type in DEPTH_TYPES:
+        print("{:<10s} {:>8d} frames".format(frame_type.name, dataset.count(frame_type)))
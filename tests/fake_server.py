@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""
+Synthetic stand-in for KSIM, for load testing the clients without a Kinect
+
+Speaks the same TCP protocol as MainWindow (see ksim_server.py) and emits
+synthetic frames of every type at configurable rates and sizes, with the byte
+layouts of Frame.Serialize. Frames are only built for the types some client
+subscribed to, and the bulky payloads are generated once up front, so the
+server itself costs little next to the consumers being measured.
+
+    python fake_server.py --port 8000 --fps 30
+"""
+
+import argparse
+import base64
+import datetime
+import math
+import threading
+import time
+
+import numpy as np
+
+import codec
+from codec import FrameType, JOINT_COUNT
+from ksim_server import KsimServer
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+# 8x8 baseline JPEG, used when cv2 is not available to encode a full size image
+_TINY_JPEG = base64.b64decode(
+    "/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDABALDA4MChAODQ4SERATGCgaGBYWGDEjJR0oOjM9PDkzODdASFxOQERXRTc4UG1RV19iZ2hnPk1xeXBkeFxl"
+    "Z2P/2wBDARESEhgVGC8aGi9jQjhCY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2P/wAARCAAIAAgDASIAAhEB"
+    "AxEB/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAAAgEDAwIEAwUFBAQAAAF9AQIDAAQRBRIhMUEGE1FhByJxFDKBkaEII0KxwRVS"
+    "0fAkM2JyggkKFhcYGRolJicoKSo0NTY3ODk6Q0RFRkdISUpTVFVWV1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWGh4iJipKTlJWWl5iZmqKjpKWmp6ipqrKz"
+    "tLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi4+Tl5ufo6erx8vP09fb3+Pn6/8QAHwEAAwEBAQEBAQEBAQAAAAAAAAECAwQFBgcICQoL/8QAtREAAgEC"
+    "BAQDBAcFBAQAAQJ3AAECAxEEBSExBhJBUQdhcRMiMoEIFEKRobHBCSMzUvAVYnLRChYkNOEl8RcYGRomJygpKjU2Nzg5OkNERUZHSElKU1RVVldYWVpj"
+    "ZGVmZ2hpanN0dXZ3eHl6goOEhYaHiImKkpOUlZaXmJmaoqOkpaanqKmqsrO0tba3uLm6wsPExcbHyMnK0tPU1dbX2Nna4uPk5ebn6Onq8vP09fb3+Pn6"
+    "/9oADAMBAAIRAxEAPwClRRRXKdJ//9k="
+)
+
+# Joints the segmented frames are centered on, as in LHDepthFrame, RHDepthFrame and HeadDepthFrame
+SPINE_BASE, HEAD, HAND_LEFT, HAND_RIGHT = 0, 3, 7, 11
+
+# Kinect audio comes in sub-frames of 16ms, i.e. 256 samples at 16kHz
+SAMPLES_PER_SUBFRAME = 256
+
+_EPOCH = datetime.datetime(1, 1, 1)
+
+
+def ticks_now():
+    """
+    Same clock as DateTime.Now.Ticks, which KSIM uses to timestamp frames
+    """
+    return (datetime.datetime.now() - _EPOCH) // datetime.timedelta(microseconds=1) * 10
+
+
+def pad_jpeg(jpeg, size):
+    """
+    Grow a JPEG to about size bytes by inserting comment (COM) segments after SOI,
+    which decoders skip, so payload sizes can be tuned without a real encoder
+    """
+    padding = []
+    missing = size - len(jpeg)
+    while missing > 4:
+        length = min(missing - 2, 0xFFFF)
+        padding.append(b"\xff\xfe" + length.to_bytes(2, 'big') + bytes(length - 2))
+        missing -= length + 2
+    return jpeg[:2] + b"".join(padding) + jpeg[2:]
+
+
+def make_jpeg(width, height, size, rng):
+    if cv2 is not None:
+        image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        ok, encoded = cv2.imencode(".jpg", image)
+        if ok:
+            return encoded.tobytes()
+    return pad_jpeg(_TINY_JPEG, size)
+
+
+def make_depth(width, height, phase, rng):
+    """
+    A floor-like gradient with a blob moving across it, in millimeters
+    """
+    y, x = np.mgrid[0:height, 0:width]
+    depth = 1000.0 + 3000.0 * y / max(height - 1, 1)
+    cx = width * (0.5 + 0.3 * math.sin(phase))
+    cy = height * 0.5
+    blob = (x - cx) ** 2 + (y - cy) ** 2 < (min(width, height) / 6.0) ** 2
+    depth[blob] = 1500.0
+    depth += rng.normal(0.0, 5.0, depth.shape)
+    depth[rng.random(depth.shape) < 0.02] = 0  # invalid pixels
+    return depth.astype(np.uint16)
+
+
+def body_pieces(t, tracking_id=72057594037927936):
+    """
+    BODY values of an engaged body at ~2m, waving both hands
+    """
+    pieces = [tracking_id, 2, 2, 2, 3]  # high confidence, hands open / closed
+    for joint in range(JOINT_COUNT):
+        x = 0.02 * (joint % 5) - 0.04
+        y = 0.6 - 0.05 * joint
+        z = 2.0
+        if joint == HAND_LEFT:
+            x, y = -0.3 + 0.1 * math.sin(t), 0.1 + 0.1 * math.cos(t)
+        elif joint == HAND_RIGHT:
+            x, y = 0.3 + 0.1 * math.cos(t), 0.1 + 0.1 * math.sin(t)
+        pieces.extend((joint, 2, x, y, z, 1.0, 0.0, 0.0, 0.0))
+    return pieces
+
+
+class SyntheticFrames(object):
+    """
+    Middle sections for every frame type, cycling through precomputed variants
+    """
+
+    def __init__(self, args):
+        rng = np.random.default_rng(args.seed)
+        self.variants = args.variants
+
+        self.depth = [codec.encode_depth(make_depth(args.depth_width, args.depth_height, 2 * math.pi * i / args.variants, rng))
+                      for i in range(args.variants)]
+        self.crops = [codec.encode_segmented_depth(make_depth(args.crop, args.crop, 2 * math.pi * i / args.variants, rng),
+                                                   args.crop / 2.0, args.crop / 2.0)
+                      for i in range(args.variants)]
+        stride = args.color_width * 4
+        self.color = codec.encode_color(stride, args.color_width, args.color_height,
+                                        make_jpeg(args.color_width, args.color_height, args.color_bytes, rng))
+        self.head_color = codec.encode_head_color(args.head_color, args.head_color,
+                                                  make_jpeg(args.head_color, args.head_color, args.head_color_bytes, rng))
+        self.speech_every = args.speech_every
+        self.audio_subframes = args.audio_subframes
+        self._rng = rng
+
+    def middle(self, frame_type, tick):
+        variant = tick % self.variants
+        t = tick / 10.0
+        if frame_type == FrameType.Color:
+            return self.color
+        if frame_type == FrameType.HeadColor:
+            return self.head_color
+        if frame_type == FrameType.Depth:
+            return self.depth[variant]
+        if frame_type in (FrameType.LHDepth, FrameType.RHDepth, FrameType.HeadDepth):
+            return self.crops[variant]
+        if frame_type == FrameType.ClosestBody:
+            return codec.encode_closest_body(1, body_pieces(t))
+        if frame_type == FrameType.ClosestFace:
+            return codec.encode_closest_face(1, 1, 0, 0, 10.0 * math.sin(t), 20.0 * math.cos(t), 0.0)
+        if frame_type == FrameType.Speech:
+            if self.speech_every and tick % self.speech_every == 0:
+                return codec.encode_speech("grab,grab this")
+            return codec.encode_speech("")
+        raise ValueError("No synthetic frames for {}".format(frame_type))
+
+    def audio(self, index):
+        n = SAMPLES_PER_SUBFRAME * self.audio_subframes
+        t = (index * n + np.arange(n)) / 16000.0
+        return codec.encode_audio(0.1 * np.sin(2 * math.pi * 440.0 * t))
+
+
+class FakeKsim(object):
+    def __init__(self, args):
+        self.args = args
+        self.server = KsimServer(args.host, args.port, args.max_queued_bytes)
+        self.frames = SyntheticFrames(args)
+        self.timestamp = ticks_now()
+        self.ticks_sent = 0
+        self.audio_sent = 0
+        self._stop = threading.Event()
+
+    def _paced(self, rate, step):
+        period = 1.0 / rate
+        deadline = time.monotonic()
+        index = 0
+        while not self._stop.is_set():
+            step(index)
+            index += 1
+            deadline += period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+            else:
+                # Running late, don't try to catch up with a burst
+                deadline = time.monotonic()
+
+    def _tick(self, index):
+        subscribed = self.server.subscribed_frame_types()
+        # KinectSensor stamps every multi source frame, audio reuses the last stamp
+        self.timestamp = ticks_now()
+        if not subscribed:
+            return
+        middles = {ft: self.frames.middle(ft, index) for ft in FrameType if ft & subscribed}
+        self.server.send_frames(self.timestamp, middles)
+        self.ticks_sent += 1
+
+    def _audio(self, index):
+        if self.server.has_audio_clients():
+            self.server.send_audio(self.timestamp, self.frames.audio(index))
+            self.audio_sent += 1
+
+    def run(self):
+        self.server.start()
+        print("Fake KSIM listening on port {}".format(self.server.port))
+        threads = [threading.Thread(target=self._paced, args=(self.args.fps, self._tick), daemon=True)]
+        audio_rate = 1000.0 / (16 * self.args.audio_subframes)
+        threads.append(threading.Thread(target=self._paced, args=(audio_rate, self._audio), daemon=True))
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def stop(self):
+        self._stop.set()
+        self.server.stop()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="")
+    parser.add_argument("-p", "--port", type=int, default=8000)
+    parser.add_argument("--fps", type=float, default=30.0, help="rate of the multi source frames")
+    parser.add_argument("--audio-subframes", type=int, default=1, help="16ms sub-frames per audio frame")
+    parser.add_argument("--depth-width", type=int, default=512)
+    parser.add_argument("--depth-height", type=int, default=424)
+    parser.add_argument("--crop", type=int, default=168, help="size of the LH/RH/Head depth crops")
+    parser.add_argument("--color-width", type=int, default=1920)
+    parser.add_argument("--color-height", type=int, default=1080)
+    parser.add_argument("--color-bytes", type=int, default=200000, help="JPEG size when cv2 is unavailable")
+    parser.add_argument("--head-color", type=int, default=200, help="size of the head color crop")
+    parser.add_argument("--head-color-bytes", type=int, default=8000)
+    parser.add_argument("--speech-every", type=int, default=90, help="ticks between speech commands, 0 for none")
+    parser.add_argument("--variants", type=int, default=8, help="precomputed depth frames to cycle through")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-queued-bytes", type=int, default=64 << 20)
+    parser.add_argument("--duration", type=float, default=None, help="seconds to run for, forever by default")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    fake = FakeKsim(args)
+    fake.run()
+    try:
+        if args.duration is None:
+            while True:
+                time.sleep(1)
+        else:
+            time.sleep(args.duration)
+    except KeyboardInterrupt:
+        pass
+    fake.stop()
+    print("Sent {} ticks and {} audio frames".format(fake.ticks_sent, fake.audio_sent))
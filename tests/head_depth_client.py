@@ -1,9 +1,9 @@
 #!/usr/bin/env python
 
 import socket, sys, struct
-import time
-import numpy as np
 import matplotlib.pyplot as plt
+from decode import recv_frame, decode
+import metrics
 
 src_addr = 'localhost'
 src_port = 8000
@@ -35,68 +35,40 @@ def connect():
 # Timestamp | frame type | width | height | depth_data
 
 def decode_frame(raw_frame):
-    
-    # Expect little endian byte order
-    endianness = "<"
-
-    # In each frame, a header is transmitted
-    header_format = "qiiiff"
-    header_size = struct.calcsize(endianness + header_format)
-    header = struct.unpack(endianness + header_format, raw_frame[:header_size])
-
-    timestamp, frame_type, width, height, posx, posy = header
-    
-    depth_data_format = str(width * height) + "H"
-    
-    depth_data = struct.unpack_from(endianness + depth_data_format, raw_frame, header_size)
-    
-    return (timestamp, frame_type, width, height, posx, posy, list(depth_data))
-
-def recv_all(sock, size):
-    result = b''
-    while len(result) < size:
-        data = sock.recv(size - len(result))
-        if not data:
-            raise EOFError("Error: Received only {} bytes into {} byte message".format(len(data), size))
-        result += data
-    return result
-
-def recv_depth_frame(sock):
     """
-    Experimental function to read each stream frame from the server
+    Tail (affix) is validated by codec.decode and returned as writer_data
     """
-    (frame_size,) = struct.unpack("<i", recv_all(sock, 4))
-    return recv_all(sock, frame_size) 
-    
+    (timestamp, frame_type), (width, height, posx, posy, depth_data), (writer_data,) = decode(raw_frame)
+
+    return (timestamp, frame_type, width, height, posx, posy, depth_data, writer_data)
 
 if __name__ == '__main__': 
     s = connect()
     if s is None:
         sys.exit(0)
+    metrics.serve_if_requested()
         
     do_plot = True if len(sys.argv) > 1 and sys.argv[1] == '--plot' else False
     
-    start_time = time.time()
     count = 0
     while True:
         try:
-            f = recv_depth_frame(s)
+            f = recv_frame(s)
         except:
             s.close()
             break
-        timestamp, frame_type, width, height, posx, posy, depth_data = decode_frame(f)
+        timestamp, frame_type, width, height, posx, posy, depth_data, writer_data = decode_frame(f)
         #print(timestamp, frame_type, width, height)
         #print("\n\n")
         
         count += 1
         if count == 100:
             print('='*30)
-            print('FPS: ', 100.0 / (time.time() - start_time))
+            print(metrics.REGISTRY.summary())
             print('='*30)
-            start_time = time.time()
             count = 0
             
         if do_plot and count % 20 == 0 and height*width > 0:
-            image = np.array(depth_data).reshape((height, width))
+            image = depth_data
             im = plt.imshow(image, cmap='gray')
             plt.show()
@@ -0,0 +1,331 @@
+"""
+Python implementation of the server side of the KSIM protocol (see MainWindow.xaml.cs)
+
+Handles the RECOGNIZER_REG, VOXSIM_REG and VOXSIM_PASS messages the same way
+MainWindow does, keeps Audio subscribers on their own connections and affixes
+the VoxSim content to the tail of the next frame of each requested type.
+What is sent is up to the caller: fake_server.py generates synthetic frames.
+"""
+
+import collections
+import queue
+import socket
+import struct
+import threading
+
+import codec
+from codec import FrameType
+from protocol import RECOGNIZER_REG, VOXSIM_REG, VOXSIM_PASS
+
+
+_message_length = struct.Struct("<i")
+_message_type = struct.Struct("<B")
+_int = struct.Struct("<i")
+
+
+def get_active_frames(requested_frames):
+    """
+    Same as MainWindow.GetActiveFrames: the frame types set in the bitset, in enum order
+    """
+    return [ft for ft in FrameType if ft & requested_frames]
+
+
+def _recv_exactly(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise EOFError("Error: Received only {} bytes into {} byte message".format(received, size))
+        received += n
+    return buf
+
+
+class Connection(object):
+    """
+    One client connection. Writes are queued and sent by a dedicated thread, so a
+    slow client never blocks the others; a client whose queue grows past
+    max_queued_bytes is disconnected, like a failed write in MainWindow.OnSent,
+    or with drop_on_overflow the writes that don't fit are dropped instead.
+    """
+
+    def __init__(self, server, sock, address, max_queued_bytes, drop_on_overflow=False):
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.max_queued_bytes = max_queued_bytes
+        self.drop_on_overflow = drop_on_overflow
+        self.frame_types = []
+
+        self.queued_bytes = 0
+        self.sent_bytes = 0
+        self.dropped_writes = 0
+        self.closed = False
+
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._sender = threading.Thread(target=self._send_loop, name="KsimSend-{}".format(address), daemon=True)
+        self._receiver = threading.Thread(target=self._receive_loop, name="KsimRecv-{}".format(address), daemon=True)
+
+    def start(self):
+        self._sender.start()
+        self._receiver.start()
+
+    def write(self, data):
+        with self._lock:
+            if self.closed:
+                return False
+            if self.queued_bytes + len(data) > self.max_queued_bytes:
+                if self.drop_on_overflow:
+                    self.dropped_writes += 1
+                    return False
+                overflow = True
+            else:
+                overflow = False
+                self.queued_bytes += len(data)
+        if overflow:
+            self.server.remove_connection(self)
+            return False
+        self._queue.put(data)
+        return True
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        self._queue.put(None)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _send_loop(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.server.remove_connection(self)
+                break
+            with self._lock:
+                self.queued_bytes -= len(data)
+                self.sent_bytes += len(data)
+
+    def _receive_loop(self):
+        try:
+            while not self.closed:
+                (length,) = _message_length.unpack(_recv_exactly(self.sock, _message_length.size))
+                if length < 0:
+                    break
+                message = _recv_exactly(self.sock, length)
+                if length >= 1:
+                    self.server.handle_message(self, message)
+        except (EOFError, OSError, struct.error):
+            pass
+        self.server.remove_connection(self)
+
+
+class KsimServer(object):
+    def __init__(self, host='', port=8000, max_queued_bytes=64 << 20, drop_on_overflow=False):
+        self.host = host
+        self.port = port
+        self.max_queued_bytes = max_queued_bytes
+        self.drop_on_overflow = drop_on_overflow
+
+        # Connection -> subscribed frame types; none of them is Audio
+        self.clients = {}
+        self.audio_clients = []
+        self.voxsim_clients = []
+        self.lock = threading.Lock()
+
+        self.affixes = {ft: collections.deque() for ft in FrameType}
+        self._affix_lock = threading.Lock()
+
+        self._listener = None
+        self._accept_thread = None
+        self._running = False
+
+    def start(self):
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((self.host, self.port))
+        self._listener.listen(16)
+        # Port 0 picks a free port
+        self.port = self._listener.getsockname()[1]
+        self._running = True
+        self._accept_thread = threading.Thread(target=self._accept_loop, name="KsimAccept", daemon=True)
+        self._accept_thread.start()
+
+    def stop(self):
+        self._running = False
+        try:
+            self._listener.close()
+        except OSError:
+            pass
+        with self.lock:
+            connections = list(self.clients) + self.audio_clients + self.voxsim_clients
+            self.clients.clear()
+            del self.audio_clients[:]
+            del self.voxsim_clients[:]
+        for conn in connections:
+            conn.close()
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                sock, address = self._listener.accept()
+            except OSError:
+                break
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            Connection(self, sock, address, self.max_queued_bytes, self.drop_on_overflow).start()
+
+    def remove_connection(self, conn):
+        with self.lock:
+            self.clients.pop(conn, None)
+            if conn in self.audio_clients:
+                self.audio_clients.remove(conn)
+            if conn in self.voxsim_clients:
+                self.voxsim_clients.remove(conn)
+        conn.close()
+
+    def handle_message(self, conn, message):
+        (message_type,) = _message_type.unpack_from(message)
+        body = memoryview(message)[_message_type.size:]
+        if message_type == RECOGNIZER_REG:
+            self.handle_recognizer_registration(conn, body)
+        elif message_type == VOXSIM_REG:
+            with self.lock:
+                self.voxsim_clients.append(conn)
+        elif message_type == VOXSIM_PASS:
+            self.handle_voxsim_pass(conn, body)
+
+    def handle_recognizer_registration(self, conn, body):
+        try:
+            (requested_frames,) = _int.unpack_from(body)
+        except struct.error:
+            conn.close()
+            return
+
+        active_frames = get_active_frames(requested_frames)
+        if not active_frames:
+            # Reject as no valid stream was identified
+            conn.close()
+        elif FrameType.Audio not in active_frames:
+            conn.frame_types = active_frames
+            with self.lock:
+                self.clients[conn] = active_frames
+        elif len(active_frames) == 1:
+            conn.frame_types = active_frames
+            with self.lock:
+                self.audio_clients.append(conn)
+        else:
+            # Reject, Audio can't be combined with other stream types
+            conn.close()
+
+    def handle_voxsim_pass(self, conn, body):
+        try:
+            (total,) = _message_type.unpack_from(body)
+            offset = _message_type.size
+            received = []
+            for _ in range(total):
+                requested_frames, content_length = struct.unpack_from("<ii", body, offset)
+                offset += 8
+                if content_length < 0 or offset + content_length > len(body):
+                    raise struct.error("Affix runs past the end of the message")
+                received.append((requested_frames, bytes(body[offset:offset + content_length])))
+                offset += content_length
+        except struct.error:
+            self.remove_connection(conn)
+            return
+
+        with self._affix_lock:
+            for requested_frames, content in received:
+                for ft in get_active_frames(requested_frames):
+                    self.affixes[ft].append(content)
+
+    def subscribed_frame_types(self):
+        """
+        Union of the frame types requested by the non-Audio clients, as a bitset
+        """
+        subscribed = 0
+        with self.lock:
+            for frame_types in self.clients.values():
+                for ft in frame_types:
+                    subscribed |= ft
+        return FrameType(subscribed)
+
+    def client_count(self):
+        """
+        Number of registered stream clients, Audio included
+        """
+        with self.lock:
+            return len(self.clients) + len(self.audio_clients)
+
+    def max_backlog(self):
+        """
+        Largest number of bytes queued for any stream client
+        """
+        with self.lock:
+            connections = list(self.clients) + self.audio_clients
+        return max([conn.queued_bytes for conn in connections] or [0])
+
+    def has_audio_clients(self):
+        with self.lock:
+            return len(self.audio_clients) > 0
+
+    def pop_affix(self, frame_type):
+        with self._affix_lock:
+            queued = self.affixes[frame_type]
+            return queued.popleft() if queued else None
+
+    def affix_encoded(self, frame_type, wire_frame):
+        """
+        Return: wire_frame (a complete frame, length prefix included) with its tail replaced
+        by the next affix passed for frame_type, or wire_frame itself if there is none
+        """
+        affix = self.pop_affix(frame_type)
+        if affix is None:
+            return wire_frame
+        raw_frame = wire_frame[codec.LENGTH.size:]
+        header, offset = codec.decode_header(raw_frame)
+        _, offset = codec.decode_content(raw_frame, offset, frame_type)
+        return codec.encode(header[0], frame_type, raw_frame[codec.HEADER.size:offset], affix)
+
+    def send_frames(self, timestamp, middles):
+        """
+        Send one tick to the non-Audio clients
+        middles: dict of frame type to the middle section of its frame (see codec.encode_xxx)
+
+        Like MainWindow.OnMultiSourceFrameArrived, nothing is sent to a client for this
+        tick unless all its subscribed frame types are available, and one affix per
+        frame type is consumed per tick. Each frame is serialized once for all clients.
+        """
+        encoded = {}
+        for frame_type, middle in middles.items():
+            encoded[frame_type] = codec.encode(timestamp, frame_type, middle, self.pop_affix(frame_type))
+        self.send_encoded(encoded)
+
+    def send_encoded(self, encoded):
+        """
+        encoded: dict of frame type to the complete frame, length prefix included
+        """
+        with self.lock:
+            clients = list(self.clients.items())
+        for conn, frame_types in clients:
+            if all(ft in encoded for ft in frame_types):
+                conn.write(b"".join(encoded[ft] for ft in frame_types))
+
+    def send_audio(self, timestamp, middle):
+        frame = codec.encode(timestamp, FrameType.Audio, middle, self.pop_affix(FrameType.Audio))
+        self.send_audio_encoded(frame)
+
+    def send_audio_encoded(self, frame):
+        with self.lock:
+            clients = list(self.audio_clients)
+        for conn in clients:
+            conn.write(frame)
@@ -0,0 +1,182 @@
+"""
+Latest-frame-only consumption of KSIM streams
+
+A consumer slower than the sensor falls further behind with every tick: frames
+pile up in the socket buffers and in the server's queue for the connection until
+KSIM gives up on the client. For interactive consumers freshness matters more
+than completeness, so LatestFrameReader drains the socket on its own thread,
+only parses the headers of the frames going past and keeps the newest complete
+tick. Payloads are only decoded for the ticks the consumer actually takes.
+"""
+
+import collections
+import socket
+import threading
+import time
+
+import codec
+import metrics
+from bundle import Bundle
+from codec import FrameType, HEADER, LENGTH, TICKS_PER_SECOND
+from decode import FrameParser, queued_socket_bytes
+
+
+# socket_bytes: received by the kernel but not read yet (None where unknown)
+# seconds: Kinect time between the newest tick received and the last tick consumed (the first tick received
+# before any was consumed)
+Backlog = collections.namedtuple('Backlog', ['socket_bytes', 'seconds'])
+
+
+class LatestFrameReader(object):
+    """
+    Keeps only the newest complete tick of a subscription to frame_types
+
+    get() returns it as a bundle.Bundle, waiting for a tick newer than the last one
+    returned. Ticks that were complete but replaced by a newer one before get() was
+    called are counted in dropped.
+    """
+
+    def __init__(self, sock, frame_types, capacity=1 << 20):
+        self.sock = sock
+        self.frame_types = frozenset(ft for ft in FrameType if ft & frame_types)
+        if not self.frame_types:
+            raise ValueError("No frame type in {}".format(frame_types))
+
+        self.received = 0
+        self.consumed = 0
+        self.dropped = 0
+        self.received_bytes = 0
+        # Kinect timestamps of the first and newest tick received and of the last one returned by get()
+        self.first_timestamp = None
+        self.newest_timestamp = None
+        self.consumed_timestamp = None
+
+        # (timestamp, {frame type: raw frame}) not yet returned by get()
+        self._latest = None
+        self._error = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._parser = FrameParser(capacity)
+        self._receiver = threading.Thread(target=self._receive_loop, name="LatestRecv", daemon=True)
+
+    def start(self):
+        self._receiver.start()
+        return self
+
+    def _receive_loop(self):
+        parser = self._parser
+        # Frames of the tick being received, copied once a recv leaves it incomplete
+        tick_timestamp, tick = None, {}
+        try:
+            while not self._closed:
+                received = self.sock.recv_into(parser.buffer())
+                if not received:
+                    break
+                parser.advance(received)
+                self.received_bytes += received
+
+                newest, completed = None, 0
+                for frame in parser.frames():
+                    timestamp, frame_type = HEADER.unpack_from(frame)
+                    if frame_type not in self.frame_types:
+                        continue
+                    # Payloads are decoded in get(), which records the decode time
+                    metrics.REGISTRY.observe_frame(frame_type, timestamp, len(frame) + LENGTH.size)
+                    if timestamp != tick_timestamp:
+                        tick_timestamp, tick = timestamp, {}
+                    tick[frame_type] = frame
+                    if len(tick) == len(self.frame_types):
+                        completed += 1
+                        newest = (timestamp, tick)
+                        if self.first_timestamp is None:
+                            self.first_timestamp = timestamp
+                        tick_timestamp, tick = None, {}
+
+                # Views over the parser buffer are only valid until the next recv
+                tick = {ft: bytes(frame) for ft, frame in tick.items()}
+                if newest is not None:
+                    self._publish(newest[0], {ft: bytes(frame) for ft, frame in newest[1].items()}, completed)
+        except Exception as ex:
+            if not self._closed:
+                self._error = ex
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _publish(self, timestamp, frames, completed):
+        """
+        completed: ticks completed since the last call, the last of which is timestamp, frames
+        """
+        with self._cond:
+            # Only the last one is kept, replacing the one get() didn't take yet
+            dropped = completed - 1
+            if self._latest is not None:
+                dropped += 1
+            self._latest = (timestamp, frames)
+            self.newest_timestamp = timestamp
+            self.received += completed
+            self.dropped += dropped
+            self._cond.notify_all()
+
+    def get_raw(self, timeout=None):
+        """
+        Return: (timestamp, {frame type: raw frame}) of the newest tick not returned yet
+        Raises EOFError once the connection is closed, socket.timeout after timeout seconds
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._latest is not None or self._closed, timeout):
+                raise socket.timeout("No new tick in {} seconds".format(timeout))
+            if self._latest is None:
+                if self._error is not None:
+                    raise self._error
+                raise EOFError("Connection closed")
+            timestamp, frames = self._latest
+            self._latest = None
+            self.consumed += 1
+            self.consumed_timestamp = timestamp
+        return timestamp, frames
+
+    def get(self, timeout=None):
+        """
+        Return: the newest tick not returned yet, as a complete bundle.Bundle
+        """
+        timestamp, raw_frames = self.get_raw(timeout)
+        frames = {}
+        for frame_type, raw_frame in raw_frames.items():
+            begin = time.perf_counter()
+            header, content, (writer_data,) = codec.decode(raw_frame)
+            metrics.REGISTRY.stream(frame_type).decode.observe(time.perf_counter() - begin)
+            frames[frame_type] = (content, writer_data)
+        return Bundle(timestamp, frames, True)
+
+    def __iter__(self):
+        try:
+            while True:
+                yield self.get()
+        except EOFError:
+            return
+
+    def backlog(self):
+        """
+        Return: Backlog of the consumer, from the socket buffer and the Kinect timestamps
+        """
+        with self._cond:
+            newest = self.newest_timestamp
+            consumed = self.consumed_timestamp if self.consumed_timestamp is not None else self.first_timestamp
+        seconds = 0.0 if newest is None else (newest - consumed) / float(TICKS_PER_SECOND)
+        return Backlog(queued_socket_bytes(self.sock), seconds)
+
+    def close(self):
+        self._closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self._receiver.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,318 @@
+"""
+Metrics of the KSIM streams received by this process
+
+Every frame read through decode.read_frame or async_client is reported to the
+default registry, REGISTRY, per frame type:
+
+- frames and bytes received, in total and per second
+- a histogram of the time spent decoding frames
+- jitter of the arrival times w.r.t. the Kinect timestamps (as in RFC 3550)
+- ticks missing from the Kinect timestamps (dropped ticks)
+- frames carrying an affix
+- bytes waiting to be read from the socket (backlog)
+- latency from capture to arrival, from the alignment of the Kinect timestamps
+  with the host clock (see clock.py)
+
+Recording a frame is a handful of integer and float operations, so it stays on.
+The values are available in process from snapshot(), and over HTTP in the
+Prometheus text format once serve() is called:
+
+    metrics.serve(9108)        # http://localhost:9108/metrics
+"""
+
+import bisect
+import http.server
+import sys
+import threading
+import time
+
+from clock import ClockAlignment
+from codec import FrameType, TICKS_PER_SECOND
+
+# Upper bounds of the decode time histogram buckets, in seconds
+DECODE_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (1e-3, 2.5e-3, 5e-3, 1e-2, 2e-2, 3.3e-2, 5e-2, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+# KinectSensor delivers multi source frames at 30 Hz
+TICK_PERIOD = TICKS_PER_SECOND // 30
+
+DEFAULT_PORT = 9108
+
+
+class Histogram(object):
+    def __init__(self, buckets=DECODE_BUCKETS):
+        self.buckets = tuple(buckets)
+        # One more for the values above the last bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        Return: list of (upper bound, number of values <= bound), ending with +inf
+        """
+        total, result = 0, []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        """
+        Return: upper bound of the bucket holding the q-th quantile (0 <= q <= 1), None if empty
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+
+
+class StreamMetrics(object):
+    """
+    Metrics of one frame type
+    """
+
+    def __init__(self, frame_type, clock=time.monotonic, rate_interval=1.0):
+        self.frame_type = FrameType(frame_type)
+        self.clock = clock
+        self.rate_interval = rate_interval
+
+        self.frames = 0
+        self.bytes = 0
+        self.affixes = 0
+        self.dropped_ticks = 0
+        self.jitter = 0.0
+        self.backlog_bytes = None
+        self.decode = Histogram()
+        self.latency = Histogram(LATENCY_BUCKETS)
+        # clock.Alignment of the last frame
+        self.alignment = None
+
+        self.frames_per_second = 0.0
+        self.bytes_per_second = 0.0
+        self.affixes_per_second = 0.0
+
+        self._last_arrival = None
+        self._last_timestamp = None
+        self._window_start = None
+        self._window_counts = (0, 0, 0)
+        self._backlog_sampled = None
+
+    def observe(self, timestamp, size, decode_seconds=None, writer_data=None, now=None):
+        now = self.clock() if now is None else now
+        self.frames += 1
+        self.bytes += size
+        if writer_data:
+            self.affixes += 1
+        if decode_seconds is not None:
+            self.decode.observe(decode_seconds)
+
+        if self._last_timestamp is not None:
+            sent_gap = timestamp - self._last_timestamp
+            # Audio frames reuse the timestamp of the last multi source frame
+            if self.frame_type != FrameType.Audio:
+                missing = (sent_gap + TICK_PERIOD // 2) // TICK_PERIOD - 1
+                if missing > 0:
+                    self.dropped_ticks += missing
+                difference = (now - self._last_arrival) - sent_gap / float(TICKS_PER_SECOND)
+                self.jitter += (abs(difference) - self.jitter) / 16.0
+        self._last_timestamp = timestamp
+        self._last_arrival = now
+
+        if self._window_start is None:
+            self._window_start = now
+            self._window_counts = (self.frames - 1, self.bytes - size, self.affixes - (1 if writer_data else 0))
+        elif now - self._window_start >= self.rate_interval:
+            elapsed = now - self._window_start
+            frames, received, affixes = self._window_counts
+            self.frames_per_second = (self.frames - frames) / elapsed
+            self.bytes_per_second = (self.bytes - received) / elapsed
+            self.affixes_per_second = (self.affixes - affixes) / elapsed
+            self._window_start = now
+            self._window_counts = (self.frames, self.bytes, self.affixes)
+
+    def backlog_due(self, now=None):
+        """
+        True at most once per rate interval, for callers sampling the socket backlog
+        """
+        now = self.clock() if now is None else now
+        if self._backlog_sampled is None or now - self._backlog_sampled >= self.rate_interval:
+            self._backlog_sampled = now
+            return True
+        return False
+
+    def snapshot(self):
+        return {
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'frames_per_second': self.frames_per_second,
+            'bytes_per_second': self.bytes_per_second,
+            'decode_seconds_sum': self.decode.sum,
+            'decode_seconds_count': self.decode.count,
+            'decode_seconds_p50': self.decode.quantile(0.5),
+            'decode_seconds_p99': self.decode.quantile(0.99),
+            'latency_seconds_p50': self.latency.quantile(0.5),
+            'latency_seconds_p99': self.latency.quantile(0.99),
+            'jitter_seconds': self.jitter,
+            'dropped_ticks': self.dropped_ticks,
+            'affixes': self.affixes,
+            'affixes_per_second': self.affixes_per_second,
+            'backlog_bytes': self.backlog_bytes,
+        }
+
+
+class Registry(object):
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.streams = {}
+        self.alignment = ClockAlignment(clock=clock)
+        self._lock = threading.Lock()
+
+    def stream(self, frame_type):
+        metrics = self.streams.get(frame_type)
+        if metrics is None:
+            with self._lock:
+                metrics = self.streams.get(frame_type)
+                if metrics is None:
+                    metrics = StreamMetrics(frame_type, self.clock)
+                    self.streams[frame_type] = metrics
+        return metrics
+
+    def observe_frame(self, frame_type, timestamp, size, decode_seconds=None, writer_data=None):
+        """
+        Record one received frame; size includes the length prefix
+        Return: clock.Alignment of the frame (capture time and latency), None before the first aligned frame
+        """
+        now = self.clock()
+        alignment = self.alignment.observe(timestamp, now, update=frame_type != FrameType.Audio)
+        stream = self.stream(frame_type)
+        stream.observe(timestamp, size, decode_seconds, writer_data, now)
+        if alignment is not None:
+            stream.latency.observe(alignment.latency)
+            stream.alignment = alignment
+        return alignment
+
+    def set_backlog(self, frame_type, backlog_bytes):
+        self.stream(frame_type).backlog_bytes = backlog_bytes
+
+    def snapshot(self):
+        """
+        Return: dict of frame type name to its metrics
+        """
+        return {FrameType(ft).name: metrics.snapshot() for ft, metrics in sorted(self.streams.items())}
+
+    def summary(self):
+        """
+        Return: one line per frame type, for printing
+        """
+        lines = []
+        for name, values in self.snapshot().items():
+            decode, latency = values['decode_seconds_p50'], values['latency_seconds_p50']
+            lines.append("{:<12s} {:>6.1f} fps {:>10.0f} B/s decode p50 <= {} latency p50 <= {} jitter {:.1f} ms "
+                         "dropped {} affixes {} backlog {}".format(
+                name, values['frames_per_second'], values['bytes_per_second'],
+                "-" if decode is None else "{:g} ms".format(decode * 1000),
+                "-" if latency is None else "{:g} ms".format(latency * 1000), values['jitter_seconds'] * 1000,
+                values['dropped_ticks'], values['affixes'], values['backlog_bytes']))
+        if self.alignment.ready:
+            lines.append("Kinect clock drift {:+.1f} ppm".format(self.alignment.drift * 1e6))
+        return "\n".join(lines)
+
+    def prometheus_text(self):
+        families = [
+            ('ksim_frames_total', 'counter', "Frames received", 'frames'),
+            ('ksim_bytes_total', 'counter', "Bytes received, length prefixes included", 'bytes'),
+            ('ksim_frames_per_second', 'gauge', "Frames received per second", 'frames_per_second'),
+            ('ksim_bytes_per_second', 'gauge', "Bytes received per second", 'bytes_per_second'),
+            ('ksim_jitter_seconds', 'gauge', "Arrival jitter w.r.t. the Kinect timestamps", 'jitter'),
+            ('ksim_dropped_ticks_total', 'counter', "Ticks missing from the Kinect timestamps", 'dropped_ticks'),
+            ('ksim_affixes_total', 'counter', "Frames received with an affix", 'affixes'),
+            ('ksim_affixes_per_second', 'gauge', "Frames received with an affix per second", 'affixes_per_second'),
+            ('ksim_backlog_bytes', 'gauge', "Bytes waiting to be read from the socket", 'backlog_bytes'),
+        ]
+        streams = sorted(self.streams.items())
+        lines = []
+        for name, kind, description, attribute in families:
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for frame_type, metrics in streams:
+                value = getattr(metrics, attribute)
+                if value is not None:
+                    lines.append('{}{{frame_type="{}"}} {}'.format(name, FrameType(frame_type).name, value))
+
+        histograms = [
+            ('ksim_decode_seconds', "Time spent decoding frames", 'decode'),
+            ('ksim_latency_seconds', "Arrival time minus estimated capture time", 'latency'),
+        ]
+        for name, description, attribute in histograms:
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} histogram".format(name))
+            for frame_type, metrics in streams:
+                label = FrameType(frame_type).name
+                histogram = getattr(metrics, attribute)
+                for bound, count in histogram.cumulative():
+                    lines.append('{}_bucket{{frame_type="{}",le="{}"}} {}'.format(
+                        name, label, "+Inf" if bound == float('inf') else repr(bound), count))
+                lines.append('{}_sum{{frame_type="{}"}} {}'.format(name, label, histogram.sum))
+                lines.append('{}_count{{frame_type="{}"}} {}'.format(name, label, histogram.count))
+
+        if self.alignment.ready:
+            lines.append("# HELP ksim_clock_drift Drift of the Kinect clock against the host monotonic clock")
+            lines.append("# TYPE ksim_clock_drift gauge")
+            lines.append("ksim_clock_drift {}".format(self.alignment.drift))
+        return "\n".join(lines) + "\n"
+
+
+# Registry the client paths report to
+REGISTRY = Registry()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=DEFAULT_PORT, host='127.0.0.1', registry=REGISTRY):
+    """
+    Serve registry in the Prometheus text format from a background thread
+    Return: the server; its port is server.server_address[1] (port 0 picks a free one)
+    """
+    handler = type('Handler', (_Handler,), {'registry': registry})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True).start()
+    return server
+
+
+def serve_if_requested(argv=None, port=DEFAULT_PORT):
+    """
+    For the clients in tests/: serve the metrics if --metrics is on the command line
+    """
+    argv = sys.argv if argv is None else argv
+    if '--metrics' not in argv:
+        return None
+    server = serve(port)
+    print("Metrics on http://127.0.0.1:{}/metrics".format(server.server_address[1]))
+    return server
@@ -0,0 +1,133 @@
+"""
+PCM-16 conversion of Kinect audio and a background WAV writer
+
+Kinect audio is mono 32 bit float sampled at 16kHz (see AudioFrame.cs).
+"""
+
+import os
+import queue
+import threading
+import wave
+
+import numpy as np
+
+
+SAMPLE_RATE = 16000
+
+PCM16_DTYPE = np.dtype("<i2")
+
+
+def to_pcm16(samples):
+    """
+    Convert float samples in [-1.0, 1.0] to PCM-16, clipping anything outside
+    Return: a new int16 array, so samples may be a view over the receive buffer
+    """
+    samples = np.asarray(samples, dtype=np.float32)
+    return (np.clip(samples, -1.0, 1.0) * 32767).astype(PCM16_DTYPE)
+
+
+class WavWriter(object):
+    """
+    Writes PCM-16 audio to disk from a background thread
+
+    write() never blocks: converted frames go into a bounded queue, and when the
+    disk can't keep up frames are dropped (and counted) rather than stalling the
+    thread that drains the socket. The writer thread batches queued frames into
+    large writeframes calls.
+
+    With rotate_seconds, a new file is started every rotate_seconds of audio and
+    files are named <name>_0000.wav, <name>_0001.wav, ...
+    """
+
+    def __init__(self, path, sample_rate=SAMPLE_RATE, max_queued=512, batch_bytes=1 << 16, rotate_seconds=None):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.batch_bytes = batch_bytes
+        self.frames_per_file = int(rotate_seconds * sample_rate) if rotate_seconds else None
+        if self.frames_per_file is not None and self.frames_per_file < 1:
+            raise ValueError("rotate_seconds must be at least one sample long, got {}".format(rotate_seconds))
+
+        self.dropped = 0
+        self.files = []
+
+        self._queue = queue.Queue(max_queued)
+        self._wav = None
+        self._frames_in_file = 0
+        self._thread = threading.Thread(target=self._run, name="WavWriter", daemon=True)
+        self._thread.start()
+
+    def write(self, samples):
+        """
+        Queue float samples for writing; return False if they had to be dropped
+        """
+        try:
+            self._queue.put_nowait(to_pcm16(samples))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self):
+        """
+        Write out everything queued so far and close the current file
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _next_path(self):
+        if self.frames_per_file is None:
+            return self.path
+        name, ext = os.path.splitext(self.path)
+        return "{}_{:04d}{}".format(name, len(self.files), ext or ".wav")
+
+    def _open(self):
+        path = self._next_path()
+        self._wav = wave.open(path, 'wb')
+        self._wav.setparams((1, PCM16_DTYPE.itemsize, self.sample_rate, 0, "NONE", "NONE"))
+        self._frames_in_file = 0
+        self.files.append(path)
+
+    def _write_batch(self, batch):
+        pcm = np.concatenate(batch) if len(batch) > 1 else batch[0]
+        while len(pcm) > 0:
+            if self._wav is None:
+                self._open()
+            if self.frames_per_file is None:
+                room = len(pcm)
+            else:
+                room = self.frames_per_file - self._frames_in_file
+            self._wav.writeframes(pcm[:room].tobytes())
+            self._frames_in_file += len(pcm[:room])
+            pcm = pcm[room:]
+            if self.frames_per_file is not None and self._frames_in_file >= self.frames_per_file:
+                self._wav.close()
+                self._wav = None
+
+    def _run(self):
+        done = False
+        while not done:
+            # Block for the first frame, then take whatever else is already queued
+            batch = [self._queue.get()]
+            size = 0
+            while batch[-1] is not None and size < self.batch_bytes:
+                size += batch[-1].nbytes
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if batch[-1] is None:
+                done = True
+                batch.pop()
+            if batch:
+                self._write_batch(batch)
+
+        if self._wav is not None:
+            self._wav.close()
+            self._wav = None
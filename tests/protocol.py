@@ -0,0 +1,105 @@
+"""
+Messages a client sends to KSIM, see MainWindow.OnReceived
+
+Every message is Length (4 bytes, signed) | Message Type (1 byte) | payload,
+where Length counts the message type and the payload.
+"""
+
+import struct
+
+from codec import FrameType
+
+
+RECOGNIZER_REG = 1
+VOXSIM_REG = 2
+VOXSIM_PASS = 3
+
+_prefix = struct.Struct("<iB")
+
+# Requested frame types as a FrameType bitset
+_recognizer_reg = struct.Struct("<iBi")
+
+# Number of affixes
+_voxsim_pass = struct.Struct("<B")
+
+# Frame types the affix is meant for | Affix length
+_affix = struct.Struct("<ii")
+
+# Affixes tagged with a sequence number start with #<sequence>|, so a client can tell
+# which message put them in the tail of a frame
+_SEQUENCE_MARK = b"#"
+_SEQUENCE_END = b"|"
+
+
+def pack_recognizer_registration(frame_types):
+    """
+    Audio can only be requested on its own; KSIM closes connections asking for Audio with anything else
+    """
+    return _recognizer_reg.pack(_recognizer_reg.size - 4, RECOGNIZER_REG, int(frame_types))
+
+
+def pack_voxsim_registration():
+    return _prefix.pack(_prefix.size - 4, VOXSIM_REG)
+
+
+def pack_voxsim_pass(affixes):
+    """
+    affixes: dict of frame types (a FrameType bitset) to the affix for them (str or bytes)
+    """
+    if len(affixes) > 255:
+        raise ValueError("At most 255 affixes can be passed in one message, got {}".format(len(affixes)))
+
+    parts = [None, _voxsim_pass.pack(len(affixes))]
+    length = _prefix.size - 4 + _voxsim_pass.size
+    for frame_types, affix in affixes.items():
+        if isinstance(affix, str):
+            affix = affix.encode('ascii')
+        parts.append(_affix.pack(int(frame_types), len(affix)))
+        parts.append(affix)
+        length += _affix.size + len(affix)
+    parts[0] = _prefix.pack(length, VOXSIM_PASS)
+    return b"".join(parts)
+
+
+def is_valid_subscription(frame_types):
+    """
+    Mirrors the checks in MainWindow.HandleRecognizerRegistration
+    """
+    frame_types = FrameType(frame_types) & sum(FrameType)
+    if not frame_types:
+        return False
+    return frame_types == FrameType.Audio or not frame_types & FrameType.Audio
+
+
+def split_subscription(frame_types):
+    """
+    Return: list of the valid subscriptions covering frame_types, Audio being on its own
+    """
+    frame_types = FrameType(frame_types) & sum(FrameType)
+    subscriptions = []
+    if frame_types & ~FrameType.Audio:
+        subscriptions.append(frame_types & ~FrameType.Audio)
+    if frame_types & FrameType.Audio:
+        subscriptions.append(FrameType.Audio)
+    return subscriptions
+
+
+def tag_affix(sequence, affix):
+    """
+    Return: affix (str or bytes) prefixed with sequence, as bytes
+    """
+    if isinstance(affix, str):
+        affix = affix.encode('ascii')
+    return _SEQUENCE_MARK + str(int(sequence)).encode('ascii') + _SEQUENCE_END + affix
+
+
+def parse_affix(writer_data):
+    """
+    Return: (sequence, affix) for an affix made by tag_affix, (None, writer_data) for any other
+    """
+    writer_data = bytes(writer_data)
+    if writer_data.startswith(_SEQUENCE_MARK):
+        end = writer_data.find(_SEQUENCE_END, 1)
+        if end > 1 and writer_data[1:end].isdigit():
+            return int(writer_data[1:end]), writer_data[end + 1:]
+    return None, writer_data
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Fan-out relay between one KSIM and many clients
+
+MainWindow serializes every frame again for each client, inside the lock on the
+client list, so the sensor host can't keep up with many consumers. The relay
+holds a single subscription to KSIM for all the frame types the consumers need
+(plus one for Audio, which can't be combined) and serves any number of clients
+with the same protocol (see ksim_server.py). The frames are forwarded as
+received, serialized once, to each client subscribed to them; every client has
+its own bounded send queue, so a slow one only loses its own ticks.
+
+    python relay.py ksim-host 224 --port 8001          # ClosestBody and both hands
+    python relay.py ksim-host 226 --audio --port 8001  # Color too, and Audio
+"""
+
+import argparse
+import socket
+import threading
+
+from codec import FrameType, HEADER, LENGTH
+from decode import FrameReader
+from ksim_server import KsimServer
+from protocol import pack_recognizer_registration
+
+
+def subscribe(host, port, frame_types):
+    sock = socket.create_connection((host, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(pack_recognizer_registration(frame_types))
+    return sock
+
+
+class Relay(object):
+    def __init__(self, upstream_host, upstream_port, frame_types, audio=False, host='', port=8001,
+                 max_queued_bytes=16 << 20, drop_on_overflow=True):
+        self.upstream = (upstream_host, upstream_port)
+        self.frame_types = frozenset(ft for ft in FrameType if ft & frame_types and ft != FrameType.Audio)
+        self.audio = audio or bool(frame_types & FrameType.Audio)
+        if not self.frame_types and not self.audio:
+            raise ValueError("No frame type to relay in {}".format(frame_types))
+        self.server = KsimServer(host, port, max_queued_bytes, drop_on_overflow)
+
+        self.ticks_relayed = 0
+        self.audio_relayed = 0
+        self.closed = threading.Event()
+        self._sockets = []
+        self._threads = []
+
+    def start(self):
+        self.server.start()
+        if self.frame_types:
+            mask = sum(self.frame_types)
+            self._start(self._relay_ticks, subscribe(self.upstream[0], self.upstream[1], mask))
+        if self.audio:
+            self._start(self._relay_audio, subscribe(self.upstream[0], self.upstream[1], FrameType.Audio))
+        return self
+
+    def _start(self, target, sock):
+        self._sockets.append(sock)
+        thread = threading.Thread(target=self._run, args=(target, sock), name="Relay-" + target.__name__, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _run(self, target, sock):
+        try:
+            target(FrameReader(sock))
+        except (EOFError, OSError):
+            pass
+        # Without the upstream connection there is nothing left to relay
+        self.closed.set()
+
+    def _relay_ticks(self, reader):
+        # KSIM sends each tick as the subscribed frame types back to back, with one timestamp
+        tick_timestamp, tick = None, {}
+        while not self.closed.is_set():
+            frame = reader.read()
+            timestamp, frame_type = HEADER.unpack_from(frame)
+            if timestamp != tick_timestamp:
+                tick_timestamp, tick = timestamp, {}
+            wire_frame = LENGTH.pack(len(frame)) + frame
+            tick[frame_type] = self.server.affix_encoded(frame_type, wire_frame)
+            if len(tick) == len(self.frame_types):
+                self.server.send_encoded(tick)
+                self.ticks_relayed += 1
+                tick_timestamp, tick = None, {}
+
+    def _relay_audio(self, reader):
+        while not self.closed.is_set():
+            frame = reader.read()
+            wire_frame = LENGTH.pack(len(frame)) + frame
+            self.server.send_audio_encoded(self.server.affix_encoded(FrameType.Audio, wire_frame))
+            self.audio_relayed += 1
+
+    def dropped_writes(self):
+        """
+        Return: dict of client address to the number of ticks it lost to a full send queue
+        """
+        with self.server.lock:
+            connections = list(self.server.clients) + self.server.audio_clients
+        return {conn.address: conn.dropped_writes for conn in connections}
+
+    def stop(self):
+        self.closed.set()
+        for sock in self._sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        for thread in self._threads:
+            thread.join()
+        self.server.stop()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("upstream_host")
+    parser.add_argument("frame_types", type=int, help="frame types to subscribe to upstream, as a bitset")
+    parser.add_argument("--upstream-port", type=int, default=8000)
+    parser.add_argument("--audio", action="store_true", help="relay Audio too, on its own upstream connection")
+    parser.add_argument("--host", default="")
+    parser.add_argument("-p", "--port", type=int, default=8001)
+    parser.add_argument("--max-queued-bytes", type=int, default=16 << 20, help="send queue size of each client")
+    parser.add_argument("--disconnect-slow", action="store_true",
+                        help="disconnect clients whose queue is full, like KSIM, instead of dropping their ticks")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    relay = Relay(args.upstream_host, args.upstream_port, args.frame_types, args.audio, args.host, args.port,
+                  args.max_queued_bytes, not args.disconnect_slow)
+    relay.start()
+    print("Relaying {} from {}:{} on port {}".format(FrameType(args.frame_types), args.upstream_host,
+                                                      args.upstream_port, relay.server.port))
+    try:
+        while not relay.closed.wait(5.0):
+            print("{} ticks, {} audio frames, {} clients, dropped {}".format(
+                relay.ticks_relayed, relay.audio_relayed, relay.server.client_count(), relay.dropped_writes()))
+    except KeyboardInterrupt:
+        pass
+    relay.stop()
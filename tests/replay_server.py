@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Serves a capture (see capture.py) over the KSIM protocol
+
+Frames are sent byte for byte as recorded, from a mmap of the capture, grouped
+by timestamp the way MainWindow sends one tick. Clients subscribe as usual and
+only get the frame types they asked for.
+
+    python replay_server.py session.ksim                 # real time
+    python replay_server.py session.ksim --speed 4       # 4x
+    python replay_server.py session.ksim --speed 0       # as fast as the clients drain
+    python replay_server.py session.ksim --start 639278704980332300
+"""
+
+import argparse
+import time
+
+from codec import FrameType, TICKS_PER_SECOND
+from capture import CaptureReader
+from ksim_server import KsimServer
+
+
+class Replay(object):
+    def __init__(self, capture, server, speed=1.0, max_backlog=8 << 20):
+        self.capture = capture
+        self.server = server
+        self.speed = speed
+        self.max_backlog = max_backlog
+        self.ticks_sent = 0
+        self.frames_sent = 0
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def _ticks(self, start, stop):
+        """
+        Yield (timestamp, [positions]) grouping consecutive frames with the same timestamp and kind (Audio or not)
+        """
+        timestamps = self.capture.index['timestamp']
+        types = self.capture.index['frame_type']
+        i = start
+        while i < stop:
+            j = i + 1
+            audio = types[i] == FrameType.Audio
+            while j < stop and timestamps[j] == timestamps[i] and (types[j] == FrameType.Audio) == audio \
+                    and types[j] not in types[i:j]:
+                j += 1
+            yield int(timestamps[i]), list(range(i, j))
+            i = j
+
+    def _wait_for_clients(self):
+        # As fast as possible is only useful while the clients keep up
+        while self.server.max_backlog() > self.max_backlog:
+            time.sleep(0.001)
+
+    def run(self, start=0, stop=None):
+        stop = len(self.capture) if stop is None else stop
+        types = self.capture.index['frame_type']
+        first_timestamp = None
+        began = time.monotonic()
+
+        for timestamp, positions in self._ticks(start, stop):
+            if self.stopped:
+                break
+            if self.speed > 0:
+                if first_timestamp is None:
+                    first_timestamp = timestamp
+                due = began + (timestamp - first_timestamp) / TICKS_PER_SECOND / self.speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                self._wait_for_clients()
+
+            frames = {}
+            for i in positions:
+                frame_type = int(types[i])
+                # Content passed by a VoxSim client replaces the recorded tail, like in KSIM
+                frames[frame_type] = self.server.affix_encoded(frame_type, self.capture.wire_frame(i))
+
+            if FrameType.Audio in frames:
+                self.server.send_audio_encoded(frames[FrameType.Audio])
+            else:
+                self.server.send_encoded(frames)
+            self.ticks_sent += 1
+            self.frames_sent += len(frames)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("capture")
+    parser.add_argument("--host", default="")
+    parser.add_argument("-p", "--port", type=int, default=8000)
+    parser.add_argument("--speed", type=float, default=1.0, help="playback speed, 0 for as fast as possible")
+    parser.add_argument("--start", type=int, default=None, help="timestamp to start from")
+    parser.add_argument("--stop", type=int, default=None, help="timestamp to stop at")
+    parser.add_argument("--loop", action="store_true")
+    parser.add_argument("--clients", type=int, default=1, help="clients to wait for before starting")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    capture = CaptureReader(args.capture)
+    server = KsimServer(args.host, args.port)
+    server.start()
+    print("Replaying {} frames from {} on port {}".format(len(capture), args.capture, server.port))
+
+    start = capture.seek(args.start) if args.start is not None else 0
+    stop = capture.seek(args.stop) if args.stop is not None else len(capture)
+
+    replay = Replay(capture, server, args.speed)
+    try:
+        while server.client_count() < args.clients:
+            time.sleep(0.05)
+        while True:
+            replay.run(start, stop)
+            if not args.loop:
+                break
+    except KeyboardInterrupt:
+        pass
+
+    # Let the clients drain what is queued before closing
+    while server.max_backlog() > 0 and server.client_count() > 0:
+        time.sleep(0.01)
+    server.stop()
+    capture.close()
+    print("Sent {} frames in {} ticks".format(replay.frames_sent, replay.ticks_sent))
@@ -1,10 +1,10 @@
 #!/usr/bin/env python
 
 import socket, sys, struct
-import time
-import numpy as np
 import matplotlib.pyplot as plt
 from decode import read_frame
+from codec import decode_segmented_depth
+import metrics
 
 src_addr = 'localhost'
 src_port = 8000
@@ -42,36 +42,17 @@ def connect():
 """
 
 
-def decode_content(raw_frame, offset):
-    """
-    raw_frame: frame starting from 4 to end (4 for length field)
-    offset: index where header ends; header is header_l, timestamp, frame_type
-    """
-    endianness = "<"
-
-    content_header_format = "iiff"  # width, height, posx, posy
-    content_header_size = struct.calcsize(endianness + content_header_format)
-    content_header = struct.unpack_from(endianness + content_header_format, raw_frame, offset)
-
-    width, height, posx, posy = content_header
-    # print(width, height, posx, posy)
-
-    depth_data_format = str(width * height) + "H"
-    depth_data = struct.unpack_from(endianness + depth_data_format, raw_frame, offset + content_header_size)
-
-    offset = offset + content_header_size + struct.calcsize(
-        endianness + depth_data_format)  # new offset from where tail starts
-    return (width, height, posx, posy, list(depth_data)), offset
+decode_content = decode_segmented_depth
 
 
 if __name__ == '__main__':
     s = connect()
     if s is None:
         sys.exit(0)
+    metrics.serve_if_requested()
 
     do_plot = True if len(sys.argv) > 1 and sys.argv[1] == '--plot' else False
 
-    start_time = time.time()
     count = 0
     while True:
         try:
@@ -86,12 +67,11 @@ if __name__ == '__main__':
         count += 1
         if count == 100:
             print('=' * 30)
-            print('FPS: ', 100.0 / (time.time() - start_time))
+            print(metrics.REGISTRY.summary())
             print('=' * 30)
-            start_time = time.time()
             count = 0
 
         if do_plot and count % 20 == 0 and height * width > 0:
-            image = np.array(depth_data).reshape((height, width))
+            image = depth_data
             im = plt.imshow(image, cmap='gray')
             plt.show()
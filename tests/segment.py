@@ -0,0 +1,193 @@
+"""
+Client side port of SegmentedDepthFrame (KSIM/Frames/SegmentedDepthFrame.cs)
+
+KSIM builds LHDepth, RHDepth and HeadDepth by copying the whole depth frame for
+each of them and clamping it pixel by pixel. segment_body does the same from a
+single Depth frame and the ClosestBody frame of the same tick, so a client can
+subscribe to Depth | ClosestBody once instead of to every crop. Each crop is cut
+and clamped with a few array operations over the segmented region only.
+
+Segmentation follows Segment, Threshold and SerializeMiddle exactly, including
+the single precision arithmetic, the zero padding where the cube leaves the
+frame and the 168x168 frame of 255 when the depth at the center is invalid.
+The only approximation is the center: KSIM maps the joint to depth space with
+the sensor's CoordinateMapper, which is replaced here by a pinhole projection
+(camera_to_depth_space). Given exact depth space centers, segment() is bit-exact.
+"""
+
+import collections
+
+import numpy as np
+
+from codec import FrameType, DEPTH_DTYPE, JOINT_COUNT
+
+CUBE_SIZE = 396
+CUBE_SIZE_Z = 300
+
+# As in SegmentedDepthFrame, in single precision
+FX = np.float32(288.03)
+FY = np.float32(287.07)
+
+# Size and value of the frame sent when the depth at the center is invalid (0)
+FALLBACK_SIZE = 168
+FALLBACK_VALUE = 255
+
+# Joints the crops are centered on (Microsoft.Kinect.JointType)
+HEAD, HAND_LEFT, HAND_RIGHT = 3, 7, 11
+
+SEGMENTED_JOINTS = collections.OrderedDict([
+    (FrameType.HeadDepth, HEAD),
+    (FrameType.LHDepth, HAND_LEFT),
+    (FrameType.RHDepth, HAND_RIGHT),
+])
+
+DepthIntrinsics = collections.namedtuple('DepthIntrinsics', ['fx', 'fy', 'cx', 'cy'])
+
+# Typical factory calibration of the Kinect v2 depth camera; pass the values read
+# from CoordinateMapper.GetDepthCameraIntrinsics for a specific sensor
+KINECT_DEPTH_INTRINSICS = DepthIntrinsics(365.456, 365.456, 254.878, 205.395)
+
+# Content of a frame that could not be segmented, as returned by codec.decode_segmented_depth
+NOT_SEGMENTED = (0, 0, -1.0, -1.0, np.zeros((0, 0), dtype=DEPTH_DTYPE))
+
+# Offsets into the BODY values, see codec.BODY_FORMAT and codec.JOINT_FORMAT
+_JOINTS_OFFSET = 5
+_JOINT_VALUES = 9
+_POSITION = 2
+
+
+def camera_to_depth_space(points, intrinsics=KINECT_DEPTH_INTRINSICS):
+    """
+    points: (..., 3) camera space positions in meters
+    Return: (..., 2) float32 depth space (x, y); like CoordinateMapper, -inf for points at or behind the camera
+    """
+    points = np.asarray(points, dtype=np.float64)
+    x, y, z = points[..., 0], points[..., 1], points[..., 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = intrinsics.cx + intrinsics.fx * x / z
+        v = intrinsics.cy - intrinsics.fy * y / z
+    behind = ~(z > 0)
+    u = np.where(behind, -np.inf, u)
+    v = np.where(behind, -np.inf, v)
+    return np.stack((u, v), axis=-1).astype(np.float32)
+
+
+def segment_bounds(depth_data, pos_x, pos_y):
+    """
+    Same as SegmentedDepthFrame.Segment
+    Return: (x_start, x_end, y_start, y_end, pos_x, pos_y, pos_z), or None if the frame can't be segmented
+    """
+    height, width = depth_data.shape
+    if not (np.isfinite(pos_x) and np.isfinite(pos_y)):
+        return None
+    pos_x, pos_y = np.float32(pos_x), np.float32(pos_y)
+
+    # IndexIntoDepthData: truncated like (int), x may be one past the end of the row
+    x, y = int(pos_x), int(pos_y)
+    if not (0 <= x <= width and 0 <= y < height) or y * width + x >= depth_data.size:
+        return None
+    pos_z = int(depth_data.reshape(-1)[y * width + x])
+
+    if pos_z == 0:
+        center = np.float32(FALLBACK_SIZE / 2.0)
+        return 0, FALLBACK_SIZE, 0, FALLBACK_SIZE, center, center, 0
+
+    # posX * posZ / fx is single precision in C#, the rest is double
+    z = np.float32(pos_z)
+    x_center = float(pos_x * z / FX)
+    y_center = float(pos_y * z / FY)
+    x_start = int(((x_center - CUBE_SIZE / 2.0) / pos_z) * float(FX))
+    x_end = int(((x_center + CUBE_SIZE / 2.0) / pos_z) * float(FX))
+    y_start = int(((y_center - CUBE_SIZE / 2.0) / pos_z) * float(FY))
+    y_end = int(((y_center + CUBE_SIZE / 2.0) / pos_z) * float(FY))
+    return x_start, x_end, y_start, y_end, pos_x, pos_y, pos_z
+
+
+def segment(depth_data, pos_x, pos_y):
+    """
+    Crop and clamp depth_data around the depth space point (pos_x, pos_y)
+    Return: (width, height, posx, posy, depth_data) as decode_segmented_depth returns it for LH/RH/HeadDepth
+    """
+    bounds = segment_bounds(depth_data, pos_x, pos_y)
+    if bounds is None:
+        return NOT_SEGMENTED
+    x_start, x_end, y_start, y_end, pos_x, pos_y, pos_z = bounds
+    height, width = depth_data.shape
+
+    # Zero padding wherever the cube is outside of the frame
+    crop = np.zeros((y_end - y_start, x_end - x_start), dtype=DEPTH_DTYPE)
+    x0, x1 = max(x_start, 0), min(x_end, width)
+    y0, y1 = max(y_start, 0), min(y_end, height)
+    if x1 > x0 and y1 > y0:
+        region = depth_data[y0:y1, x0:x1]
+        target = crop[y0 - y_start:y1 - y_start, x0 - x_start:x1 - x_start]
+        if pos_z == 0:
+            target[...] = FALLBACK_VALUE
+        else:
+            # Threshold: invalid pixels go to the back of the cube, the others are clamped into it
+            z_start = max(pos_z - CUBE_SIZE_Z // 2, 0)
+            z_end = min(pos_z + CUBE_SIZE_Z // 2, np.iinfo(DEPTH_DTYPE).max)
+            np.clip(region, z_start, z_end, out=target)
+            target[region == 0] = z_end
+
+    posx = float(pos_x - np.float32(x_start))
+    posy = float(pos_y - np.float32(y_start))
+    return x_end - x_start, y_end - y_start, posx, posy, crop
+
+
+def same_frame(expected, actual):
+    """
+    Both are (width, height, posx, posy, depth_data) as returned by decode_segmented_depth
+    """
+    return expected[:4] == actual[:4] and np.array_equal(expected[4], actual[4])
+
+
+def find_center(depth_data, received, guess, radius=32):
+    """
+    The header only holds the center relative to the crop, so look for the crop
+    origin near the projected joint that reproduces the received frame exactly.
+    This takes CoordinateMapper out of the comparison.
+    Return: segmented frame that matches received, or None
+    """
+    width, height, posx, posy, _ = received
+    if width == 0:
+        return None
+    gx, gy = int(guess[0] - posx), int(guess[1] - posy)
+    for y_start in range(gy - radius, gy + radius + 1):
+        for x_start in range(gx - radius, gx + radius + 1):
+            pos_x, pos_y = np.float32(posx) + np.float32(x_start), np.float32(posy) + np.float32(y_start)
+            # Cheap check of the crop size first
+            bounds = segment_bounds(depth_data, pos_x, pos_y)
+            if bounds is None or bounds[1] - bounds[0] != width or bounds[3] - bounds[2] != height:
+                continue
+            candidate = segment(depth_data, pos_x, pos_y)
+            if same_frame(candidate, received):
+                return candidate
+    return None
+
+
+def joint_positions(closest_body):
+    """
+    closest_body: content of a ClosestBody frame, (tracked_body_count, engaged, frame_pieces)
+    Return: (JOINT_COUNT, 3) camera space positions, or None if no body is engaged
+    """
+    tracked_body_count, engaged, frame_pieces = closest_body
+    if not engaged:
+        return None
+    values = np.asarray(frame_pieces[_JOINTS_OFFSET:], dtype=np.float64).reshape(JOINT_COUNT, _JOINT_VALUES)
+    return values[:, _POSITION:_POSITION + 3]
+
+
+def segment_body(depth_data, closest_body, intrinsics=KINECT_DEPTH_INTRINSICS, frame_types=tuple(SEGMENTED_JOINTS)):
+    """
+    depth_data: (height, width) array of a Depth frame
+    closest_body: content of the ClosestBody frame of the same tick
+    Return: dict of frame type (LHDepth, RHDepth, HeadDepth) to the content of that frame
+    """
+    positions = joint_positions(closest_body)
+    if positions is None:
+        # SetCenter leaves the center invalid when no body is engaged
+        return {frame_type: NOT_SEGMENTED for frame_type in frame_types}
+
+    centers = camera_to_depth_space(positions[[SEGMENTED_JOINTS[ft] for ft in frame_types]], intrinsics)
+    return {frame_type: segment(depth_data, x, y) for frame_type, (x, y) in zip(frame_types, centers)}
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import socket, sys, struct
+import time
+from codec import FrameType
+from bundle import read_bundles
+from segment import segment_body, camera_to_depth_space, joint_positions, same_frame, find_center, SEGMENTED_JOINTS
+import metrics
+
+src_addr = 'localhost'
+src_port = 8000
+
+# The crops KSIM sends, along with what is needed to compute them on this side
+stream_id = FrameType.Depth | FrameType.ClosestBody | FrameType.LHDepth | FrameType.RHDepth | FrameType.HeadDepth
+
+def connect():
+    """
+    Connect to a specific port
+    """
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    try:
+        sock.connect((src_addr, src_port))
+    except:
+        print("Error connecting to {}:{}".format(src_addr, src_port))
+        return None
+    try:
+        print("Sending stream info")
+        sock.sendall(struct.pack('<iBi', 5, 1, stream_id));
+    except:
+        print("Error: Stream rejected")
+        return None
+    print("Successfully connected to host")
+    return sock
+
+
+if __name__ == '__main__':
+
+    s = connect()
+    if s is None:
+        sys.exit(0)
+    metrics.serve_if_requested()
+
+    # Exhaustive search for the exact center, slow
+    search = True if len(sys.argv) > 1 and sys.argv[1] == '--search' else False
+
+    stats = {ft: [0, 0, 0] for ft in SEGMENTED_JOINTS}  # frames, same as projected, same with exact center
+    count = 0
+    for timestamp, frames, complete in read_bundles(s, stream_id):
+        (width, height, depth_data), _ = frames[FrameType.Depth]
+        closest_body, _ = frames[FrameType.ClosestBody]
+
+        t_begin = time.time()
+        local = segment_body(depth_data, closest_body)
+        t_end = time.time()
+
+        positions = joint_positions(closest_body)
+        for frame_type, joint in SEGMENTED_JOINTS.items():
+            received, _ = frames[frame_type]
+            counts = stats[frame_type]
+            counts[0] += 1
+            if same_frame(local[frame_type], received):
+                counts[1] += 1
+                counts[2] += 1
+            elif search and positions is not None:
+                guess = camera_to_depth_space(positions[joint])
+                if find_center(depth_data, received, guess) is not None:
+                    counts[2] += 1
+                else:
+                    print("{} {}: no center reproduces the frame ({}x{}, pos {}, {})".format(
+                        timestamp, frame_type.name, *received[:4]))
+
+        count += 1
+        if count == 100:
+            print('='*30)
+            print(metrics.REGISTRY.summary())
+            print('Segmentation time: {:.2f} ms'.format((t_end - t_begin) * 1000))
+            for frame_type, (total, projected, exact) in stats.items():
+                print('{:<10s} {} frames, {} equal with the projected center, {} equal with the exact center'.format(
+                    frame_type.name, total, projected, exact))
+            print('='*30)
+            count = 0
+
+    s.close()
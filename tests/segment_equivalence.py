@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+Equivalence check of segment.py against KSIM's LHDepth, RHDepth and HeadDepth frames
+
+Two checks, exiting with status 1 if either finds a difference:
+
+- reference: segment() against reference_segment(), a literal port of the C#
+  loops of SegmentedDepthFrame (Segment, Threshold, SerializeMiddle), on
+  synthetic frames covering the edge cases: the 168x168 fallback, centers in
+  and one past the last column, cubes crossing each border and centers that
+  can't be segmented.
+- capture: replays a capture of Depth | ClosestBody | LHDepth | RHDepth |
+  HeadDepth (capture.py) and checks that every crop KSIM sent is reproduced by
+  segment() from the Depth frame of the same tick. The exact center comes from
+  CoordinateMapper on the server, so it is searched for around the pinhole
+  projection of the joint (segment.find_center).
+
+    python capture.py segment.ksim 241 60       # Depth|ClosestBody|LHDepth|RHDepth|HeadDepth, one minute
+    python segment_equivalence.py segment.ksim
+    python segment_equivalence.py               # reference check only
+"""
+
+import argparse
+import sys
+
+import numpy as np
+
+import codec
+from bundle import BundleAssembler
+from capture import CaptureReader
+from codec import FrameType, DEPTH_DTYPE, DEPTH_SHAPE
+from segment import (segment, same_frame, find_center, camera_to_depth_space, joint_positions, SEGMENTED_JOINTS,
+                     FX, FY, CUBE_SIZE, CUBE_SIZE_Z, FALLBACK_SIZE, FALLBACK_VALUE)
+
+FRAME_TYPES = FrameType.Depth | FrameType.ClosestBody | FrameType.LHDepth | FrameType.RHDepth | FrameType.HeadDepth
+
+
+def reference_segment(depth_data, pos_x, pos_y):
+    """
+    SegmentedDepthFrame statement by statement, on a copy of depth_data as KSIM copies the frame
+    Return: (width, height, posx, posy, depth_data) as written by SerializeMiddle
+    """
+    height, width = depth_data.shape
+    data = depth_data.reshape(-1).tolist()
+
+    def index_into_depth_data(x, y):
+        # (int) truncates toward zero; one past the end is allowed for x
+        x, y = int(x), int(y)
+        if 0 <= x <= width and 0 <= y < height:
+            return y * width + x
+        return -1
+
+    # Segment
+    if not (np.isfinite(pos_x) and np.isfinite(pos_y)):
+        # (int) of an infinite float is int.MinValue
+        return 0, 0, np.float32(-1.0), np.float32(-1.0), []
+    pos_x, pos_y = np.float32(pos_x), np.float32(pos_y)
+    index = index_into_depth_data(pos_x, pos_y)
+    if index == -1:
+        return 0, 0, np.float32(-1.0), np.float32(-1.0), []
+    pos_z = data[index]
+    is_depth_invalid = pos_z == 0
+    if is_depth_invalid:
+        x_start, x_end, y_start, y_end = 0, FALLBACK_SIZE, 0, FALLBACK_SIZE
+        pos_x = pos_y = np.float32(FALLBACK_SIZE / 2.0)
+    else:
+        # float * ushort / float is float, the rest is double
+        x_start = int((((float(pos_x * np.float32(pos_z) / FX)) - (CUBE_SIZE / 2.0)) / pos_z) * float(FX))
+        x_end = int((((float(pos_x * np.float32(pos_z) / FX)) + (CUBE_SIZE / 2.0)) / pos_z) * float(FX))
+        y_start = int((((float(pos_y * np.float32(pos_z) / FY)) - (CUBE_SIZE / 2.0)) / pos_z) * float(FY))
+        y_end = int((((float(pos_y * np.float32(pos_z) / FY)) + (CUBE_SIZE / 2.0)) / pos_z) * float(FY))
+
+    x_start_in_frame = x_start if x_start >= 0 else 0
+    x_end_in_frame = x_end if x_end <= width else width
+    y_start_in_frame = y_start if y_start >= 0 else 0
+    y_end_in_frame = y_end if y_end <= height else height
+
+    # Threshold, down to the end of the frame
+    z_start, z_end = pos_z - CUBE_SIZE_Z / 2.0, pos_z + CUBE_SIZE_Z / 2.0
+    x_start_in_buffer = index_into_depth_data(x_start_in_frame, y_start_in_frame)
+    x_end_in_buffer = index_into_depth_data(x_end_in_frame, y_start_in_frame)
+    while x_end_in_buffer <= len(data):
+        for i in range(x_start_in_buffer, x_end_in_buffer):
+            if is_depth_invalid:
+                data[i] = FALLBACK_VALUE
+            elif data[i] == 0:
+                data[i] = int(z_end)
+            elif data[i] > z_end:
+                data[i] = int(z_end)
+            elif data[i] < z_start:
+                data[i] = int(z_start)
+        x_start_in_buffer += width
+        x_end_in_buffer += width
+
+    # SerializeMiddle
+    segmented_width = x_end - x_start
+    if x_end < 0:
+        prepend_zeros = x_end - x_start
+    elif x_start < 0:
+        prepend_zeros = -x_start
+    else:
+        prepend_zeros = 0
+    if x_start >= width:
+        append_zeros = x_end - x_start
+    elif x_end > width:
+        append_zeros = x_end - width
+    else:
+        append_zeros = 0
+    if y_end < 0:
+        prepend_rows = y_end - y_start
+    elif y_start < 0:
+        prepend_rows = -y_start
+    else:
+        prepend_rows = 0
+    if y_start >= height:
+        append_rows = y_end - y_start
+    elif y_end > height:
+        append_rows = y_end - height
+    else:
+        append_rows = 0
+
+    values = []
+    for i in range(prepend_rows):
+        values.extend([0] * segmented_width)
+    x_start_in_buffer = index_into_depth_data(x_start_in_frame, y_start_in_frame)
+    x_end_in_buffer = index_into_depth_data(x_end_in_frame, y_start_in_frame)
+    for i in range(y_end_in_frame - y_start_in_frame):
+        values.extend([0] * prepend_zeros)
+        for j in range(x_start_in_buffer, x_end_in_buffer):
+            values.append(data[j])
+        x_start_in_buffer += width
+        x_end_in_buffer += width
+        values.extend([0] * append_zeros)
+    for i in range(append_rows):
+        values.extend([0] * segmented_width)
+
+    return (segmented_width, y_end - y_start, pos_x - np.float32(x_start), pos_y - np.float32(y_start), values)
+
+
+def same_as_reference(expected, actual):
+    width, height, posx, posy, values = expected
+    if len(values) != width * height:
+        return False
+    return same_frame((width, height, posx, posy, np.array(values, dtype=DEPTH_DTYPE).reshape(height, width)), actual)
+
+
+def synthetic_cases(rng, random_centers=20):
+    """
+    Yield (name, depth_data, pos_x, pos_y)
+    """
+    height, width = DEPTH_SHAPE
+    depth_data = rng.integers(500, 4500, size=DEPTH_SHAPE).astype(DEPTH_DTYPE)
+    # Invalid pixels, which Threshold moves to the back of the cube
+    depth_data[rng.random(DEPTH_SHAPE) < 0.1] = 0
+
+    def at(x, y, z):
+        frame = depth_data.copy()
+        frame[int(y), int(x)] = z
+        return frame
+
+    yield "fallback-168", at(200.5, 150.2, 0), 200.5, 150.2
+    yield "fallback-168 near the corner", at(509.9, 422.5, 0), 509.9, 422.5
+    yield "center in the last column", at(width - 0.4, 212.3, 1200), width - 0.4, 212.3
+    # IndexIntoDepthData allows x == width, which reads the first pixel of the next row
+    next_row = depth_data.copy()
+    next_row[101, 0] = 900
+    yield "center one past the last column", next_row, width + 0.3, 100.7
+    yield "cube crossing the left border", at(10.3, 200.0, 800), 10.3, 200.0
+    yield "cube crossing the right border", at(500.2, 200.0, 800), 500.2, 200.0
+    yield "cube crossing the top border", at(256.0, 5.5, 800), 256.0, 5.5
+    yield "cube crossing the bottom border", at(256.0, 420.7, 800), 256.0, 420.7
+    yield "cube crossing the top left corner", at(3.0, 3.0, 700), 3.0, 3.0
+    yield "cube crossing the bottom right corner", at(509.0, 421.0, 700), 509.0, 421.0
+    yield "cube larger than the frame", at(256.5, 212.5, 100), 256.5, 212.5
+    yield "center in the sub-pixel left of the frame", at(0, 50.0, 1000), -0.5, 50.0
+    yield "center left of the frame", depth_data, -1.5, 50.0
+    yield "center below the frame", depth_data, 100.0, height + 0.5
+    yield "center behind the camera", depth_data, -np.inf, -np.inf
+    yield "center not a number", depth_data, np.nan, 10.0
+    for i in range(random_centers):
+        yield "random center {}".format(i), depth_data, rng.uniform(0, width), rng.uniform(0, height)
+
+
+def check_reference(seed=0):
+    """
+    Return: number of synthetic cases where segment() differs from the reference
+    """
+    failures = 0
+    for name, depth_data, pos_x, pos_y in synthetic_cases(np.random.default_rng(seed)):
+        if not same_as_reference(reference_segment(depth_data, pos_x, pos_y), segment(depth_data, pos_x, pos_y)):
+            print("reference: {} ({}, {}) differs".format(name, pos_x, pos_y))
+            failures += 1
+    return failures
+
+
+def is_fallback(received):
+    width, height, posx, posy, depth_data = received
+    return (width == height == FALLBACK_SIZE and posx == posy == FALLBACK_SIZE / 2.0
+            and np.all(depth_data == FALLBACK_VALUE))
+
+
+def check_capture(path, radius=32):
+    """
+    Return: (crops checked, crops not reproduced, crops not segmented by KSIM)
+    """
+    checked, failures, skipped = 0, 0, 0
+    assembler = BundleAssembler(FRAME_TYPES, clock=lambda: 0.0)
+    with CaptureReader(path) as capture:
+        for _, frame in capture.frames(frame_types=int(FRAME_TYPES)):
+            (timestamp, frame_type), content, _ = codec.decode(frame)
+            for bundle in assembler.add(timestamp, FrameType(frame_type), content):
+                if not bundle.complete:
+                    continue
+                (width, height, depth_data), _ = bundle.frames[FrameType.Depth]
+                closest_body, _ = bundle.frames[FrameType.ClosestBody]
+                positions = joint_positions(closest_body)
+                for frame_type, joint in SEGMENTED_JOINTS.items():
+                    received, _ = bundle.frames[frame_type]
+                    checked += 1
+                    if received[0] == 0:
+                        # Without a body there is no center; otherwise CoordinateMapper put it outside of the frame
+                        if positions is not None:
+                            skipped += 1
+                        continue
+                    if positions is None:
+                        reproduced = False
+                    elif is_fallback(received):
+                        # The crop doesn't depend on the center, only on the depth there being invalid
+                        invalid = np.argwhere(depth_data == 0)
+                        reproduced = len(invalid) > 0 and same_frame(
+                            segment(depth_data, invalid[0][1] + 0.5, invalid[0][0] + 0.5), received)
+                    else:
+                        guess = camera_to_depth_space(positions[joint])
+                        reproduced = find_center(depth_data, received, guess, radius) is not None
+                    if not reproduced:
+                        print("capture: {} {}: no center reproduces the frame ({}x{}, pos {}, {})".format(
+                            timestamp, frame_type.name, *received[:4]))
+                        failures += 1
+    return checked, failures, skipped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("capture", nargs='?', help="capture of Depth, ClosestBody and the three crops")
+    parser.add_argument("--radius", type=int, default=32, help="pixels searched around the projected joint")
+    args = parser.parse_args()
+
+    failures = check_reference()
+    print("reference: {} differences".format(failures))
+    if args.capture is not None:
+        checked, different, skipped = check_capture(args.capture, args.radius)
+        print("capture: {} crops, {} not reproduced, {} not segmented by KSIM".format(checked, different, skipped))
+        failures += different
+    sys.exit(1 if failures else 0)
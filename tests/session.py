@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+One session over every connection a set of frame types needs
+
+HandleRecognizerRegistration rejects subscriptions mixing Audio with other
+types, so a consumer of audio and skeleton needs two connections. Session opens
+the connections for any mask (protocol.split_subscription) and drives all of
+them from one selector (epoll on Linux) in the calling thread: each readable
+connection gets one recv into its FrameParser and the frames it completes are
+decoded and handed out, through callbacks registered with on() or by iterating
+over the session, in the order they were received.
+
+As with decode.read_frame, the arrays in a frame's content are views over the
+receive buffer and only valid until the next frame is taken, unless the session
+was created with copy=True. Frames are recorded in metrics.REGISTRY.
+
+    with Session('localhost', 8000, FrameType.Audio | FrameType.ClosestBody) as session:
+        session.on(FrameType.Audio, on_audio)
+        session.on(FrameType.ClosestBody, on_body)
+        session.run()
+
+    python session.py 40            # Audio and ClosestBody (8|32)
+"""
+
+import collections
+import selectors
+import sys
+import time
+
+import metrics
+from aggregator import Source
+from codec import FrameType
+from decode import decode
+from protocol import split_subscription
+
+SessionFrame = collections.namedtuple('SessionFrame', ['timestamp', 'frame_type', 'content', 'writer_data'])
+
+
+class Session(object):
+    def __init__(self, address='localhost', port=8000, frame_types=FrameType.Audio | FrameType.ClosestBody, copy=False):
+        subscriptions = split_subscription(frame_types)
+        if not subscriptions:
+            raise ValueError("No frame type in {}".format(frame_types))
+        self.frame_types = FrameType(sum(subscriptions))
+        self.copy = copy
+        self.sources = [Source(address, port, mask, host=mask.name) for mask in subscriptions]
+        # frame type -> callbacks, in registration order
+        self.callbacks = collections.defaultdict(list)
+        self._selector = selectors.DefaultSelector()
+        self._stopped = False
+
+    def open(self):
+        try:
+            for source in self.sources:
+                source.open()
+                self._selector.register(source.sock, selectors.EVENT_READ, source)
+        except BaseException:
+            # Don't leave the connections already made behind
+            self.close()
+            raise
+        return self
+
+    def on(self, frame_types, callback):
+        """
+        Call callback(timestamp, frame_type, content, writer_data) for every frame of frame_types (a bitset)
+        """
+        for frame_type in FrameType:
+            if frame_type & frame_types:
+                if not frame_type & self.frame_types:
+                    raise ValueError("{} is not part of the session ({})".format(frame_type.name, self.frame_types))
+                self.callbacks[frame_type].append(callback)
+        return callback
+
+    def frames(self, timeout=None):
+        """
+        Yield SessionFrame as received, until every connection is closed or stop() is called
+        timeout: seconds without any frame after which TimeoutError is raised, None to wait forever
+        """
+        self._stopped = False
+        while not self._stopped and any(not source.closed for source in self.sources):
+            events = self._selector.select(timeout)
+            if not events:
+                raise TimeoutError("No frame in {} seconds".format(timeout))
+            for key, _ in events:
+                source = key.data
+                if source.receive():
+                    for raw_frame in source.parser.frames():
+                        (timestamp, frame_type), content, (writer_data,) = decode(raw_frame, self.copy)
+                        yield SessionFrame(timestamp, FrameType(frame_type), content, writer_data)
+                        if self._stopped:
+                            return
+                elif source.closed:
+                    self._selector.unregister(source.sock)
+                    source.close()
+
+    def __iter__(self):
+        return self.frames()
+
+    def run(self, timeout=None):
+        """
+        Dispatch every frame to the callbacks registered for its type, until stop() or the connections close
+        """
+        for frame in self.frames(timeout):
+            for callback in self.callbacks.get(frame.frame_type, ()):
+                callback(*frame)
+
+    def stop(self):
+        """
+        Make run() / frames() return after the current frame, e.g. from a callback
+        """
+        self._stopped = True
+
+    def close(self):
+        for source in self.sources:
+            if source.sock is not None and not source.closed:
+                if source.sock in self._selector.get_map():
+                    self._selector.unregister(source.sock)
+                source.close()
+        self._selector.close()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    frame_types = int(sys.argv[1]) if len(sys.argv) > 1 else int(FrameType.Audio | FrameType.ClosestBody)
+    metrics.serve_if_requested()
+
+    with Session('localhost', 8000, frame_types) as session:
+        print("Subscribed to {} over {} connections".format(session.frame_types, len(session.sources)))
+        last_summary = time.monotonic()
+        try:
+            for frame in session:
+                if time.monotonic() - last_summary >= 5.0:
+                    print(metrics.REGISTRY.summary())
+                    last_summary = time.monotonic()
+        except KeyboardInterrupt:
+            pass
+        print(metrics.REGISTRY.summary())
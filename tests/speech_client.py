@@ -4,6 +4,7 @@ import socket
 import sys
 import struct
 from decode import read_frame
+from codec import decode_speech
 
 src_addr = 'localhost'
 src_port = 8000
@@ -35,26 +36,7 @@ def connect():
 
 # Timestamp | frame type | command_length | command
 
-def decode_content(raw_frame, offset):
-    """
-    raw_frame: frame starting from 4 to end (4 for length)
-    offset: index where header ends  # header is header_l, timestamp, frame_type
-    """
-    endianness = "<"
-
-    content_header_format = "i"  # command_length
-    content_header_size = struct.calcsize(endianness + content_header_format)
-    content_header, = struct.unpack_from(endianness + content_header_format, raw_frame, offset)
-
-    command_length = content_header
-    command_format = str(command_length) + "s"
-
-    command = struct.unpack_from(endianness + command_format, raw_frame, offset + content_header_size)[0]
-    command = command.decode('ascii')
-
-    offset = offset + content_header_size + struct.calcsize(
-        endianness + command_format)  # new offset from where tail starts
-    return (command_length, command), offset
+decode_content = decode_speech
 
 
 if __name__ == '__main__':
@@ -1,5 +1,5 @@
 import socket
-import struct
+from protocol import pack_voxsim_registration, pack_voxsim_pass
 
 frameIds = {
     'color': 2,
@@ -23,7 +23,7 @@ def connect(hostname, port):
 
 def register(sock):
     try:
-        sock.sendall(struct.pack('<iB', 1, 2))
+        sock.sendall(pack_voxsim_registration())
     except:
         print("Error: Registration failed")
         return False
@@ -32,12 +32,7 @@ def register(sock):
 
 
 def send_command(sock: socket.socket, command_dict: dict):
-    msg = struct.pack('<BB', 3, len(command_dict))
-    for frameId, command in command_dict.items():
-        command = command.encode('ascii')
-        msg += struct.pack('<ii{}s'.format(len(command)), frameId, len(command), command)
-
-    msg = struct.pack('<i', len(msg)) + msg
+    msg = pack_voxsim_pass(command_dict)
     try:
         sock.sendall(msg)
     except: